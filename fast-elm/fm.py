@@ -1,5 +1,17 @@
 from fastapi import FastAPI                     # 引入 FastAPI 
-from fmdb import connect_to_mongo, close_mongo_connection
+from fmlog import setup_logging, stop_logging, RequestIdMiddleware, LOG_REQUEST_ID
+
+setup_logging()
+
+from fmdb import connect_to_mongo, close_mongo_connection, create_indexes, run_migrations
+from fmhttp import open_http_client, close_http_client
+from fmcity import start_city_index, stop_city_index
+from fmmenu import start_menu_watcher, stop_menu_watcher
+from fmsnapshot import start_snapshot, stop_snapshot
+from fmsearch import start_search_index, stop_search_index
+from fmstock import start_stock_sweeper, stop_stock_sweeper
+from fmcaptcha import start_captcha_pool, stop_captcha_pool
+from fmsecurity import close_password_pool
 from starlette.middleware.cors import CORSMiddleware
 
 
@@ -20,8 +32,13 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Request-ID", "ETag"],
 )
 
+# request id 关联 fmapi -> fmcrud -> mongo 的日志，关闭时不加这一层
+if LOG_REQUEST_ID:
+    app.add_middleware(RequestIdMiddleware)
+
 from fmapi import (
     v1router, 
     v2router,
@@ -36,7 +53,25 @@ from fmapi import (
 
 # Add App Event Handler -------------------------------------------------------
 app.add_event_handler("startup", connect_to_mongo)
+app.add_event_handler("startup", create_indexes)
+app.add_event_handler("startup", run_migrations)
+app.add_event_handler("startup", open_http_client)
+app.add_event_handler("startup", start_city_index)
+app.add_event_handler("startup", start_menu_watcher)
+app.add_event_handler("startup", start_snapshot)
+app.add_event_handler("startup", start_search_index)
+app.add_event_handler("startup", start_stock_sweeper)
+app.add_event_handler("startup", start_captcha_pool)
+app.add_event_handler("shutdown", stop_city_index)
+app.add_event_handler("shutdown", stop_menu_watcher)
+app.add_event_handler("shutdown", stop_snapshot)
+app.add_event_handler("shutdown", stop_search_index)
+app.add_event_handler("shutdown", stop_stock_sweeper)
+app.add_event_handler("shutdown", stop_captcha_pool)
 app.add_event_handler("shutdown", close_mongo_connection)
+app.add_event_handler("shutdown", close_http_client)
+app.add_event_handler("shutdown", close_password_pool)
+app.add_event_handler("shutdown", stop_logging)
 
 app.include_router(v1router, prefix='/v1')
 app.include_router(v2router, prefix='/v2')
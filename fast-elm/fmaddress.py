@@ -0,0 +1,134 @@
+import os
+import logging
+
+from datetime import datetime
+
+from fastapi import HTTPException
+from starlette.status import HTTP_404_NOT_FOUND, HTTP_422_UNPROCESSABLE_ENTITY
+
+from fmdb import db_name, addresses_collection_name, userinfos_collection_name, query_shape
+from fmcache import TieredCache
+from fmcrud import next_id
+from fmjson import model_projection, load_row
+from fmmodel import AddressInCreate, AddressModel
+from fmgeo import (
+    SHOP_SEARCH_RADIUS,
+    haversine,
+    format_distance,
+    geohash_encode,
+    geohash_cover,
+    parse_latlng,
+)
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# address config
+ADDRESS_CACHE_SIZE = int(os.getenv("ADDRESS_CACHE_SIZE", 10000))     # 缓存的用户数
+# 本进程写入时立即失效，其他进程写入后缓存最多旧这么久
+ADDRESS_CACHE_TTL = float(os.getenv("ADDRESS_CACHE_TTL", 60))
+# 餐馆可配送的距离，米
+DELIVERY_RADIUS = float(os.getenv("DELIVERY_RADIUS", SHOP_SEARCH_RADIUS))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# address book
+# 每个地址保存完整精度的 st_geohash 和 location [经度, 纬度]
+# 按餐馆位置查询时用覆盖配送范围的 geohash 前缀，走 (user_id, st_geohash) 索引
+address_cache = TieredCache("addresses", ADDRESS_CACHE_SIZE, ADDRESS_CACHE_TTL)
+address_projection = model_projection(AddressModel)
+
+
+def invalidate_addresses(user_id: int):
+    address_cache.invalidate(str(user_id))
+
+
+query_shape(addresses_collection_name, "user_id")
+async def get_addresses(conn, user_id: int) -> list:
+    async def load():
+        rows = conn[db_name][addresses_collection_name].find(
+            {"user_id": user_id}, projection=address_projection
+        ).sort("id", -1)
+        return [load_row(AddressModel, row) async for row in rows]
+
+    return list(await address_cache.get_or_load(str(user_id), load))
+
+
+query_shape(userinfos_collection_name, "user_id")
+async def add_address(conn, user_id: int, address: AddressInCreate) -> AddressModel:
+    latlng = parse_latlng(address.geohash)
+    if not latlng:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="地址位置格式错误",
+        )
+    latitude, longitude = latlng
+
+    row = dict(
+        address.dict(),
+        id=await next_id(conn, "address_id"),
+        user_id=user_id,
+        st_geohash=geohash_encode(latitude, longitude, 12),
+        location=[longitude, latitude],
+        is_valid=1,
+        created_at=datetime.utcnow(),
+    )
+    await conn[db_name][addresses_collection_name].insert_one(row)
+    # 还没有当前地址时，新地址作为当前地址
+    await conn[db_name][userinfos_collection_name].update_one(
+        {"user_id": user_id, "current_address_id": {"$in": [0, None]}},
+        {"$set": {"current_address_id": row["id"]}},
+    )
+    invalidate_addresses(user_id)
+    logger.debug("add address %s user %s", row["id"], user_id)
+    return AddressModel(**row)
+
+
+query_shape(addresses_collection_name, "user_id", "id")
+async def delete_address(conn, user_id: int, address_id: int):
+    result = await conn[db_name][addresses_collection_name].delete_one(
+        {"user_id": user_id, "id": address_id}
+    )
+    if not result.deleted_count:
+        raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND,
+            detail=f"地址 {address_id} 不存在",
+        )
+    await conn[db_name][userinfos_collection_name].update_one(
+        {"user_id": user_id, "current_address_id": address_id},
+        {"$set": {"current_address_id": 0}},
+    )
+    invalidate_addresses(user_id)
+
+
+query_shape(addresses_collection_name, "user_id", "st_geohash")
+async def get_deliverable_addresses(
+    conn,
+    user_id: int,
+    latitude: float,
+    longitude: float,
+    radius: float = DELIVERY_RADIUS,
+) -> list:
+    # 餐馆 (纬度, 经度) 能配送到的地址，由近到远；一次查询，只读配送范围附近的地址
+    cells = geohash_cover(latitude, longitude, radius)
+    rows = conn[db_name][addresses_collection_name].find(
+        {"$or": [
+            {"user_id": user_id, "st_geohash": {"$gte": cell, "$lt": cell + "~"}}
+            for cell in cells
+        ]},
+        projection=dict(address_projection, location=True),
+    )
+
+    hits = []
+    async for row in rows:
+        lng, lat = row.pop("location")
+        meters = haversine(latitude, longitude, lat, lng)
+        if meters > radius:
+            continue
+        row["is_deliverable"] = True
+        row["distance"] = format_distance(meters)
+        hits.append((meters, row["id"], row))
+    hits.sort(key=lambda hit: hit[:2])
+    return [load_row(AddressModel, row) for _, _, row in hits]
+# =============================================================================
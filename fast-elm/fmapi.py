@@ -1,3 +1,5 @@
+import logging
+
 from datetime import timedelta
 from typing import Optional, List
 
@@ -12,11 +14,24 @@ from fastapi import HTTPException
 
 from slugify import slugify
 from pydantic import BaseModel
-from starlette.responses import JSONResponse
-from fastapi.encoders import jsonable_encoder
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from fmdb import get_database
+from fmcity import get_city_index
+from fmjson import JSONBytesResponse, dumps
+from fmgeo import parse_latlng
+from fmresponse import conditional_response, catalog_policy, menu_policy
+from fmmenu import get_menu_entry
+from fmcart import checkout, place_order, get_cart_location
+from fmaddress import (
+    get_addresses,
+    add_address,
+    delete_address,
+    get_deliverable_addresses,
+)
+from fmorder import get_orders, get_order_snapshot
+from fmcaptcha import CAPTCHA_TTL, issue_captcha, check_captcha
+from fmsnapshot import get_snapshot, snapshot_age
 
 from starlette.status import (
     HTTP_400_BAD_REQUEST,
@@ -28,6 +43,8 @@ from fmtoken import (
     ACCESS_TOKEN_EXPIRE_MINUTES,
     create_access_token,
     get_current_user_authorizer,
+    get_current_user_id,
+    authorize_user_id,
 )
 
 from fmmodel import (
@@ -45,6 +62,9 @@ from fmmodel import (
     DeliveriesModel,
     ActivitiesModel,
     MenusModel,
+    CartInCheckout,
+    OrderInCreate,
+    AddressInCreate,
 )
 
 from fmcrud import (
@@ -52,20 +72,19 @@ from fmcrud import (
     get_article_by_slug,
     create_article_by_slug,
     get_user_by_email,
+    check_user_password,
     create_user,
+    create_user_info,
     get_articles_with_filters,
+    count_articles_with_filters,
     get_cities_by_key,
     get_cities_by_id,
     get_pois_by_ip,
     get_pois_by_latlng,
-    get_index_entry,
     get_userinfos,
-    get_categories,
     get_restaurants,
-    get_deliveries,
-    get_activities,
     get_restaurant_detail,
-    get_menus,
+    search_restaurants,
     get_restaurant_ratings,
     get_restaurant_ratings_scores,
     get_restaurant_ratings_tags,
@@ -81,8 +100,11 @@ payapirouter = APIRouter()
 bosrouter = APIRouter()
 eusrouter = APIRouter()
 
-def create_aliased_response(model: BaseModel) -> JSONResponse:
-    return JSONResponse(content=jsonable_encoder(model, by_alias=True))
+logger = logging.getLogger(__name__)
+
+def create_aliased_response(model: BaseModel) -> JSONBytesResponse:
+    # model.json 按模型自己的 json_encoders 一次编码，不再经过 jsonable_encoder
+    return JSONBytesResponse(model.json(by_alias=True).encode())
 
 
 # -----------------------------------------------------------------------------
@@ -97,11 +119,18 @@ async def login(
         cap: str = Cookie(...),
         db: AsyncIOMotorClient = Depends(get_database)
 ):
-    if not cap:
-        return {"status":0, "type": "ERROR_CAPTCHA", "message": "验证码失效"}
+    # cookie cap 中是验证码 id，答案在服务端，见 fmcaptcha
+    # 错误提示直接返回，不经过 response_model 校验
+    ok = await check_captcha(db, cap, user.vcode) if cap else None
+    if ok is None:
+        return JSONBytesResponse(
+            {"status":0, "type": "ERROR_CAPTCHA", "message": "验证码失效"}
+        )
 
-    if user.vcode != cap:
-        return {"status":0, "type": "ERROR_CAPTCHA", "message": "验证码不正确"}
+    if not ok:
+        return JSONBytesResponse(
+            {"status":0, "type": "ERROR_CAPTCHA", "message": "验证码不正确"}
+        )
 
     dbuser = await get_user_by_email(db, user.email)
     if not dbuser:
@@ -130,7 +159,7 @@ async def login(
             return RWUserInResponse(user=RWUser(**dbuser.dict(), token=token))
         pass
     else:
-        if not dbuser.check_password(user.password):
+        if not await check_user_password(db, dbuser, user.password):
             raise HTTPException(
                 status_code=HTTP_400_BAD_REQUEST, 
                 detail="Incorrect email or password"
@@ -140,6 +169,7 @@ async def login(
             # req.session.user_id = user.user_id;
             # const userinfo = await UserInfoModel.findOne({user_id: user.user_id}, '-_id');
             # res.send(userinfo) 
+            await create_user_info(db, dbuser.username)
             access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
             token = create_access_token(
                 data={"username": dbuser.username}, expires_delta=access_token_expires
@@ -171,6 +201,19 @@ async def register(
             )
 
             return RWUserInResponse(user=RWUser(**dbuser.dict(), token=token))
+
+
+@v1router.post(
+    "/captchas",
+    tags=["authentication"],
+)
+async def v1_captchas(
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    captcha_id, code = await issue_captcha(db)
+    response = JSONBytesResponse({"status": 1, "code": code})
+    response.set_cookie("cap", captcha_id, max_age=int(CAPTCHA_TTL), httponly=True)
+    return response
 # =============================================================================
 
 
@@ -187,21 +230,27 @@ async def get_articles(
     favorited: str = "",
     limit: int = Query(20, gt=0),
     offset: int = Query(0, ge=0),
+    cursor: str = "",
     user: RWUser = Depends(get_current_user_authorizer(required=False)),
     db: AsyncIOMotorClient = Depends(get_database),
 ):
     filters = ArticleFilterParams(
-        tag=tag, author=author, favorited=favorited, limit=limit, offset=offset
+        tag=tag, author=author, favorited=favorited, limit=limit, offset=offset,
+        cursor=cursor,
     )
-    dbarticles = await get_articles_with_filters(
+    dbarticles, next_cursor = await get_articles_with_filters(
         db, filters, user.username if user else None
     )
-    return create_aliased_response(
+    articles_count = await count_articles_with_filters(db, filters)
+    response = create_aliased_response(
         ManyArticlesInResponse(
             articles=dbarticles,
-            articles_count=len(dbarticles)
+            articles_count=articles_count
         )
     )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 
 @v1router.post(
@@ -238,8 +287,20 @@ async def create_new_article(
 )
 async def get_cities(
     type: str = "",
+    if_none_match: str = Header(None),
     db: AsyncIOMotorClient = Depends(get_database),
 ):
+    # hot 和 group 直接返回启动时序列化好的响应体
+    index = get_city_index()
+    if type == "hot":
+        return conditional_response(
+            index.hot_bytes, if_none_match, catalog_policy, index.hot_etag
+        )
+    if type == "group":
+        return conditional_response(
+            index.group_bytes, if_none_match, catalog_policy, index.group_etag
+        )
+
     cities = await get_cities_by_key(db, type)
     return cities
 
@@ -251,10 +312,11 @@ async def get_cities(
 )
 async def get_cities(
     id: int = "",
+    if_none_match: str = Header(None),
     db: AsyncIOMotorClient = Depends(get_database),
 ):
     cities = await get_cities_by_id(db, id)
-    return cities
+    return conditional_response(dumps(cities), if_none_match, catalog_policy)
 # =============================================================================
 
 
@@ -327,10 +389,11 @@ async def index_entry(
     geohash: str = "40.043021,116.434523",
     flags: str = "F",
     group_type: int = 1,
-    db: AsyncIOMotorClient = Depends(get_database),
+    if_none_match: str = Header(None),
 ):
-    results = await get_index_entry(db, geohash, flags, group_type)
-    return results
+    # 入口数据不区分位置，直接返回快照中序列化好的响应体
+    table = get_snapshot().entries
+    return conditional_response(table.body, if_none_match, catalog_policy, table.etag)
 # =============================================================================
 
 
@@ -359,72 +422,83 @@ async def v1_user(
 async def getcategories(
     latitude: str = None,
     longitude: str = None,
-    db: AsyncIOMotorClient = Depends(get_database)
+    if_none_match: str = Header(None),
 ):
-    try:
-        latitude = float(latitude)
-        longitude = float(longitude)
-    except:
-        latitude = 40.043021
-        longitude = 116.434523
-
-    res = await get_categories(db, latitude, longitude)
-    return res
+    # 分类数据目前不区分位置
+    table = get_snapshot().categories
+    return conditional_response(table.body, if_none_match, catalog_policy, table.etag)
 
 # =============================================================================
 
 # -----------------------------------------------------------------------------
 # restaurants
+def parse_int_list(values: List[str]) -> List[int]:
+    res = []
+    for v in values or []:
+        try:
+            res.append(int(v))
+        except (TypeError, ValueError):
+            pass
+    return res
+
+
 @shoppingrouter.get(
     "/restaurants",
     tags=["shopping"],
 )
 async def getrestaurants(
-    # latitude: float = 39.944971,
-    # longitude: float = 116.482313,
     latitude: str,
     longitude: str,
-    # latitude: float = None,
-    # longitude: float = None,
     offset: int = 0,
-    limit: int = 20,
-    extras: List[str] = "activites",
+    limit: int = Query(20, gt=0, le=100),
+    # 前端固定传 extras[]=activities，活动总是随餐馆返回，不再单独处理
+    extras: List[str] = Query(None, alias="extras[]"),
     keyword: str = None,
-    restaurant_category_id: int = None,
-    restaurant_category_ids: List[int] = None,
-    order_by: int = None,
-    delivery_mode: List[int] = None,
+    restaurant_category_id: str = None,
+    restaurant_category_ids: List[str] = Query(
+        None, alias="restaurant_category_ids[]"
+    ),
+    order_by: str = None,
+    delivery_mode: List[str] = Query(None, alias="delivery_mode[]"),
+    support_ids: List[str] = Query(None, alias="support_ids[]"),
+    cursor: str = None,
     db: AsyncIOMotorClient = Depends(get_database)
 ) -> List[ShopModel]:
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except:
+        latitude = 40.043021
+        longitude = 116.434523
 
-    print('api')
-    print(latitude)
-    print(longitude)
-    print(keyword)
-    print(order_by)
-    print(extras)
-    print(offset)
-    print(limit)
-    print(delivery_mode)
-    print(restaurant_category_id)
-    print(restaurant_category_ids)
-    res = await get_restaurants(
+    order_by = (parse_int_list([order_by]) or [None])[0]
+    logger.debug(
+        "restaurants lat=%s lng=%s keyword=%s order_by=%s offset=%s limit=%s "
+        "delivery_mode=%s support_ids=%s category_id=%s category_ids=%s cursor=%s",
+        latitude, longitude, keyword, order_by, offset, limit,
+        delivery_mode, support_ids, restaurant_category_id, restaurant_category_ids, cursor,
+    )
+    res, next_cursor = await get_restaurants(
         db, 
         latitude, 
         longitude, 
         keyword,
-        restaurant_category_id,
+        (parse_int_list([restaurant_category_id]) or [None])[0],
         order_by,
-        extras, 
         offset, 
         limit, 
-        delivery_mode,
-        [],
-        restaurant_category_ids,
+        parse_int_list(delivery_mode),
+        parse_int_list(support_ids),
+        parse_int_list(restaurant_category_ids),
+        cursor,
     )
-    print('end')
 
-    return res
+    # 整页返回时附带下一页游标，客户端可用 cursor 参数继续翻页
+    response = JSONBytesResponse(res)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+    return response
 
 @shoppingrouter.get(
     "/restaurant/{restaurant_id}",
@@ -436,6 +510,25 @@ async def restaurant_restaurant_id(
 ):
     res = await get_restaurant_detail(db, restaurant_id)
     return res
+
+
+@v4router.get(
+    "/restaurants",
+    tags=["shopping"],
+)
+async def v4_restaurants(
+    geohash: str,
+    keyword: str = "",
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, gt=0, le=100),
+    extras: List[str] = Query(None, alias="extras[]"),
+    type: str = "search",
+    db: AsyncIOMotorClient = Depends(get_database),
+) -> List[ShopModel]:
+    # 前端 searchRestaurant 传 geohash="纬度,经度" 和 keyword
+    latlng = parse_latlng(geohash) or (40.043021, 116.434523)
+    res = await search_restaurants(db, *latlng, keyword, offset, limit)
+    return JSONBytesResponse(res)
 # =============================================================================
 
 
@@ -446,10 +539,10 @@ async def restaurant_restaurant_id(
     tags=["shopping"],
 )
 async def v1_restaurants_deliverymodes(
-    db: AsyncIOMotorClient = Depends(get_database),
+    if_none_match: str = Header(None),
 ):
-    res = await get_deliveries(db)
-    return res
+    table = get_snapshot().deliveries
+    return conditional_response(table.body, if_none_match, catalog_policy, table.etag)
 
 # =============================================================================
 
@@ -461,10 +554,10 @@ async def v1_restaurants_deliverymodes(
     tags=["shopping"],
 )
 async def v1_restaurants_activity_attributes(
-    db: AsyncIOMotorClient = Depends(get_database)
+    if_none_match: str = Header(None),
 ):
-    res = await get_activities(db)
-    return res
+    table = get_snapshot().activities
+    return conditional_response(table.body, if_none_match, catalog_policy, table.etag)
 
 # =============================================================================
 
@@ -477,10 +570,134 @@ async def v1_restaurants_activity_attributes(
 )
 async def v2_menu(
     restaurant_id: int,
+    if_none_match: str = Header(None),
     db: AsyncIOMotorClient = Depends(get_database),
 ):
-    res = await get_menus(db, restaurant_id)
-    return res
+    entry = await get_menu_entry(db, restaurant_id)
+    return conditional_response(entry.body, if_none_match, menu_policy, entry.etag)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# carts
+@v1router.post(
+    "/carts/checkout",
+    tags=["carts"],
+)
+async def v1_carts_checkout(
+    cart: CartInCheckout = Body(..., embed=False),
+    user: RWUser = Depends(get_current_user_authorizer(required=False)),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    res = await checkout(db, cart, user.username if user else None)
+    return JSONBytesResponse(res)
+
+
+@v1router.post(
+    "/users/{user_id}/carts/{cart_id}/orders",
+    tags=["carts"],
+)
+async def v1_users_carts_orders(
+    cart_id: str,
+    order: OrderInCreate = Body(..., embed=False),
+    user_id: int = Depends(authorize_user_id),
+    user: RWUser = Depends(get_current_user_authorizer()),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    # 只能用本人结算的购物车下单
+    return await place_order(db, user_id, cart_id, order, user.username)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# addresses
+@v1router.get(
+    "/users/{user_id}/addresses",
+    tags=["addresses"],
+)
+async def v1_users_addresses(
+    user_id: int = Depends(authorize_user_id),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    res = await get_addresses(db, user_id)
+    return JSONBytesResponse(res)
+
+
+@v1router.post(
+    "/users/{user_id}/addresses",
+    tags=["addresses"],
+)
+async def v1_users_addresses_add(
+    address: AddressInCreate = Body(..., embed=False),
+    user_id: int = Depends(authorize_user_id),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    res = await add_address(db, user_id, address)
+    return JSONBytesResponse({"status": 1, "success": "添加地址成功", "address": res})
+
+
+@v1router.delete(
+    "/users/{user_id}/addresses/{address_id}",
+    tags=["addresses"],
+)
+async def v1_users_addresses_delete(
+    address_id: int,
+    user_id: int = Depends(authorize_user_id),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    await delete_address(db, user_id, address_id)
+    return {"status": 1, "success": "删除地址成功"}
+
+
+@v1router.get(
+    "/carts/{cart_id}/addresses",
+    tags=["addresses"],
+)
+async def v1_carts_addresses(
+    cart_id: str,
+    sig: str = "",
+    user_id: int = Depends(get_current_user_id),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    # 当前登录用户的地址中，只返回餐馆能配送到的，由近到远，前端默认选第一个
+    latitude, longitude = await get_cart_location(db, cart_id, sig)
+    res = await get_deliverable_addresses(db, user_id, latitude, longitude)
+    return JSONBytesResponse(res)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# orders
+@bosrouter.get(
+    "/v2/users/{user_id}/orders",
+    tags=["orders"],
+)
+async def bos_v2_users_orders(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(10, gt=0, le=50),
+    cursor: str = None,
+    user_id: int = Depends(authorize_user_id),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    # 前端按 offset 翻页；带 cursor 时从上一页最后一单之后继续
+    res, next_cursor = await get_orders(db, user_id, offset, limit, cursor)
+    response = JSONBytesResponse(res)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
+
+
+@bosrouter.get(
+    "/v1/users/{user_id}/orders/{order_id}/snapshot",
+    tags=["orders"],
+)
+async def bos_v1_users_orders_snapshot(
+    order_id: str,
+    user_id: int = Depends(authorize_user_id),
+    db: AsyncIOMotorClient = Depends(get_database),
+):
+    res = await get_order_snapshot(db, user_id, order_id)
+    return JSONBytesResponse(res)
 # =============================================================================
 
 
@@ -492,9 +709,14 @@ async def v2_menu(
 )
 async def v2_restaurants_restaurant_id_ratings(
     restaurant_id: int,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(10, gt=0, le=50),
+    tag_name: str = "",
     db: AsyncIOMotorClient = Depends(get_database),
 ):
-    res = await get_restaurant_ratings(db, restaurant_id)
+    res = await get_restaurant_ratings(
+        db, restaurant_id, offset, limit, tag_name
+    )
     return res
 # =============================================================================
 
@@ -526,4 +748,21 @@ async def v2_restaurants_restaurant_id_ratings_tags(
 ):
     res = await get_restaurant_ratings_tags(db, restaurant_id)
     return res
-# =============================================================================
\ No newline at end of file
+# =============================================================================
+
+# -----------------------------------------------------------------------------
+# metrics
+@v1router.get(
+    "/metrics/snapshot",
+    tags=["metrics"],
+)
+async def v1_metrics_snapshot():
+    snapshot = get_snapshot()
+    return {
+        "age": snapshot_age(),
+        "entries": len(snapshot.entries.rows),
+        "categories": len(snapshot.categories.rows),
+        "deliveries": len(snapshot.deliveries.rows),
+        "activities": len(snapshot.activities.rows),
+    }
+# =============================================================================
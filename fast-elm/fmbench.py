@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+
+from collections import defaultdict
+
+# -----------------------------------------------------------------------------
+# bench config
+BENCH_REQUESTS = int(os.getenv("BENCH_REQUESTS", 2000))        # 每轮请求总数
+BENCH_CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", 20))    # 并发数
+BENCH_SHOPS = int(os.getenv("BENCH_SHOPS", 200))               # 生成的餐馆数
+BENCH_SEED = int(os.getenv("BENCH_SEED", 2020))                # 随机种子
+BENCH_ALLOC_SAMPLES = int(os.getenv("BENCH_ALLOC_SAMPLES", 5))  # 每个接口统计内存的请求数
+BENCH_BASELINE = os.getenv("BENCH_BASELINE", "fmbench.json")
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", 0.2))     # p95 允许变慢的比例
+
+BENCH_LATITUDE = 39.9288      # 东城区，fmgen 生成的餐馆集中在北京城区
+BENCH_LONGITUDE = 116.4164
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "bench-password"
+BENCH_CAPTCHA = "bench"
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# mock mongo
+# 用 mongomock 模拟 motor 的异步接口，不需要本地 mongod
+# 不支持的功能（change stream、2dsphere）由各模块自行降级
+class MockCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def skip(self, n):
+        self.cursor = self.cursor.skip(n)
+        return self
+
+    def limit(self, n):
+        self.cursor = self.cursor.limit(n)
+        return self
+
+    def __aiter__(self):
+        self.iter = iter(self.cursor)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        return list(self.cursor)[:length] if length else list(self.cursor)
+
+
+class MockCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, *args, **kwargs):
+        return MockCursor(self.collection.find(*args, **kwargs))
+
+    def aggregate(self, *args, **kwargs):
+        return MockCursor(self.collection.aggregate(*args, **kwargs))
+
+    def list_indexes(self):
+        # 与 mongod 一致，key 为 {字段: 方向}
+        return MockCursor(iter([
+            dict(index, key=dict(index["key"]))
+            for index in self.collection.index_information().values()
+        ]))
+
+    def watch(self, *args, **kwargs):
+        from pymongo.errors import OperationFailure
+        raise OperationFailure("mock: change streams are not supported")
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+
+class MockDatabase:
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, name):
+        return MockCollection(self.database[name])
+
+    def watch(self, *args, **kwargs):
+        from pymongo.errors import OperationFailure
+        raise OperationFailure("mock: change streams are not supported")
+
+
+class MockSession:
+    # 注册、登录建用户时的 session/事务，mongomock 没有事务，直接执行
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def start_transaction(self):
+        return self
+
+
+class MockClient:
+    def __init__(self):
+        import mongomock
+
+        self.client = mongomock.MongoClient()
+
+    def __getitem__(self, name):
+        return MockDatabase(self.client[name])
+
+    async def start_session(self):
+        return MockSession()
+
+    def close(self):
+        self.client.close()
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# seed
+async def seed_user(conn):
+    from fmmodel import RWUserInCreate
+    from fmcrud import create_user, get_user_by_email
+
+    if not await get_user_by_email(conn, BENCH_EMAIL):
+        await create_user(conn, RWUserInCreate(
+            email=BENCH_EMAIL, password=BENCH_PASSWORD, vcode="", username="bench"
+        ))
+
+
+async def seed_captchas(conn, calls: list):
+    # 验证码只能用一次，按调用列表给每个登录请求写入答案
+    # 随机种子固定时每次运行的 id 相同，先删掉上次没用完的再写入
+    from datetime import datetime, timedelta
+    from fmdb import db_name, captchas_collection_name
+
+    expire_at = datetime.utcnow() + timedelta(days=1)
+    docs = [
+        {
+            "_id": kwargs["headers"]["Cookie"][len("cap="):],
+            "answer": BENCH_CAPTCHA,
+            "expire_at": expire_at,
+        }
+        for name, _, _, kwargs in calls if name == "login"
+    ]
+    if docs:
+        collection = conn[db_name][captchas_collection_name]
+        await collection.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}})
+        await collection.insert_many(docs)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# call mix
+def login_kwargs(captcha_id: str) -> dict:
+    # POST /v1/captchas 的响应会把验证码池里的 cap cookie 存进共享的 client，
+    # 登录请求用显式的 Cookie 头，不受其中的 cookie 影响
+    return dict(
+        json={"email": BENCH_EMAIL, "password": BENCH_PASSWORD, "vcode": BENCH_CAPTCHA},
+        headers={"Cookie": f"cap={captcha_id}"},
+    )
+
+
+# 按 vue2-elm src/service/getData.js 中首页、商家页、评价页、登录的调用比例
+def call_mix(rng: random.Random, shops: int, count: int) -> list:
+    latlng = {"latitude": BENCH_LATITUDE, "longitude": BENCH_LONGITUDE}
+    geohash = f"{BENCH_LATITUDE},{BENCH_LONGITUDE}"
+
+    def shop_id():
+        # 热门商家访问更多
+        return min(int(rng.paretovariate(1.2)), shops)
+
+    calls = [
+        (20, "restaurants", lambda: ("GET", "/shopping/restaurants", dict(params=dict(
+            latlng, offset=rng.choice([0, 0, 0, 20, 40]), limit=20,
+            **{"extras[]": "activities", "restaurant_category_ids[]": rng.choice(["", "209", "220"])}
+        )))),
+        (15, "menu", lambda: ("GET", "/shopping/v2/menu", dict(
+            params={"restaurant_id": shop_id()}
+        ))),
+        (6, "ratings", lambda: ("GET", f"/ugc/v2/restaurants/{shop_id()}/ratings", dict(
+            params={"offset": 0, "limit": 10, "tag_name": rng.choice(["", "全部", "味道好"])}
+        ))),
+        (6, "ratings_scores", lambda: (
+            "GET", f"/ugc/v2/restaurants/{shop_id()}/ratings/scores", {}
+        )),
+        (6, "ratings_tags", lambda: (
+            "GET", f"/ugc/v2/restaurants/{shop_id()}/ratings/tags", {}
+        )),
+        (4, "cities_hot", lambda: ("GET", "/v1/cities", dict(params={"type": "hot"}))),
+        (2, "cities_group", lambda: ("GET", "/v1/cities", dict(params={"type": "group"}))),
+        (2, "cities_guess", lambda: ("GET", "/v1/cities", dict(params={"type": "guess"}))),
+        (2, "city", lambda: ("GET", "/v1/cities/1", {})),
+        (8, "index_entry", lambda: ("GET", "/v2/index_entry", dict(
+            params={"geohash": geohash}
+        ))),
+        (3, "category", lambda: ("GET", "/shopping/v2/restaurant/category/", dict(params=latlng))),
+        (3, "delivery_modes", lambda: (
+            "GET", "/shopping/v1/restaurants/delivery_modes", dict(params=latlng)
+        )),
+        (3, "activity_attributes", lambda: (
+            "GET", "/shopping/v1/restaurants/activity_attributes", dict(params=latlng)
+        )),
+        (5, "search", lambda: ("GET", "/v4/restaurants", dict(
+            params={"geohash": geohash, "keyword": rng.choice(["黄焖鸡", "牛肉", "xiao long", "mlxg"])}
+        ))),
+        (1, "captcha", lambda: ("POST", "/v1/captchas", {})),
+        (1, "login", lambda: ("POST", "/v1/users/login", login_kwargs(
+            f"bench-{rng.getrandbits(64):x}"
+        ))),
+    ]
+    weights = [weight for weight, _, _ in calls]
+    res = []
+    for weight, name, make in rng.choices(calls, weights=weights, k=count):
+        res.append((name,) + make())
+    return res
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# runner
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def is_error(name: str, res) -> bool:
+    # 接口出错时有的返回 4xx/5xx，有的返回 200 和 {"status": 0, "type": "ERROR_..."}
+    if res.status_code >= 400:
+        return True
+    try:
+        body = res.json()
+    except ValueError:
+        return False
+    if not isinstance(body, dict):
+        return False
+    if body.get("status") == 0 or str(body.get("type", "")).startswith("ERROR"):
+        return True
+    # 登录必须真正拿到 token
+    return name == "login" and not (body.get("user") or {}).get("token")
+
+
+async def run_calls(client, calls: list, concurrency: int):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    pending = iter(calls)
+
+    async def worker():
+        for name, method, url, kwargs in pending:
+            start = time.perf_counter()
+            res = await client.request(method, url, **kwargs)
+            latencies[name].append((time.perf_counter() - start) * 1000)
+            if is_error(name, res):
+                errors[name] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - start
+
+
+async def measure_allocations(client, calls: list, samples: int) -> dict:
+    # 顺序执行，每个请求单独统计 tracemalloc 峰值
+    peaks = defaultdict(list)
+    for name, method, url, kwargs in calls:
+        if len(peaks[name]) >= samples:
+            continue
+        tracemalloc.start()
+        await client.request(method, url, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks[name].append(peak / 1024)
+    return {name: sum(values) / len(values) for name, values in peaks.items()}
+
+
+def summarize(latencies: dict, errors: dict, elapsed: float, allocations: dict) -> dict:
+    res = {}
+    for name, values in sorted(latencies.items()):
+        res[name] = {
+            "count": len(values),
+            "errors": errors.get(name, 0),
+            "rps": round(len(values) / elapsed, 1),
+            "p50": round(percentile(values, 50), 2),
+            "p95": round(percentile(values, 95), 2),
+            "p99": round(percentile(values, 99), 2),
+            "alloc_kib": round(allocations.get(name, 0), 1),
+        }
+    total = sum(len(values) for values in latencies.values())
+    res["_total"] = {"count": total, "rps": round(total / elapsed, 1)}
+    return res
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# report & baseline
+def report(result: dict, baseline: dict):
+    print(
+        f"{'endpoint':<22}{'count':>7}{'err':>5}{'rps':>9}{'p50':>9}{'p95':>9}"
+        f"{'p99':>9}{'KiB':>9}{'p95 vs base':>13}"
+    )
+    for name, row in result.items():
+        if name.startswith("_"):
+            continue
+        base = baseline.get(name, {}).get("p95")
+        delta = f"{(row['p95'] - base) / base:+.0%}" if base else "-"
+        print(
+            f"{name:<22}{row['count']:>7}{row['errors']:>5}{row['rps']:>9}"
+            f"{row['p50']:>9}{row['p95']:>9}{row['p99']:>9}{row['alloc_kib']:>9}"
+            f"{delta:>13}"
+        )
+    print(f"total {result['_total']['count']} requests, {result['_total']['rps']} req/s")
+
+
+def find_regressions(result: dict, baseline: dict, tolerance: float) -> list:
+    res = []
+    for name, row in result.items():
+        base = baseline.get(name, {}).get("p95")
+        if not name.startswith("_") and base and row["p95"] > base * (1 + tolerance):
+            res.append(name)
+    return res
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# cli
+# python fmbench.py --mock                  进程内 mongomock，自动生成数据
+# python fmbench.py --seed                  本地 mongod（MONGO_DB 需单独建库），清空后用 fmgen 写入数据
+# python fmbench.py --mock --save           把本次结果保存为基线
+async def main(args) -> int:
+    import httpx
+
+    import fm
+    from fmdb import db, db_name, connect_to_mongo, create_indexes
+    from fmgen import generate, generated_collections
+
+    startup = list(fm.app.router.lifespan.startup_handlers)
+    if args.mock:
+        db.client = MockClient()
+        # mongomock 不支持 2dsphere 等索引，跳过建索引
+        startup = [h for h in startup if h not in (connect_to_mongo, create_indexes)]
+    else:
+        await connect_to_mongo()
+        startup = [h for h in startup if h is not connect_to_mongo]
+
+    if args.mock or args.seed:
+        if args.seed:
+            # 重复运行时先清掉上次生成的数据，否则会与 shops.id 等唯一索引冲突
+            # 索引由下面的 create_indexes 重新建立
+            for name in generated_collections:
+                await db.client[db_name][name].drop()
+        await generate(db.client[db_name], args.shops, args.random_seed)
+        await seed_user(db.client)
+
+    for handler in startup:
+        await handler()
+
+    rng = random.Random(args.random_seed)
+    calls = call_mix(rng, args.shops, args.requests)
+    warmup = call_mix(rng, args.shops, 200)
+    await seed_captchas(db.client, warmup + calls)
+    try:
+        async with httpx.AsyncClient(app=fm.app, base_url="http://fmbench") as client:
+            # 预热一遍，缓存和索引进入稳定状态后再计时
+            await run_calls(client, warmup, args.concurrency)
+            latencies, errors, elapsed = await run_calls(client, calls, args.concurrency)
+            # 计时那轮已用掉登录验证码，统计内存前重新写入
+            await seed_captchas(db.client, calls)
+            allocations = await measure_allocations(client, calls, BENCH_ALLOC_SAMPLES)
+    finally:
+        for handler in fm.app.router.lifespan.shutdown_handlers:
+            await handler()
+
+    result = summarize(latencies, errors, elapsed, allocations)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    regressions = find_regressions(result, baseline, args.tolerance)
+    for name in regressions:
+        print(f"regression: {name} p95 {result[name]['p95']}ms > baseline {baseline[name]['p95']}ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fm 接口压测")
+    parser.add_argument("--mock", action="store_true", help="使用进程内 mongomock")
+    parser.add_argument("--seed", action="store_true", help="向 MONGO_DB 写入测试数据")
+    parser.add_argument("--save", action="store_true", help="保存结果为基线")
+    parser.add_argument("--requests", type=int, default=BENCH_REQUESTS)
+    parser.add_argument("--concurrency", type=int, default=BENCH_CONCURRENCY)
+    parser.add_argument("--shops", type=int, default=BENCH_SHOPS)
+    parser.add_argument("--random-seed", type=int, default=BENCH_SEED)
+    parser.add_argument("--baseline", default=BENCH_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(parser.parse_args())))
+# =============================================================================
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# cache config
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", 10000))            # 进程内缓存条目上限
+CACHE_TTL = float(os.getenv("CACHE_TTL", 300))              # 缺省过期秒数
+CACHE_NEGATIVE_TTL = float(os.getenv("CACHE_NEGATIVE_TTL", 30))  # 失败结果缓存秒数
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "")          # 共享缓存, 为空则不启用
+# =============================================================================
+
+
+_missing = object()
+
+
+# -----------------------------------------------------------------------------
+# local tier
+class TTLCache:
+    # 进程内 LRU + TTL，只在事件循环线程内使用，无需加锁
+    def __init__(self, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self.data.get(key, _missing)
+        if item is _missing:
+            return default
+        value, expire = item
+        if expire < time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        expire = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self.data[key] = (value, expire)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, _missing)
+        return default if item is _missing else item[0]
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# shared tier
+class RedisTier:
+    # redis-py 是同步客户端，放到线程池执行，避免阻塞事件循环
+    def __init__(self, url: str, prefix: str = "fm:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key):
+        loop = asyncio.get_event_loop()
+        raw = await loop.run_in_executor(None, self.client.get, self.prefix + key)
+        if raw is None:
+            return _missing
+        return json.loads(raw)
+
+    async def set(self, key, value, ttl: float):
+        loop = asyncio.get_event_loop()
+        raw = json.dumps(value, ensure_ascii=False)
+        await loop.run_in_executor(
+            None, self.client.set, self.prefix + key, raw, None, int(ttl * 1000)
+        )
+
+
+class SharedTier:
+    tier: RedisTier = None
+
+
+shared = SharedTier()
+
+
+def get_shared_tier():
+    if CACHE_REDIS_URL and not shared.tier:
+        shared.tier = RedisTier(CACHE_REDIS_URL)
+    return shared.tier
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# tiered cache
+class NegativeResult:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class TieredCache:
+    # 本地 LRU+TTL -> 共享缓存 -> loader
+    # 同一个 key 的并发请求只会触发一次 loader 调用
+    # negative 中的异常会被缓存 negative_ttl 秒，期间直接重新抛出
+    def __init__(
+        self,
+        name: str,
+        maxsize: int = CACHE_SIZE,
+        ttl: float = CACHE_TTL,
+        negative_ttl: float = CACHE_NEGATIVE_TTL,
+        negative: tuple = (),
+        shared=None,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.negative = negative
+        self.local = TTLCache(maxsize, ttl)
+        self.shared = shared
+        self.inflight = {}
+
+    async def get_or_load(self, key: str, loader):
+        value = self.local.get(key, _missing)
+        if value is _missing:
+            future = self.inflight.get(key)
+            if future is None:
+                value = await self._load(key, loader)
+            else:
+                value = await asyncio.shield(future)
+
+        if isinstance(value, NegativeResult):
+            raise value.error
+        return value
+
+    async def _load(self, key: str, loader):
+        future = asyncio.get_event_loop().create_future()
+        self.inflight[key] = future
+        try:
+            value = await self._load_shared(key)
+            if value is _missing:
+                try:
+                    value = await loader()
+                except self.negative as e:
+                    value = NegativeResult(e)
+                    self.local.set(key, value, self.negative_ttl)
+                else:
+                    self.local.set(key, value)
+                    await self._store_shared(key, value)
+            else:
+                self.local.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self.inflight.pop(key, None)
+
+    async def _load_shared(self, key: str):
+        if not self.shared:
+            return _missing
+        try:
+            return await self.shared.get(f"{self.name}:{key}")
+        except Exception as e:
+            logger.warning("共享缓存读取失败 %s:%s %r", self.name, key, e)
+            return _missing
+
+    async def _store_shared(self, key: str, value):
+        if not self.shared:
+            return
+        try:
+            await self.shared.set(f"{self.name}:{key}", value, self.ttl)
+        except Exception as e:
+            logger.warning("共享缓存写入失败 %s:%s %r", self.name, key, e)
+
+    def invalidate(self, key: str):
+        self.local.pop(key)
+
+    def clear(self):
+        self.local.clear()
+# =============================================================================
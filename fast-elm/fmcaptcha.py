@@ -0,0 +1,170 @@
+import io
+import os
+import time
+import base64
+import random
+import asyncio
+import secrets
+import logging
+
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+from fmdb import db, db_name, captchas_collection_name, query_shape
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# captcha config
+CAPTCHA_POOL_SIZE = int(os.getenv("CAPTCHA_POOL_SIZE", 500))       # 预先生成的验证码数
+CAPTCHA_BATCH = int(os.getenv("CAPTCHA_BATCH", 50))                # 每次生成并写库的数量
+CAPTCHA_TTL = float(os.getenv("CAPTCHA_TTL", 300))                 # 发放后至少有效的秒数
+CAPTCHA_POOL_MAX_AGE = float(os.getenv("CAPTCHA_POOL_MAX_AGE", 600))   # 池中最长保留秒数
+CAPTCHA_FONT = os.getenv("CAPTCHA_FONT", "DejaVuSans.ttf")         # 找不到时用 Pillow 自带字体
+CAPTCHA_LENGTH = 4
+CAPTCHA_CHARS = "23456789abcdefghjkmnpqrstuvwxyz"                  # 去掉易混的 0 1 i l o
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# render
+# Pillow 绘图占用 cpu，只在 captcha 线程中执行，不阻塞事件循环
+def load_font():
+    try:
+        return ImageFont.truetype(CAPTCHA_FONT, 28)
+    except OSError:
+        logger.warning("验证码字体 %s 不存在，使用默认字体", CAPTCHA_FONT)
+        return ImageFont.load_default()
+
+
+def render_captcha(text: str, font, rng: random.Random) -> str:
+    # 返回 data:image/png;base64,... ，前端直接作为 img src
+    image = Image.new("RGB", (100, 40), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    for n, char in enumerate(text):
+        color = tuple(rng.randint(0, 150) for _ in range(3))
+        draw.text((8 + n * 22 + rng.randint(-2, 2), rng.randint(0, 6)), char, fill=color, font=font)
+    for _ in range(4):
+        points = [(rng.randint(0, 100), rng.randint(0, 40)) for _ in range(2)]
+        draw.line(points, fill=tuple(rng.randint(100, 220) for _ in range(3)), width=1)
+    for _ in range(120):
+        draw.point((rng.randint(0, 99), rng.randint(0, 39)), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def render_batch(count: int) -> list:
+    # [(答案, 图片)]
+    if captchas.font is None:
+        captchas.font = load_font()
+    rng = random.Random(secrets.randbits(64))
+    res = []
+    for _ in range(count):
+        text = "".join(secrets.choice(CAPTCHA_CHARS) for _ in range(CAPTCHA_LENGTH))
+        res.append((text, render_captcha(text, captchas.font, rng)))
+    return res
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# pool
+# 后台任务预先生成图片，答案同时写入 captchas 集合，发放时从池中取出不再访问数据库
+# 客户端 cookie 中只有验证码 id，答案只保存在服务端，校验一次后删除
+# 写库时的过期时间留出池中保留的时间，发放后至少还有 CAPTCHA_TTL 秒有效
+class CaptchaPool:
+    items: deque = None             # (id, 图片, 生成时间)，左边最旧
+    refill: asyncio.Event = None
+    task: asyncio.Task = None
+    executor: ThreadPoolExecutor = None
+    font = None
+
+
+captchas = CaptchaPool()
+
+
+async def render_and_store(conn, count: int) -> list:
+    if not captchas.executor:
+        captchas.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="captcha")
+    loop = asyncio.get_event_loop()
+    batch = await loop.run_in_executor(captchas.executor, render_batch, count)
+
+    now = datetime.utcnow()
+    expire_at = now + timedelta(seconds=CAPTCHA_POOL_MAX_AGE + CAPTCHA_TTL)
+    docs = [
+        {"_id": secrets.token_urlsafe(16), "answer": text, "expire_at": expire_at}
+        for text, _ in batch
+    ]
+    await conn[db_name][captchas_collection_name].insert_many(docs)
+    created = time.monotonic()
+    return [(doc["_id"], code, created) for doc, (_, code) in zip(docs, batch)]
+
+
+def drop_stale():
+    deadline = time.monotonic() - CAPTCHA_POOL_MAX_AGE
+    while captchas.items and captchas.items[0][2] < deadline:
+        captchas.items.popleft()
+
+
+async def fill_pool(conn):
+    drop_stale()
+    while len(captchas.items) < CAPTCHA_POOL_SIZE:
+        count = min(CAPTCHA_BATCH, CAPTCHA_POOL_SIZE - len(captchas.items))
+        captchas.items.extend(await render_and_store(conn, count))
+
+
+async def keep_pool_filled():
+    while True:
+        try:
+            await fill_pool(db.client)
+        except Exception as e:
+            logger.warning("验证码生成失败: %r", e)
+        # 池子用掉一半或最旧的图片过期前再补充
+        try:
+            await asyncio.wait_for(captchas.refill.wait(), CAPTCHA_POOL_MAX_AGE / 2)
+        except asyncio.TimeoutError:
+            pass
+        captchas.refill.clear()
+
+
+async def issue_captcha(conn) -> tuple:
+    # 返回 (id, 图片)；池子空了（启动中或突发流量）时在 captcha 线程中现做一个
+    drop_stale()
+    if captchas.items:
+        captcha_id, code, _ = captchas.items.popleft()
+    else:
+        captcha_id, code, _ = (await render_and_store(conn, 1))[0]
+    if captchas.refill and len(captchas.items) < CAPTCHA_POOL_SIZE // 2:
+        captchas.refill.set()
+    return captcha_id, code
+
+
+query_shape(captchas_collection_name, "_id")
+async def check_captcha(conn, captcha_id: str, answer: str) -> bool:
+    # 返回 None 表示验证码不存在或已过期；无论对错验证码都只能用一次
+    row = await conn[db_name][captchas_collection_name].find_one_and_delete(
+        {"_id": captcha_id}
+    )
+    if not row or row["expire_at"] < datetime.utcnow():
+        return None
+    return row["answer"] == (answer or "").strip().lower()
+
+
+async def start_captcha_pool():
+    captchas.items = deque()
+    captchas.refill = asyncio.Event()
+    captchas.task = asyncio.ensure_future(keep_pool_filled())
+
+
+async def stop_captcha_pool():
+    if captchas.task:
+        captchas.task.cancel()
+        captchas.task = None
+    if captchas.executor:
+        captchas.executor.shutdown(wait=False)
+        captchas.executor = None
+# =============================================================================
@@ -0,0 +1,359 @@
+import os
+import json
+import secrets
+import logging
+
+from bson import ObjectId
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from starlette.status import (
+    HTTP_404_NOT_FOUND,
+    HTTP_409_CONFLICT,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+)
+
+from fmdb import (
+    query_shape,
+    db_name,
+    restaurants_collection_name,
+    menus_collection_name,
+    carts_collection_name,
+)
+from fmmenu import price_cache
+from fmmodel import CartInCheckout, OrderInCreate
+from fmstock import StockLine, reserve_stock, release_stock, confirm_stock, get_stock_levels
+from fmorder import create_order
+from fmgeo import (
+    SHOP_SEARCH_RADIUS,
+    haversine,
+    format_distance,
+    estimate_lead_time,
+    parse_latlng,
+)
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# cart config
+CART_TTL = float(os.getenv("CART_TTL", 3600))   # 结算后未下单的购物车保留秒数
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# price book
+# 结算只需要店铺的费用字段和每个规格的价格、餐盒费、库存
+# 按餐馆缓存在 fmmenu.price_cache，菜单变化时与菜单缓存一起失效
+shop_fields = (
+    "id", "name", "phone", "image_path", "address", "latitude", "longitude",
+    "status", "delivery_mode", "float_delivery_fee", "float_minimum_order_amount",
+    "piecewise_agent_fee",
+)
+sku_fields = (
+    "sku_id", "item_id", "food_id", "name", "specs", "price", "packing_fee",
+    "stock", "promotion_stock", "sold_out",
+)
+
+
+class SkuPrice:
+    __slots__ = sku_fields
+
+    def __init__(self, spec: dict):
+        for name in sku_fields:
+            setattr(self, name, spec.get(name))
+        self.price = spec.get("price") or 0
+        self.packing_fee = spec.get("packing_fee") or 0
+        self.specs = spec.get("specs") or []
+
+
+def parse_fee_rules(piecewise_agent_fee: dict) -> list:
+    # piecewise_agent_fee.rules 为 JSON 字符串 [{"price": 起步金额, "fee": 配送费}]
+    # 返回按起步金额降序的 [(起步金额, 配送费)]，格式不对时忽略
+    try:
+        rules = json.loads((piecewise_agent_fee or {}).get("rules") or "[]")
+        rules = [(float(rule["price"]), float(rule["fee"])) for rule in rules]
+    except (TypeError, ValueError, KeyError) as e:
+        logger.warning("piecewise_agent_fee.rules 格式错误: %r", e)
+        return []
+    return sorted(rules, reverse=True)
+
+
+class PriceBook:
+    # 一个餐馆的价格表，构建后只读，失效时整体替换
+    def __init__(self, shop: dict, menus: list = ()):
+        self.shop = {name: shop.get(name) for name in shop_fields}
+        self.fee_rules = parse_fee_rules(shop.get("piecewise_agent_fee"))
+        self.skus = {}              # sku_id -> SkuPrice
+        self.items = {}             # item_id -> [SkuPrice]
+        for menu in menus:
+            for food in menu.get("foods") or []:
+                for spec in food.get("specfoods") or []:
+                    sku = SkuPrice(spec)
+                    self.skus[sku.sku_id] = sku
+                    self.items.setdefault(sku.item_id, []).append(sku)
+
+    def find(self, sku_id: int, item_id: int = None) -> SkuPrice:
+        # 旧客户端缓存的 sku_id 可能已变化，商品只有一个规格时按 item_id 匹配
+        sku = self.skus.get(sku_id)
+        if sku is None and item_id is not None:
+            skus = self.items.get(item_id) or []
+            if len(skus) == 1:
+                sku = skus[0]
+        return sku
+
+    def delivery_fee(self, amount: float) -> float:
+        # 满足起步金额的最高一档，没有分档规则时用 float_delivery_fee
+        for price, fee in self.fee_rules:
+            if amount >= price:
+                return fee
+        return self.shop["float_delivery_fee"] or 0
+
+
+query_shape(restaurants_collection_name, "id")
+query_shape(menus_collection_name, "restaurant_id")
+async def load_price_book(conn, restaurant_id: int) -> PriceBook:
+    # 店铺和菜单一次聚合取回，只投影价格相关字段，不传输完整菜单文档
+    projection = {"_id": False}
+    projection.update({name: True for name in shop_fields})
+    projection.update({f"menus.foods.specfoods.{name}": True for name in sku_fields})
+    rows = conn[db_name][restaurants_collection_name].aggregate([
+        {"$match": {"id": restaurant_id}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": menus_collection_name,
+            "localField": "id",
+            "foreignField": "restaurant_id",
+            "as": "menus",
+        }},
+        {"$project": projection},
+    ])
+    async for row in rows:
+        return PriceBook(row, row.pop("menus", []))
+    raise HTTPException(
+        status_code=HTTP_404_NOT_FOUND,
+        detail=f"餐馆 {restaurant_id} 不存在",
+    )
+
+
+async def get_price_book(conn, restaurant_id: int) -> PriceBook:
+    async def load():
+        return await load_price_book(conn, restaurant_id)
+
+    return await price_cache.get_or_load(str(restaurant_id), load)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# checkout
+def cart_error(detail: str):
+    return HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=detail)
+
+
+def price_groups(book: PriceBook, entities: list, stocks: dict = None) -> tuple:
+    # 返回 (groups, 商品金额, 餐盒费)，价格一律取自价格表
+    # stocks 为 fmstock 中的当前库存，用于提前拦截售罄商品，下单时再扣减真实库存
+    # 还没有 stocks 文档的规格没被买过，用菜单中的初始库存
+    stocks = stocks or {}
+    groups = []
+    amount = 0
+    packing_fee = 0
+    for group in entities:
+        items = []
+        for entity in group:
+            if entity.quantity <= 0:
+                raise cart_error(f"商品 {entity.name or entity.sku_id} 数量错误")
+            sku = book.find(entity.sku_id, entity.item_id)
+            if sku is None:
+                raise cart_error(f"商品 {entity.name or entity.sku_id} 已下架")
+            stock = stocks.get(sku.sku_id, sku.stock)
+            if sku.sold_out or (stock is not None and stock < entity.quantity):
+                raise cart_error(f"商品 {sku.name} 库存不足")
+            items.append({
+                "id": sku.food_id,
+                "item_id": sku.item_id,
+                "sku_id": sku.sku_id,
+                "name": sku.name,
+                "specs": entity.specs or [spec["value"] for spec in sku.specs],
+                "attrs": entity.attrs,
+                "extra": entity.extra,
+                "price": sku.price,
+                "packing_fee": sku.packing_fee,
+                "quantity": entity.quantity,
+                "stock": stock,
+            })
+            amount += sku.price * entity.quantity
+            packing_fee += sku.packing_fee * entity.quantity
+        if items:
+            groups.append(items)
+
+    if not groups:
+        raise cart_error("购物车为空")
+    return groups, round(amount, 2), round(packing_fee, 2)
+
+
+async def checkout(conn, cart: CartInCheckout, username: str = None) -> dict:
+    # 价格表命中缓存时，整个结算只有一次按 _id 读库存和一次写入购物车的 mongo 请求
+    book = await get_price_book(conn, cart.restaurant_id)
+    shop = book.shop
+    stocks = await get_stock_levels(conn, {
+        entity.sku_id for group in cart.entities for entity in group
+    })
+    groups, amount, packing_fee = price_groups(book, cart.entities, stocks)
+    deliver_amount = book.delivery_fee(amount)
+
+    meters = None
+    latlng = parse_latlng(cart.geohash)
+    if latlng and shop["latitude"] is not None:
+        meters = haversine(*latlng, shop["latitude"], shop["longitude"])
+
+    now = datetime.utcnow()
+    doc = {
+        "id": str(ObjectId()),
+        "username": username,
+        "restaurant_id": cart.restaurant_id,
+        "geohash": cart.geohash,
+        "come_from": cart.come_from,
+        "groups": groups,
+        "extra": [{
+            "description": "", "name": "餐盒", "price": packing_fee,
+            "quantity": 1, "type": 0,
+        }],
+        "deliver_amount": deliver_amount,
+        "original_total": amount,
+        "total": round(amount + packing_fee + deliver_amount, 2),
+        "restaurant_minimum_order_amount": shop["float_minimum_order_amount"] or 0,
+        "is_address_too_far": meters is not None and meters > SHOP_SEARCH_RADIUS,
+        "dist_info": format_distance(meters) if meters is not None else "",
+        "promise_delivery_time": estimate_lead_time(meters) if meters is not None else "",
+        "is_deliver_by_fengniao": bool(shop["delivery_mode"]),
+        "is_online_paid": 1,
+        "phone": shop["phone"],
+        "restaurant_status": shop["status"],
+        "restaurant_info": shop,
+        "sig": secrets.token_hex(8),      # 下单时校验，防止跨购物车提交
+        "created_at": now,
+        "expire_at": now + timedelta(seconds=CART_TTL),
+    }
+    await conn[db_name][carts_collection_name].insert_one(doc)
+    doc.pop("_id", None)
+    logger.debug("checkout cart %s restaurant %s", doc["id"], cart.restaurant_id)
+
+    return {
+        "id": doc["id"],
+        "cart": doc,
+        "sig": doc["sig"],
+        "invoice": {"is_available": False, "status_text": "商家不支持开发票"},
+        "payments": [{
+            "description": "", "disabled_reason": "", "id": 1,
+            "is_online_payment": True, "name": "在线支付", "select_state": 1,
+        }],
+        "current_address": {},
+        "deliver_times": [],
+        "deliver_times_v2": [],
+        "merchant_coupon_info": {},
+        "number_of_meals": {},
+        "discount_rule": {},
+        "hongbao_info": {},
+        "is_support_coupon": False,
+        "is_support_ninja": 1,
+    }
+
+
+query_shape(carts_collection_name, "id")
+async def get_cart_location(conn, cart_id: str, sig: str) -> tuple:
+    # 购物车对应餐馆的 (纬度, 经度)
+    cart = await conn[db_name][carts_collection_name].find_one(
+        {"id": cart_id, "sig": sig},
+        projection={
+            "_id": False,
+            "restaurant_info.latitude": True,
+            "restaurant_info.longitude": True,
+        },
+    )
+    if not cart:
+        raise HTTPException(
+            status_code=HTTP_404_NOT_FOUND,
+            detail="购物车不存在或已过期",
+        )
+    shop = cart["restaurant_info"]
+    return shop["latitude"], shop["longitude"]
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# orders
+async def release_cart(conn, cart_id: str, order_id: str):
+    await conn[db_name][carts_collection_name].update_one(
+        {"id": cart_id, "order_id": order_id}, {"$unset": {"order_id": ""}}
+    )
+
+
+async def place_order(
+    conn,
+    user_id: int,
+    cart_id: str,
+    order: OrderInCreate,
+    username: str,
+) -> dict:
+    order_id = str(ObjectId())
+    carts = conn[db_name][carts_collection_name]
+    # 原子地占用购物车，同一购物车只能下一次单
+    # sig 不对或不是本人结算的购物车时视为不存在
+    cart = await carts.find_one_and_update(
+        {"id": cart_id, "sig": order.sig, "username": username, "order_id": None},
+        {"$set": {"order_id": order_id}},
+        projection={"_id": False},
+    )
+    if not cart:
+        raise HTTPException(
+            status_code=HTTP_409_CONFLICT,
+            detail="购物车已失效或已下单",
+        )
+
+    try:
+        # 价格表通常在结算时已缓存，这里只用来取 stocks 文档不存在时的初始库存
+        book = await get_price_book(conn, cart["restaurant_id"])
+        lines = []
+        for group in cart["groups"]:
+            for item in group:
+                sku = book.skus.get(item["sku_id"])
+                lines.append(StockLine(
+                    item["sku_id"],
+                    item["quantity"],
+                    cart["restaurant_id"],
+                    sku.stock if sku else 0,
+                    sku.promotion_stock if sku else -1,
+                ))
+        reserved = await reserve_stock(conn, order_id, lines, user_id)
+        if reserved:
+            await create_order(conn, order_id, user_id, cart, order)
+    except Exception:
+        # 出错时归还库存并释放购物车，用户可以重新下单
+        # 归还失败时由 fmstock 的过期清理兜底
+        logger.exception("order %s cart %s 下单失败", order_id, cart_id)
+        try:
+            await release_stock(conn, order_id)
+        finally:
+            await release_cart(conn, cart_id, order_id)
+        raise
+
+    if not reserved:
+        await release_cart(conn, cart_id, order_id)
+        raise cart_error("商品库存不足")
+
+    # 目前没有支付步骤，订单写入即确认扣减；以后接入支付时移到支付成功的回调
+    # 确认失败时订单照常返回，预留到期后由过期清理归还
+    try:
+        if not await confirm_stock(conn, order_id):
+            logger.warning("order %s 库存预留已过期，未能确认", order_id)
+    except Exception:
+        logger.exception("order %s 库存预留确认失败", order_id)
+
+    logger.debug("order %s cart %s user %s", order_id, cart_id, user_id)
+    return {
+        "status": 1,
+        "success": "下单成功，请及时付款",
+        "need_validation": False,
+        "order_id": order_id,
+    }
+# =============================================================================
@@ -0,0 +1,131 @@
+import os
+import json
+import asyncio
+import logging
+
+from types import MappingProxyType
+
+from pymongo.errors import PyMongoError
+
+from fmdb import db, db_name, cities_collection_name
+from fmresponse import make_etag
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# city index config
+# 不支持 change stream（单机 mongo）时，比较城市数据内容的间隔秒数
+CITY_REFRESH_INTERVAL = float(os.getenv("CITY_REFRESH_INTERVAL", 60))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# city index
+def dump_json(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class CityIndex:
+    # 城市数据基本不变，启动时整体加载，之后只读
+    # 更新时构造新的 CityIndex 整体替换，不修改已有对象
+    def __init__(self, doc: dict = None):
+        doc = doc or {}
+        data = dict(doc.get("data") or {})
+        data.pop("_id", None)
+        hot = data.pop("hotCities", [])
+
+        self.version = city_version(doc)
+
+        by_id = {}
+        by_pinyin = {}
+        for letter, group in data.items():
+            for city in group:
+                by_id[city["id"]] = city
+                by_pinyin[city["pinyin"]] = city
+        for city in hot:
+            by_id.setdefault(city["id"], city)
+            by_pinyin.setdefault(city["pinyin"], city)
+
+        self.by_id = MappingProxyType(by_id)
+        self.by_pinyin = MappingProxyType(by_pinyin)
+        self.by_letter = MappingProxyType(
+            {letter: tuple(group) for letter, group in data.items()}
+        )
+        self.hot = tuple(hot)
+
+        # hot 与 group 响应体只序列化一次
+        self.hot_bytes = dump_json(hot)
+        self.group_bytes = dump_json(data)
+        self.hot_etag = make_etag(self.hot_bytes)
+        self.group_etag = make_etag(self.group_bytes)
+
+
+def city_version(doc: dict):
+    # 按内容计算版本，不依赖写入方维护版本字段
+    if not doc:
+        return None
+    data = dict(doc.get("data") or {})
+    data.pop("_id", None)
+    return make_etag(dump_json(data))
+
+
+class CityIndexHolder:
+    index: CityIndex = CityIndex()
+    task: asyncio.Task = None
+
+
+cities = CityIndexHolder()
+
+
+def get_city_index() -> CityIndex:
+    return cities.index
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# load & refresh
+async def load_city_index() -> CityIndex:
+    doc = await db.client[db_name][cities_collection_name].find_one()
+    cities.index = CityIndex(doc)
+    logger.info("城市索引加载完成: %s 个城市", len(cities.index.by_id))
+    return cities.index
+
+
+async def watch_cities():
+    collection = db.client[db_name][cities_collection_name]
+    try:
+        async with collection.watch() as stream:
+            logger.info("城市索引: 使用 change stream 刷新")
+            async for change in stream:
+                try:
+                    await load_city_index()
+                except Exception as e:
+                    logger.warning("城市索引刷新失败: %r", e)
+    except PyMongoError as e:
+        logger.info("城市索引: change stream 不可用 (%r)，改为定时比较内容", e)
+        await refresh_city_index()
+
+
+async def refresh_city_index():
+    # 城市数据只有一个文档，每次取回按内容比较，变化时才重建索引
+    while True:
+        await asyncio.sleep(CITY_REFRESH_INTERVAL)
+        try:
+            doc = await db.client[db_name][cities_collection_name].find_one()
+            if city_version(doc) != cities.index.version:
+                cities.index = CityIndex(doc)
+                logger.info("城市索引已更新: %s 个城市", len(cities.index.by_id))
+        except Exception as e:
+            logger.warning("城市索引刷新失败: %r", e)
+
+
+async def start_city_index():
+    await load_city_index()
+    cities.task = asyncio.ensure_future(watch_cities())
+
+
+async def stop_city_index():
+    if cities.task:
+        cities.task.cancel()
+        cities.task = None
+# =============================================================================
@@ -1,8 +1,14 @@
+import os
 import json
-import requests
+import base64
+import logging
+import ipaddress
 
 from bson import ObjectId
-from datetime import datetime
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from bson.errors import InvalidId
+from datetime import datetime, timedelta
 from typing import Optional, List
 
 from slugify import slugify
@@ -10,9 +16,38 @@ from pydantic import EmailStr
 from fastapi import HTTPException
 from motor.motor_asyncio import AsyncIOMotorClient
 
-from fmtoken import get_user
+from fmtoken import get_user, get_user_id, invalidate_user
+
+from fmsecurity import verify_and_update_password
+
+from fmhttp import (
+    MAP_API_URL,
+    HttpClientError,
+    get_json,
+    post_json,
+)
+
+from fmcache import TieredCache, get_shared_tier
+
+from fmcity import get_city_index
+
+from fmsnapshot import get_snapshot, get_category_tree
+
+from fmsearch import get_search_index
+
+from fmjson import model_projection, load_row
+
+from fmgeo import (
+    SHOP_SEARCH_RADIUS,
+    haversine,
+    format_distance,
+    estimate_lead_time,
+    geohash_encode,
+    parse_latlng,
+)
 
 from starlette.status import (
+    HTTP_400_BAD_REQUEST,
     HTTP_422_UNPROCESSABLE_ENTITY, 
     HTTP_404_NOT_FOUND
 )
@@ -27,17 +62,21 @@ from fmmodel import (
     ArticleFilterParams,
     CitiesModel,
     EntryModel,
-    UserModel,
     UserInfoModel,
+    ColumnDesc,
     CategoryModel,
     ShopModel,
     DeliveriesModel,
     ActivitiesModel,
     MenusModel,
     RatingsModel,
+    RateModel,
+    ScoresModel,
+    TagsModel,
 )
 
 from fmdb import (
+    query_shape,
     db_name, 
     articles_collection_name, 
     favorites_collection_name, 
@@ -54,9 +93,51 @@ from fmdb import (
     activities_collection_name,
     menus_collection_name,
     ratings_collection_name,
+    ids_collection_name,
 )
 
 
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------------
+# cursor
+# 游标分页: 从上一页最后一条记录 (排序键, id) 之后继续，避免 skip 的 O(offset) 开销
+def encode_cursor(value, last_id) -> str:
+    token = base64.urlsafe_b64encode(json.dumps([value, last_id]).encode())
+    return token.decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        value, last_id = json.loads(
+            base64.urlsafe_b64decode((cursor + padding).encode())
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+    return value, last_id
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# ids
+query_shape(ids_collection_name, "_id")
+async def next_id(conn: AsyncIOMotorClient, name: str) -> int:
+    # 自增整数 id，ids 集合中每种 id 一个计数文档
+    row = await conn[db_name][ids_collection_name].find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return row["seq"]
+# =============================================================================
+
+
 # -----------------------------------------------------------------------------
 # user
 async def check_free_username_and_email(
@@ -100,6 +181,7 @@ async def get_profile_for_user(
     return profile
 
 
+query_shape(followers_collection_name, "follower", "following")
 async def is_following_for_user(
     conn: AsyncIOMotorClient, 
     current_username: str, 
@@ -112,6 +194,7 @@ async def is_following_for_user(
     return count > 0
 
 
+query_shape(users_collection_name, "email")
 async def get_user_by_email(
     conn: AsyncIOMotorClient, 
     email: EmailStr
@@ -126,36 +209,68 @@ async def create_user(
     user: RWUserInCreate
 ) -> RWUserInDB:
     dbuser = RWUserInDB(**user.dict())
-    dbuser.change_password(user.password)
-    print(user)
+    await dbuser.change_password_async(user.password)
+    logger.debug("create user %s", user.username)
     row = await conn[db_name][users_collection_name].insert_one(dbuser.dict())
 
     dbuser.id = row.inserted_id
     dbuser.created_at = ObjectId(dbuser.id ).generation_time
     dbuser.updated_at = ObjectId(dbuser.id ).generation_time
+    await create_user_info(conn, dbuser.username)
+    invalidate_user(dbuser.username)
 
     return dbuser
 
 
 async def create_user_info(
     conn: AsyncIOMotorClient, 
-    user: UserModel,
-    userinfo: UserInfoModel,
-) -> UserInfoModel:
-    print(user)
-    print(userinfo)
-
-    dbuser = UserModel(**user.dict())
-    dbuser.change_password(user.password)
+    username: str,
+    city: str = "",
+) -> int:
+    # 每个用户一条 userinfos，订单、地址等按其中的 user_id 归属
+    # 已存在时返回原有的 user_id；早期注册的用户在登录时补建
+    user_id = await get_user_id(conn, username)
+    if user_id is not None:
+        return user_id
+
+    user_id = await next_id(conn, "user_id")
+    logger.debug("create user info %s %s", username, user_id)
+    dbuserinfo = UserInfoModel(
+        id=user_id,
+        user_id=user_id,
+        username=username,
+        city=city,
+        registe_time=datetime.now().strftime("%Y-%m-%d %H:%M"),
+        column_desc=ColumnDesc(),
+    )
+    try:
+        await conn[db_name][userinfos_collection_name].insert_one(dbuserinfo.dict())
+    except DuplicateKeyError:
+        # 同一用户并发登录时以先写入的为准，userinfos.username 为唯一索引
+        return await get_user_id(conn, username)
+    invalidate_user(username)
 
-    dbuserinfo = UserInfoModel(**userinfo.dict())
-    rowuserinfo = await conn[db_name][userinfos_collection_name].insert_one(dbuserinfo.dict())
-    dbuserinfo.id = rowuserinfo.inserted_id
-    dbuserinfo.user_id = dbuserinfo.id
+    return user_id
 
-    rowuser = await conn[db_name][users_collection_name].insert_one(dbuser.dict())
+query_shape(users_collection_name, "username")
+async def check_user_password(
+    conn: AsyncIOMotorClient,
+    dbuser: RWUserInDB,
+    password: str,
+) -> bool:
+    # 校验在密码线程池中执行；cost 变化时顺便保存新哈希
+    ok, new_hash = await verify_and_update_password(
+        dbuser.salt + password, dbuser.hashed_password
+    )
+    if ok and new_hash:
+        dbuser.hashed_password = new_hash
+        await conn[db_name][users_collection_name].update_one(
+            {"username": dbuser.username},
+            {"$set": {"hashed_password": new_hash}}
+        )
+        invalidate_user(dbuser.username)
+    return ok
 
-    return dbuserinfo
 
 async def update_user(
     conn: AsyncIOMotorClient, 
@@ -169,12 +284,13 @@ async def update_user(
     dbuser.bio = user.bio or dbuser.bio
     dbuser.image = user.image or dbuser.image
     if user.password:
-        dbuser.change_password(user.password)
+        await dbuser.change_password_async(user.password)
 
     updated_at = await conn[db_name][users_collection_name].update_one(
-        {"username": dbuser.username}, 
+        {"username": username}, 
         {'$set': dbuser.dict()}
     )
+    invalidate_user(username, dbuser.username)
     dbuser.updated_at = updated_at
     return dbuser
 # =============================================================================
@@ -182,6 +298,7 @@ async def update_user(
 
 # -----------------------------------------------------------------------------
 # article
+query_shape(articles_collection_name, "slug")
 async def get_article_by_slug(
     conn: AsyncIOMotorClient, slug: str, username: Optional[str] = None
 ) -> ArticleInDB:
@@ -189,21 +306,78 @@ async def get_article_by_slug(
         {"slug": slug}
     )
     if article_doc:
-        article_doc["favorites_count"] = await get_favorites_count_for_article(
-            conn, slug
-        )
-        article_doc["favorited"] = await is_article_favorited_by_user(
-            conn, slug, username
-        )
-        article_doc["author"] = await get_profile_for_user(
-            conn,
-            article_doc["author_id"]
+        articles = await assemble_articles(conn, [article_doc], username)
+        return articles[0]
+
+
+query_shape(favorites_collection_name, "article_id")
+query_shape(favorites_collection_name, "user_id", "article_id")
+query_shape(followers_collection_name, "follower")
+async def assemble_articles(
+    conn: AsyncIOMotorClient,
+    rows: List[dict],
+    username: Optional[str] = None
+) -> List[ArticleInDB]:
+    # 一页文章的作者、收藏数、是否收藏、是否关注用固定次数的 $in 查询取回
+    if not rows:
+        return []
+
+    article_ids = [row["_id"] for row in rows]
+    author_names = list({row["author_id"] for row in rows})
+
+    users = {}
+    user_rows = conn[db_name][users_collection_name].find(
+        {"username": {"$in": author_names + ([username] if username else [])}},
+        projection={"username": True, "bio": True, "image": True}
+    )
+    async for user in user_rows:
+        users[user["username"]] = user
+
+    favorites_count = {}
+    count_rows = conn[db_name][favorites_collection_name].aggregate([
+        {"$match": {"article_id": {"$in": article_ids}}},
+        {"$group": {"_id": "$article_id", "count": {"$sum": 1}}},
+    ])
+    async for row in count_rows:
+        favorites_count[row["_id"]] = row["count"]
+
+    favorited = set()
+    following = set()
+    current_user = users.get(username) if username else None
+    if current_user:
+        favorite_rows = conn[db_name][favorites_collection_name].find(
+            {"user_id": current_user["_id"], "article_id": {"$in": article_ids}},
+            projection={"article_id": True}
         )
+        async for row in favorite_rows:
+            favorited.add(row["article_id"])
 
-        return ArticleInDB(
-            **article_doc,
-            created_at=ObjectId(article_doc["_id"]).generation_time
+        follower_rows = conn[db_name][followers_collection_name].find(
+            {"follower": username, "following": {"$in": author_names}},
+            projection={"following": True}
+        )
+        async for row in follower_rows:
+            following.add(row["following"])
+
+    articles = []
+    for row in rows:
+        author_name = row["author_id"]
+        author = users.get(author_name) or {"username": author_name}
+        fields = dict(row)
+        if not fields.get("created_at"):
+            fields["created_at"] = ObjectId(row["_id"]).generation_time
+        articles.append(
+            ArticleInDB(
+                **fields,
+                author=Profile(
+                    **author,
+                    following=author_name in following
+                ),
+                favorites_count=favorites_count.get(row["_id"], 0),
+                favorited=row["_id"] in favorited,
+            )
         )
+    return articles
 
 
 async def create_article_by_slug(
@@ -213,8 +387,10 @@ async def create_article_by_slug(
     article_doc = article.dict()
     article_doc["slug"] = slug
     article_doc["author_id"] = username
+    article_doc["created_at"] = datetime.utcnow()
     article_doc["updated_at"] = datetime.now()
     await conn[db_name][articles_collection_name].insert_one(article_doc)
+    invalidate_articles_count()
 
     if article.tag_list:
         await create_tags_that_not_exist(conn, article.tag_list)
@@ -222,7 +398,6 @@ async def create_article_by_slug(
     author = await get_profile_for_user(conn, username, "")
     return ArticleInDB(
         **article_doc,
-        created_at=ObjectId(article_doc["_id"]).generation_time,
         author=author,
         favorites_count=1,
         favorited=True,
@@ -270,49 +445,117 @@ async def is_article_favorited_by_user(
         )
 
 
-async def get_articles_with_filters(
+ARTICLES_COUNT_TTL = float(os.getenv("ARTICLES_COUNT_TTL", 30))
+
+# 只缓存按 tag/author 的计数，新建或删除文章时调用 invalidate_articles_count
+# 按收藏过滤的计数随收藏/取消收藏变化，不缓存
+articles_count_cache = TieredCache("articles_count", ttl=ARTICLES_COUNT_TTL)
+
+
+def invalidate_articles_count():
+    articles_count_cache.clear()
+
+# 文章按 (created_at, _id) 倒序，游标中的 created_at 为毫秒时间戳
+article_sort = {"created_at": -1, "_id": -1}
+epoch = datetime(1970, 1, 1)
+
+
+query_shape(favorites_collection_name, "user_id")
+query_shape(articles_collection_name, "created_at", "_id")
+query_shape(articles_collection_name, "tag_list", "created_at", "_id")
+query_shape(articles_collection_name, "author_id", "created_at", "_id")
+async def compile_article_filters(
     conn: AsyncIOMotorClient,
     filters: ArticleFilterParams,
-    username: Optional[str] = None
-) -> List[ArticleInDB]:
-    articles: List[ArticleInDB] = []
-    base_query = {}
-
+):
+    # 返回 (集合名, 聚合管道前缀)
+    match = {}
     if filters.tag:
-        base_query["tag_list"] = f"$all: [\"{filters.tag}\"]"
-
-    if filters.favorited:
-        base_query["slug"] = f"$in: [\"{filters.favorited}\"]"
+        match["tag_list"] = filters.tag
 
     if filters.author:
-        base_query["author"] = f"$in: [\"{filters.author}]\""
+        match["author_id"] = filters.author
+
+    if not filters.favorited:
+        return articles_collection_name, [{"$match": match}]
 
-    rows = conn[db_name][articles_collection_name].find(
-        {"author_id": username},
-        limit=filters.limit,
-        skip=filters.offset
+    # 按收藏过滤: 从该用户的收藏出发，在数据库里关联文章
+    user_doc = await conn[db_name][users_collection_name].find_one(
+        {"username": filters.favorited},
+        projection={"_id": True}
     )
+    return favorites_collection_name, [
+        {"$match": {"user_id": user_doc["_id"] if user_doc else None}},
+        {"$lookup": {
+            "from": articles_collection_name,
+            "localField": "article_id",
+            "foreignField": "_id",
+            "as": "article",
+        }},
+        {"$unwind": "$article"},
+        {"$replaceRoot": {"newRoot": "$article"}},
+        {"$match": match},
+    ]
+
+
+async def count_articles_with_filters(
+    conn: AsyncIOMotorClient,
+    filters: ArticleFilterParams,
+) -> int:
+    async def load():
+        name, pipeline = await compile_article_filters(conn, filters)
+        rows = conn[db_name][name].aggregate(pipeline + [{"$count": "count"}])
+        count = 0
+        async for row in rows:
+            count = row["count"]
+        return count
 
-    async for row in rows:
-        slug = row["slug"]
-        # author = await get_profile_for_user(conn, row["author_id"], username)
-        # tags = await get_tags_for_article(conn, slug)
-        # favorites_count = await get_favorites_count_for_article(conn, slug)
-        # favorited_by_user = await is_article_favorited_by_user(conn, slug, username)
-        author = "author"
-        tags = await get_tags_for_article(conn, slug)
-        favorites_count = 1
-        favorited_by_user = True
-        articles.append(
-            ArticleInDB(
-                **row,
-                author=author,
-                created_at=ObjectId(row["_id"]).generation_time,
-                favorites_count=favorites_count,
-                favorited=favorited_by_user,
+    if filters.favorited:
+        return await load()
+    key = f"{filters.tag}:{filters.author}"
+    return await articles_count_cache.get_or_load(key, load)
+
+
+async def get_articles_with_filters(
+    conn: AsyncIOMotorClient,
+    filters: ArticleFilterParams,
+    username: Optional[str] = None
+):
+    # 返回 (文章列表, 下一页游标)，不足一页时游标为 None
+    name, pipeline = await compile_article_filters(conn, filters)
+
+    if filters.cursor:
+        value, last_id = decode_cursor(filters.cursor)
+        try:
+            created_at = epoch + timedelta(milliseconds=value)
+            last_id = ObjectId(last_id)
+        except (TypeError, OverflowError, InvalidId):
+            raise HTTPException(
+                status_code=HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
             )
-        )
-    return articles
+        pipeline.append({"$match": {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}},
+        ]}})
+
+    pipeline.append({"$sort": article_sort})
+    if filters.offset and not filters.cursor:
+        pipeline.append({"$skip": filters.offset})
+    pipeline.append({"$limit": filters.limit})
+
+    page = []
+    async for row in conn[db_name][name].aggregate(pipeline):
+        page.append(row)
+    articles = await assemble_articles(conn, page, username)
+
+    next_cursor = None
+    if page and len(page) == filters.limit:
+        last = page[-1]
+        milliseconds = (last["created_at"] - epoch) // timedelta(milliseconds=1)
+        next_cursor = encode_cursor(milliseconds, str(last["_id"]))
+
+    return articles, next_cursor
 # =============================================================================
 
 
@@ -358,32 +601,17 @@ async def get_cities_by_key(
     conn: AsyncIOMotorClient,
     key: str
 ):
-    cities = conn['test']['cities'].find()
-    key_cities = None
+    index = get_city_index()
 
     data = None
     if key == 'hot':
-        async for c in cities:
-            data = c['data']['hotCities']
+        data = list(index.hot)
 
     if key == 'group':
-
-        async for c in cities:
-            data = c['data']
-        data.pop('hotCities', None)
-        data.pop('_id', None)
+        data = {k: list(v) for k, v in index.by_letter.items()}
 
     if key == 'guess':
-        name = get_city_name()
-        city = None
-        fw = name[0:1].upper()
-        async for c in cities:
-            data = c['data'][fw]
-
-        for k in data:
-            if k['pinyin'] == name:
-                city = k
-        data = city
+        data = index.by_pinyin.get(get_city_name())
     
     return data
 
@@ -395,26 +623,53 @@ async def get_cities_by_id(
     conn: AsyncIOMotorClient,
     id: int
 ):
-    cities = conn['test']['cities'].find()
-    key_cities = None
-
-    data = None
-    async for c in cities:
-        data = c['data']
-    
-    for d in data:
-        for v in data[d]:
-            if v['id'] == id:
-                key_cities = v
-    
-    data = key_cities
-
-    return data
+    return get_city_index().by_id.get(id)
 # =============================================================================
 
 
 # ----------------------------------------------------------------------------- 
 # pois
+txkey = 'RLHBZ-WMPRP-Q3JDS-V2IQA-JNRFH-EJBHL';
+txkey2 = 'RRXBZ-WC6KF-ZQSJT-N2QU7-T5QIT-6KF5X';
+txkey3 = 'OHTBZ-7IFRG-JG2QF-IHFUK-XTTK6-VXFBN';
+txkey4 = 'Z2BBZ-QBSKJ-DFUFG-FDGT3-4JRYV-JKF5O';
+bdkey = 'fjke3YUipM9N64GdOIh1DNeK2APO2WcT';
+# baidukey2 = 'fjke3YUipM9N64GdOIh1DNeK2APO2WcT';
+
+POIS_CACHE_TTL = float(os.getenv("POIS_CACHE_TTL", 600))
+GEOHASH_PRECISION = int(os.getenv("GEOHASH_PRECISION", 8))   # 8 位约 20 米
+
+# ip 段 -> 城市, (城市, 关键词) -> 地址, geohash -> 逆地址解析
+ip_city_cache = TieredCache(
+    "ipcity", ttl=POIS_CACHE_TTL * 6, negative=(HttpClientError,),
+    shared=get_shared_tier(),
+)
+place_cache = TieredCache(
+    "place", ttl=POIS_CACHE_TTL, negative=(HttpClientError,),
+    shared=get_shared_tier(),
+)
+geocoder_cache = TieredCache(
+    "geocoder", ttl=POIS_CACHE_TTL, negative=(HttpClientError,),
+    shared=get_shared_tier(),
+)
+
+
+def ip_prefix(ip: str) -> str:
+    # 同一网段的用户定位到同一城市: ipv4 取 /24, ipv6 取 /64
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    prefix = 24 if addr.version == 4 else 64
+    return str(ipaddress.ip_network(f"{ip}/{prefix}", strict=False))
+
+
+def check_map_status(data: dict) -> dict:
+    if data.get("status") != 0:
+        raise HttpClientError(f"地图接口错误: {data.get('message')}")
+    return data
+
+
 # 获取定位
 async def get_pois_by_ip(
     conn: AsyncIOMotorClient,
@@ -423,20 +678,25 @@ async def get_pois_by_ip(
     keyword: str,
     ip: str
 ):
-    txkey = 'RLHBZ-WMPRP-Q3JDS-V2IQA-JNRFH-EJBHL';
-    txkey2 = 'RRXBZ-WC6KF-ZQSJT-N2QU7-T5QIT-6KF5X';
-    txkey3 = 'OHTBZ-7IFRG-JG2QF-IHFUK-XTTK6-VXFBN';
-    txkey4 = 'Z2BBZ-QBSKJ-DFUFG-FDGT3-4JRYV-JKF5O';
-    bdkey = 'fjke3YUipM9N64GdOIh1DNeK2APO2WcT';
-    # baidukey2 = 'fjke3YUipM9N64GdOIh1DNeK2APO2WcT';
-
-    posi = await guess_position(ip, txkey)
-
-    city_name = posi["result"]["ad_info"]["city"].replace("市", "")
+    try:
+        city_name = await ip_city_cache.get_or_load(
+            ip_prefix(ip), lambda: guess_city(ip, txkey)
+        )
+        place = await place_cache.get_or_load(
+            f"{city_name}:{keyword or ''}",
+            lambda: search_place(keyword, city_name, txkey, 10)
+        )
+        return place['data']
+    except (HttpClientError, KeyError):
+        return {"msg": "获取定位失败"}
 
-    place = await search_place(keyword, city_name, txkey, 10)
 
-    return place['data']
+async def guess_city(
+    ip: str,
+    txkey: str,
+) -> str:
+    posi = check_map_status(await guess_position(ip, txkey))
+    return posi["result"]["ad_info"]["city"].replace("市", "")
 
 
 async def guess_position(
@@ -446,9 +706,8 @@ async def guess_position(
     # get position
     # demo: http://apis.map.qq.com/ws/location/v1/ip?key=Z2BBZ-QBSKJ-DFUFG-FDGT3-4JRYV-JKF5O&ip=223.20.22.111
     ip = '180.158.102.141'
-    posi_api = "http://apis.map.qq.com/ws/location/v1/ip"
-    res = requests.get(f"{posi_api}?key={txkey}&ip={ip}")
-    posi = res.json()
+    posi_api = f"{MAP_API_URL}/ws/location/v1/ip"
+    posi = await get_json(posi_api, {"key": txkey, "ip": ip})
 
     return posi
     
@@ -462,26 +721,40 @@ async def search_place(
 ):
     # get place
     # demo: http://apis.map.qq.com/ws/place/v1/search?key=Z2BBZ-QBSKJ-DFUFG-FDGT3-4JRYV-JKF5O&boundary=region(%E5%8C%97%E4%BA%AC,0)&keyword=%E6%9C%9D%E9%98%B3
-    place_api = "http://apis.map.qq.com/ws/place/v1/search"
+    place_api = f"{MAP_API_URL}/ws/place/v1/search"
     bd = f"region({cn},0)"
-    res = requests.get(f"{place_api}?key={key}&boundary={bd}&keyword={kw}")
-    place = res.json()
-    return place
+    place = await get_json(
+        place_api,
+        {"key": key, "boundary": bd, "keyword": kw or ""}
+    )
+    return check_map_status(place)
 
 # 搜索经纬度
 async def get_pois_by_latlng(
     location: str,
 ):
-    txkey = 'RLHBZ-WMPRP-Q3JDS-V2IQA-JNRFH-EJBHL';
+    latlng = parse_latlng(location)
+    try:
+        if latlng:
+            return await geocoder_cache.get_or_load(
+                geohash_encode(*latlng, GEOHASH_PRECISION),
+                lambda: geocode_location(location)
+            )
+        return await geocode_location(location)
+    except HttpClientError:
+        return {"msg": "获取定位失败"}
+
+
+async def geocode_location(
+    location: str,
+):
     data = {"key": txkey, "location": location}
     headers = {'Content-Type': 'application/json'}
-    geocoder_api = "http://apis.map.qq.com/ws/geocoder/v1/"
-    res = requests.post(geocoder_api, headers=headers, data=json.dumps(data))
-    data = res.json()
-    if data["status"]==0:
-        return data
-    else:
-        return {"msg": "获取定位失败"}
+    geocoder_api = f"{MAP_API_URL}/ws/geocoder/v1/"
+    data = await post_json(
+        geocoder_api, headers=headers, data=json.dumps(data)
+    )
+    return check_map_status(data)
 # =============================================================================
 
 
@@ -493,30 +766,23 @@ async def get_index_entry(
     flags: str,
     group_type: int,
 ) -> List[EntryModel]:
-    entrys = []
-    # rows = conn[db_name][entry_collection_name].find({}, '-_id')
-    rows = conn[db_name][entries_collection_name].find()
-    print(db_name)
-    print(entries_collection_name)
-    async for row in rows:
-        print(row)
-        entrys.append(EntryModel(**row))
-    return entrys 
+    # 参考数据从内存快照读取，见 fmsnapshot
+    return list(get_snapshot().entries.rows)
 
 # =============================================================================
 
 
 # -----------------------------------------------------------------------------
 # user
+query_shape(userinfos_collection_name, "user_id")
 async def get_userinfos(
     conn: AsyncIOMotorClient,
     user_id: int = None,
 ):
 #    userinfo = await UserInfoModel.findOne({user_id}, '-_id')
-    print('crud 1')
     row = await conn[db_name][userinfos_collection_name].find_one({"user_id": user_id})
     res = UserInfoModel(**row)
-    print(res)
+    logger.debug("userinfo %s", user_id)
     return res
 
 # =============================================================================
@@ -529,38 +795,91 @@ async def get_categories(
     latitude: float = None,
     longitude: float = None,
 ) -> List[CategoryModel]:
-    # userinfo = await UserInfoModel.findOne({user_id}, '-_id')
-    rows= conn[db_name][categories_collection_name].find({})
-    res = []
-    async for row in rows:
-        res.append(CategoryModel(**row))
-    return res 
+    return list(get_snapshot().categories.rows)
 
 async def get_category_by_id(
     conn: AsyncIOMotorClient,
     category_id: int,
-) -> CategoryModel:
-    rows = conn[db_name][categories_collection_name].findOne(
-        {'sub_categories.id': category_id}
-    )
-
-    res = []
-    async for row in rows:
-        res.append(CategoryModel(**row))
-
-    res0 = res[0]
-    categoName = res0["name"]
-    for sub in res0["subcategories"]:
-        if sub["id"] == category_id:
-            categoName += '/' + sub["name"]
-    
-    return categoName
+) -> str:
+    # 子分类 id -> "父/子"，由分类树直接查出，不访问数据库
+    node = get_category_tree().nodes.get(category_id)
+    return node.full_name if node else None
 
 # ============================================================================
 
 
 # -----------------------------------------------------------------------------
 # restaurants
+# 按照起送价，评分，销量等排序: order_by -> (字段, 方向)
+# order_by 2 (配送速度) 和 5 (距离) 由 $geoNear 按距离排序
+restaurant_sorts = {
+    1: ("float_minimum_order_amount", 1),
+    2: ("distance_m", 1),
+    3: ("rating", -1),
+    5: ("distance_m", 1),
+    6: ("recent_order_num", -1),
+}
+
+
+query_shape(restaurants_collection_name, "category")
+query_shape(restaurants_collection_name, "id")
+query_shape(restaurants_collection_name, "delivery_mode.id")
+query_shape(restaurants_collection_name, "supports.id")
+async def get_restaurants_filter(
+    conn: AsyncIOMotorClient,
+    keyword: str = None,
+    delivery_mode: List[int] = [],
+    support_ids: List[int] = [],
+    restaurant_category_ids: List[int] = [],
+    restaurant_category_id: int = None,
+    latitude: float = None,
+    longitude: float = None,
+) -> dict:
+    filter = {}
+    # 父分类展开为全部子分类，按 shops.category 索引一次过滤
+    tree = get_category_tree()
+    categories = tree.full_names(restaurant_category_ids)
+    scoped = False
+    if restaurant_category_id is not None:
+        # 商家列表页的 restaurant_category_id 限定范围，同时选了子分类时取交集
+        scope = tree.full_names([restaurant_category_id])
+        if scope:
+            categories = [name for name in categories if name in scope] if categories else scope
+            scoped = True
+    if len(categories) == 1:
+        filter["category"] = categories[0]
+    elif categories or scoped:
+        filter["category"] = {"$in": categories}
+
+    if keyword:
+        # 关键词由 fmsearch 的内存索引匹配，再按 shops.id 索引过滤，不做 $regex 全表扫描
+        # 有位置时只取搜索半径内的餐馆，避免 $in 过大
+        radius = SHOP_SEARCH_RADIUS if latitude is not None else None
+        hits = get_search_index().search(keyword, latitude, longitude, radius)
+        filter["id"] = {"$in": [shop_id for shop_id, _ in hits]}
+
+    #   查找配送方式
+    if delivery_mode:
+        filter["delivery_mode.id"] = {"$in": list(delivery_mode)}
+
+    # 	//查找活动支持方式
+    filterarr = []
+    for s in support_ids or []:
+        if s != 8:
+            filterarr.append(s)
+        else:
+            filter["is_premium"] = True
+
+    if filterarr:
+        filter["supports.id"] = {"$all": filterarr}
+
+    return filter
+
+
+query_shape(restaurants_collection_name, "location")
+query_shape(restaurants_collection_name, "float_minimum_order_amount", "id")
+query_shape(restaurants_collection_name, "rating", "id")
+query_shape(restaurants_collection_name, "recent_order_num", "id")
 async def get_restaurants(
     conn: AsyncIOMotorClient,
     latitude: float,
@@ -568,90 +887,115 @@ async def get_restaurants(
     keyword: str,
     restaurant_category_id: int,
     order_by: int,
-    extras: str,
     offset: int = 0,
     limit: int = 20,
     delivery_mode: List = [],
     support_ids: List[int] = [],
     restaurant_category_ids: List[int] = [],
+    cursor: str = None,
 ):
-    filter = {}
-    if restaurant_category_ids:
-        category = await get_category_by_id(conn, restaurant_category_ids[0])
-        filter = category.copy()
-
-    # 按照距离，评分，销量等排序
-    sortby = {}
-    if order_by:
-        if order_by == 1:
-            sortby["float_minimum_order_amount"] = 1
-        if order_by == 2:
-            filter["location"] = {"$near":[longitude, latitude]}
-        if order_by == 3:
-            sortby["rating"] = -1
-        if order_by == 5:
-            filter["location"] = {"$near":[longitude, latitude]}
-        if order_by == 6:
-            sortby["recent_order_num"] = -1
-    print('sortby')
-    print(sortby)
-
-    #   查找配送方式
-    if delivery_mode:
-        for d in delivery_mode:
-            filter["delivery_mode.id"] = d
+    # 返回 (餐馆列表, 下一页游标)，不足一页时游标为 None
+    filter = await get_restaurants_filter(
+        conn, keyword, delivery_mode, support_ids, restaurant_category_ids,
+        restaurant_category_id, latitude, longitude,
+    )
 
-    # 	//查找活动支持方式
-    filterarr = []
-    if support_ids:
-        for s in support_ids:
-            if s != 8:
-                filterarr.aappend(s)
-            else:
-                filter["is_premium"] = True
+    field, direction = restaurant_sorts.get(order_by, (None, 1))
+    sortby = {field: direction} if field else {}
+    sortby["id"] = 1
+
+    pipeline = []
+    if field == "distance_m":
+        # 距离由 mongodb 按 2dsphere 索引计算，限定搜索半径
+        pipeline.append({"$geoNear": {
+            "near": {"type": "Point", "coordinates": [longitude, latitude]},
+            "distanceField": "distance_m",
+            "maxDistance": SHOP_SEARCH_RADIUS,
+            "spherical": True,
+            "query": filter,
+        }})
+    else:
+        pipeline.append({"$match": filter})
+
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        if field:
+            op = "$gt" if direction > 0 else "$lt"
+            after = {"$or": [
+                {field: {op: value}},
+                {field: value, "id": {"$gt": last_id}},
+            ]}
+        else:
+            after = {"id": {"$gt": last_id}}
+        pipeline.append({"$match": after})
+
+    pipeline.append({"$sort": sortby})
+    if offset and not cursor:
+        pipeline.append({"$skip": offset})
+    pipeline.append({"$limit": limit})
+    pipeline.append({"$project": dict(
+        model_projection(ShopModel), distance_m=True
+    )})
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("mongo aggregate %s %s", restaurants_collection_name, pipeline)
+    rows = conn[db_name][restaurants_collection_name].aggregate(pipeline)
 
-        filter["supports.id"] = {"$all": filterarr}
+    res = []
+    last_row = None
+    last_meters = None
+    async for row in rows:
+        meters = row.pop("distance_m", None)
+        if meters is None:
+            meters = haversine(
+                latitude, longitude, row["latitude"], row["longitude"]
+            )
+        row["distance"] = format_distance(meters)
+        row["order_lead_time"] = estimate_lead_time(meters)
+        last_row = row
+        last_meters = meters
+        res.append(load_row(ShopModel, row))
 
-    print('filter')
-    print(filter)
+    logger.debug("restaurants %s rows", len(res))
+    next_cursor = None
+    if last_row and len(res) == limit:
+        value = last_meters if field == "distance_m" else last_row.get(field)
+        next_cursor = encode_cursor(value, last_row["id"])
 
-    res = []
-    # rows = conn[db_name][restaurants_collection_name].find(
-        # filter
-    # ).sort(sortby).limit(limit).skip(offset)
-    rows = conn[db_name][restaurants_collection_name].find()
+    return res, next_cursor
 
+async def search_restaurants(
+    conn: AsyncIOMotorClient,
+    latitude: float,
+    longitude: float,
+    keyword: str,
+    offset: int = 0,
+    limit: int = 20,
+) -> list:
+    # 搜索索引给出排好序的 shop id，再按 id 批量取餐馆详情
+    hits = get_search_index().search(
+        keyword, latitude, longitude, SHOP_SEARCH_RADIUS
+    )[offset:offset + limit]
+    if not hits:
+        return []
+
+    rows = conn[db_name][restaurants_collection_name].find(
+        {"id": {"$in": [shop_id for shop_id, _ in hits]}},
+        projection=model_projection(ShopModel)
+    )
+    shops = {}
     async for row in rows:
-        res.append(ShopModel(**row))
-
-    print('res')
-    print(res)
-    # 获取百度地图测局所需经度纬度
-    # from = str(latitude) + ',' + str(longitude)
-    # to = ''
-
-    # for i in res:
-
-    # 	restaurants.forEach((item, index) => {
-    # 		const slpitStr = (index == restaurants.length -1) ? '' : '|';
-    # 		to += item.latitude + ',' + item.longitude + slpitStr;
-    # 	})
-
-    # 	try{
-    # 		if (restaurants.length) {
-    # 			//获取距离信息，并合并到数据中
-    # 			const distance_duration = await this.getDistance(from, to)
-    # 			restaurants.map((item, index) => {
-    # 				return Object.assign(item, distance_duration[index])
-    # 			})
-    # 		}
-    # 	}catch(err){
-    # 		// 百度地图达到上限后会导致加车失败，需优化
-    # 		console.log('从addressComoponent获取测距数据失败', err);
-    # 		restaurants.map((item, index) => {
-    # 			return Object.assign(item, {distance: '10公里', order_lead_time: '40分钟'})
-    # 		})
-    # 	}
+        shops[row["id"]] = row
+
+    res = []
+    for shop_id, meters in hits:
+        row = shops.get(shop_id)
+        if not row:
+            continue
+        row["distance"] = format_distance(meters)
+        row["order_lead_time"] = estimate_lead_time(meters)
+        res.append(load_row(ShopModel, row))
+    logger.debug("search %r %s hits", keyword, len(res))
     return res
 
 async def get_restaurant_detail(
@@ -672,11 +1016,7 @@ async def get_restaurant_detail(
 async def get_deliveries(
     conn: AsyncIOMotorClient,
 ):
-    rows= conn[db_name][deliveries_collection_name].find({})
-    res = []
-    async for row in rows:
-        res.append(DeliveriesModel(**row))
-    return res 
+    return list(get_snapshot().deliveries.rows)
 # =============================================================================
 
 
@@ -685,23 +1025,22 @@ async def get_deliveries(
 async def get_activities(
     conn: AsyncIOMotorClient,
 ):
-    rows= conn[db_name][activities_collection_name].find({})
-    res = []
-    async for row in rows:
-        res.append(ActivitiesModel(**row))
-    return res 
+    return list(get_snapshot().activities.rows)
 # =============================================================================
 
 # -----------------------------------------------------------------------------
 # menu
+query_shape(menus_collection_name, "restaurant_id")
 async def get_menus(
     conn: AsyncIOMotorClient,
     id:int,
 ):
-    rows= conn[db_name][menus_collection_name].find({"restaurant_id":id})
+    rows= conn[db_name][menus_collection_name].find(
+        {"restaurant_id":id}, projection=model_projection(MenusModel)
+    )
     res = []
     async for row in rows:
-        res.append(MenusModel(**row))
+        res.append(load_row(MenusModel, row))
     return res 
     # const category_id = req.params.category_id;
     # const menu = await MenuModel.findOne({id: category_id}, '-_id');
@@ -710,41 +1049,81 @@ async def get_menus(
 
 # -----------------------------------------------------------------------------
 # ratings
+RATINGS_CACHE_TTL = float(os.getenv("RATINGS_CACHE_TTL", 30))
+
+# 评分和标签在同一次查询里取出，店铺页同时发起的三个请求共享一次查询
+ratings_cache = TieredCache("ratings", ttl=RATINGS_CACHE_TTL)
+
+
+query_shape(ratings_collection_name, "restaurant_id")
 async def get_restaurant_ratings(
     conn: AsyncIOMotorClient,
     id:int,
+    offset: int = 0,
+    limit: int = 10,
+    tag_name: str = "",
+) -> List[RateModel]:
+    if tag_name == "全部":
+        tag_name = ""
+
+    async def load():
+        ratings = "$ratings"
+        if tag_name:
+            ratings = {"$filter": {
+                "input": "$ratings",
+                "as": "r",
+                "cond": {"$in": [tag_name, {"$ifNull": ["$$r.tags", []]}]},
+            }}
+        rows = conn[db_name][ratings_collection_name].aggregate([
+            {"$match": {"restaurant_id": id}},
+            {"$limit": 1},
+            {"$project": {
+                "_id": False,
+                "ratings": {"$slice": [ratings, offset, limit]},
+            }},
+        ])
+        res = []
+        async for row in rows:
+            res = [RateModel(**r) for r in row.get("ratings") or []]
+        return res
+
+    return await ratings_cache.get_or_load(
+        f"{id}:ratings:{offset}:{limit}:{tag_name}", load
+    )
+
+
+async def get_restaurant_ratings_summary(
+    conn: AsyncIOMotorClient,
+    id:int,
 ):
-    rows= conn[db_name][ratings_collection_name].find({"restaurant_id":id})
-    res = []
-    async for row in rows:
-        k = RatingsModel(**row)
-        res = k.ratings
-    return res 
+    async def load():
+        row = await conn[db_name][ratings_collection_name].find_one(
+            {"restaurant_id": id},
+            projection={"_id": False, "scores": True, "tags": True}
+        )
+        if not row:
+            return {"scores": [], "tags": []}
+        return {
+            "scores": ScoresModel(**(row.get("scores") or {})),
+            "tags": [TagsModel(**t) for t in row.get("tags") or []],
+        }
+
+    return await ratings_cache.get_or_load(f"{id}:summary", load)
 
 
 async def get_restaurant_ratings_scores(
     conn: AsyncIOMotorClient,
     id:int,
 ):
-    rows= conn[db_name][ratings_collection_name].find({"restaurant_id":id})
-    res = []
-    async for row in rows:
-        k = RatingsModel(**row)
-        res = k.scores
-    return res 
+    res = await get_restaurant_ratings_summary(conn, id)
+    return res["scores"]
 
 
 async def get_restaurant_ratings_tags(
     conn: AsyncIOMotorClient,
     id:int,
 ):
-    rows= conn[db_name][ratings_collection_name].find({"restaurant_id":id})
-    res = []
-    async for row in rows:
-        k = RatingsModel(**row)
-        res = k.tags
-    return res 
-
-
+    res = await get_restaurant_ratings_summary(conn, id)
+    return res["tags"]
 
 # =============================================================================
\ No newline at end of file
@@ -2,8 +2,14 @@ import os
 import logging
 
 from databases import DatabaseURL
+from datetime import datetime
+
+from pymongo import IndexModel, UpdateOne, ASCENDING, DESCENDING, GEOSPHERE
+from pymongo.errors import OperationFailure
 from motor.motor_asyncio import AsyncIOMotorClient
 
+logger = logging.getLogger(__name__)
+
 # -----------------------------------------------------------------------------
 # mongodb config
 MAX_CONN = int(os.getenv("MAX_CONN", 10))
@@ -44,20 +50,20 @@ async def get_database() -> AsyncIOMotorClient:
 # -----------------------------------------------------------------------------
 # connect & close
 async def connect_to_mongo():
-    logging.info("连接数据库中...")
-    logging.info(str(MONGODB_URL))
+    logger.info("连接数据库中...")
+    logger.info(str(MONGODB_URL))
     db.client = AsyncIOMotorClient(
         str(MONGODB_URL),
         maxPoolSize=MAX_CONN,
         minPoolSize=MIN_CONN
     )
-    logging.info("连接数据库成功！")
+    logger.info("连接数据库成功！")
 
 
 async def close_mongo_connection():
-    logging.info("关闭数据库连接...")
+    logger.info("关闭数据库连接...")
     db.client.close()
-    logging.info("数据库连接关闭！")
+    logger.info("数据库连接关闭！")
 # =============================================================================
 
 
@@ -79,8 +85,228 @@ users_collection_name = "users"
 userinfos_collection_name = "userinfos"
 categories_collection_name = "categories"
 restaurants_collection_name = "shops"
+category_counts_collection_name = "category_counts"
 deliveries_collection_name = "deliveries"
 activities_collection_name = "activities"
 menus_collection_name = "menus"
 ratings_collection_name = "ratings"
+carts_collection_name = "carts"
+stocks_collection_name = "stocks"
+reservations_collection_name = "reservations"
+orders_collection_name = "orders"
+addresses_collection_name = "addresses"
+ids_collection_name = "ids"
+captchas_collection_name = "captchas"
+
+migrations_collection_name = "migrations"
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# indexes
+# 订单冷库 (fmorder.ORDER_ARCHIVE_DB) 使用同样的索引
+order_indexes = [
+    IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)]),
+    IndexModel([("created_at", ASCENDING)]),
+]
+
+# 每个集合需要的索引，启动时或 `python fmdb.py indexes` 幂等创建
+collection_indexes = {
+    users_collection_name: [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    articles_collection_name: [
+        IndexModel([("slug", ASCENDING)], unique=True),
+        IndexModel([("created_at", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([
+            ("author_id", ASCENDING),
+            ("created_at", DESCENDING),
+            ("_id", DESCENDING)
+        ]),
+        IndexModel([
+            ("tag_list", ASCENDING),
+            ("created_at", DESCENDING),
+            ("_id", DESCENDING)
+        ]),
+    ],
+    favorites_collection_name: [
+        IndexModel([("user_id", ASCENDING), ("article_id", ASCENDING)], unique=True),
+        IndexModel([("article_id", ASCENDING)]),
+    ],
+    followers_collection_name: [
+        IndexModel([("follower", ASCENDING), ("following", ASCENDING)], unique=True),
+        IndexModel([("following", ASCENDING)]),
+    ],
+    tags_collection_name: [
+        IndexModel([("tag", ASCENDING)]),
+    ],
+    userinfos_collection_name: [
+        IndexModel([("user_id", ASCENDING)]),
+        IndexModel([("username", ASCENDING)], unique=True),
+    ],
+    restaurants_collection_name: [
+        # shops.location 为 [经度, 纬度]，$geoNear 需要 2dsphere 索引
+        IndexModel([("location", GEOSPHERE)]),
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("category", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("float_minimum_order_amount", ASCENDING), ("id", ASCENDING)]),
+        IndexModel([("rating", DESCENDING), ("id", ASCENDING)]),
+        IndexModel([("recent_order_num", DESCENDING), ("id", ASCENDING)]),
+        IndexModel([("delivery_mode.id", ASCENDING)]),
+        IndexModel([("supports.id", ASCENDING)]),
+    ],
+    menus_collection_name: [
+        IndexModel([("restaurant_id", ASCENDING)]),
+        IndexModel([("v", ASCENDING)]),
+    ],
+    ratings_collection_name: [
+        IndexModel([("restaurant_id", ASCENDING)]),
+    ],
+    carts_collection_name: [
+        IndexModel([("id", ASCENDING)], unique=True),
+        # 结算后未下单的购物车到 expire_at 自动删除
+        IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+    stocks_collection_name: [
+        IndexModel([("restaurant_id", ASCENDING)]),
+    ],
+    reservations_collection_name: [
+        IndexModel([("state", ASCENDING), ("expire_at", ASCENDING)]),
+    ],
+    orders_collection_name: order_indexes,
+    addresses_collection_name: [
+        IndexModel([("user_id", ASCENDING), ("id", ASCENDING)], unique=True),
+        # 按餐馆位置的 geohash 前缀找用户可配送的地址
+        IndexModel([("user_id", ASCENDING), ("st_geohash", ASCENDING)]),
+    ],
+    captchas_collection_name: [
+        IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0),
+    ],
+}
+
+# 查询形状: (集合, 需要索引支撑的等值/排序字段)
+# 由发出查询的模块在查询函数旁用 query_shape 登记，其余条件在索引命中的文档上过滤
+# 启动时检查每个形状都有可用索引，新增查询忘记建索引时会有警告
+query_shapes = []
+
+
+def query_shape(name: str, *fields: str):
+    shape = (name, list(fields))
+    if shape not in query_shapes:
+        query_shapes.append(shape)
+
+
+async def create_indexes():
+    logger.info("创建索引...")
+    database = db.client[db_name]
+    for name, indexes in collection_indexes.items():
+        try:
+            await database[name].create_indexes(indexes)
+        except OperationFailure as e:
+            # 已有数据违反唯一约束或同名索引定义不同，记录后继续
+            logger.error("集合 %s 创建索引失败: %s", name, e)
+
+    for name, fields in await find_unindexed_queries():
+        logger.warning("集合 %s 的查询 %s 没有可用索引", name, fields)
+
+
+async def get_index_keys(name: str) -> list:
+    # _id 总有索引；集合还没有文档时 list_indexes 为空
+    keys = [["_id"]]
+    async for index in db.client[db_name][name].list_indexes():
+        keys.append([field for field, _ in index["key"].items()])
+    return keys
+
+
+async def find_unindexed_queries() -> list:
+    # 查询字段需要是某个索引的前缀（顺序不限）
+    missing = []
+    index_keys = {}
+    for name, fields in query_shapes:
+        if name not in index_keys:
+            index_keys[name] = await get_index_keys(name)
+        if not any(
+            set(keys[:len(fields)]) == set(fields)
+            for keys in index_keys[name]
+        ):
+            missing.append((name, fields))
+    return missing
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# migrations
+# 每个迁移只执行一次，执行记录保存在 migrations 集合
+async def backfill_article_created_at(database):
+    # 早期文章没有 created_at 字段，用 _id 的生成时间补齐，供 (created_at, _id) 分页
+    requests = []
+    rows = database[articles_collection_name].find(
+        {"created_at": {"$exists": False}},
+        projection={"_id": True}
+    )
+    async for row in rows:
+        requests.append(UpdateOne(
+            {"_id": row["_id"]},
+            {"$set": {"created_at": row["_id"].generation_time.replace(tzinfo=None)}}
+        ))
+        if len(requests) >= 1000:
+            await database[articles_collection_name].bulk_write(requests)
+            requests = []
+    if requests:
+        await database[articles_collection_name].bulk_write(requests)
+
+
+migrations = [
+    ("0001_article_created_at", backfill_article_created_at),
+]
+
+
+async def run_migrations():
+    database = db.client[db_name]
+    applied = set()
+    async for row in database[migrations_collection_name].find():
+        applied.add(row["_id"])
+
+    for name, migration in migrations:
+        if name in applied:
+            continue
+        logger.info("执行迁移 %s...", name)
+        await migration(database)
+        await database[migrations_collection_name].insert_one(
+            {"_id": name, "applied_at": datetime.utcnow()}
+        )
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# cli
+# python fmdb.py indexes  创建索引、执行迁移并检查查询形状
+async def main():
+    await connect_to_mongo()
+    try:
+        await create_indexes()
+        await run_migrations()
+        for name, indexes in collection_indexes.items():
+            print(name, await get_index_keys(name))
+        missing = await find_unindexed_queries()
+        for name, fields in missing:
+            print("missing", name, fields)
+        return 1 if missing else 0
+    finally:
+        await close_mongo_connection()
+
+
+if __name__ == "__main__":
+    import sys
+    import asyncio
+
+    if sys.argv[1:] != ["indexes"]:
+        print("usage: python fmdb.py indexes")
+        sys.exit(2)
+    logging.basicConfig(level=logging.INFO)
+    # 作为脚本运行时本模块是 __main__；导入 fm 让各模块向 fmdb 登记查询形状，再用 fmdb 的 main
+    import fm       # noqa: F401
+    import fmdb
+    sys.exit(asyncio.get_event_loop().run_until_complete(fmdb.main()))
 # =============================================================================
@@ -0,0 +1,440 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import argparse
+
+from datetime import datetime, timedelta
+from collections import Counter
+
+from pymongo import UpdateOne
+
+from fmdb import (
+    restaurants_collection_name,
+    category_counts_collection_name,
+    menus_collection_name,
+    ratings_collection_name,
+    categories_collection_name,
+    deliveries_collection_name,
+    activities_collection_name,
+    entries_collection_name,
+    cities_collection_name,
+)
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# generator config
+GEN_SEED = int(os.getenv("GEN_SEED", 2020))
+GEN_BATCH_SIZE = int(os.getenv("GEN_BATCH_SIZE", 1000))     # 每次 insert_many 的餐馆数
+GEN_MAX_RATINGS = int(os.getenv("GEN_MAX_RATINGS", 200))    # 每个餐馆最多保存的评价数
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# reference data
+# 北京各区中心点和餐馆分布的标准差（度），市中心密集，郊区稀疏
+DISTRICTS = [
+    ("东城区", 39.9288, 116.4164, 0.02, 10),
+    ("西城区", 39.9123, 116.3660, 0.02, 10),
+    ("朝阳区", 39.9215, 116.4864, 0.05, 25),
+    ("海淀区", 39.9599, 116.2981, 0.05, 20),
+    ("丰台区", 39.8585, 116.2864, 0.04, 12),
+    ("石景山区", 39.9056, 116.2230, 0.02, 4),
+    ("通州区", 39.9097, 116.6566, 0.05, 7),
+    ("昌平区", 40.2207, 116.2312, 0.06, 6),
+    ("大兴区", 39.7269, 116.3415, 0.06, 6),
+]
+
+# (父分类 id, 名称, [(子分类 id, 名称, 菜品)])
+CATEGORY_TREE = [
+    (207, "快餐便当", [
+        (209, "简餐", [("黄焖鸡米饭", "huang men ji mi fan"), ("香菇滑鸡饭", "xiang gu hua ji fan")]),
+        (211, "盖浇饭", [("鱼香肉丝盖饭", "yu xiang rou si gai fan"), ("宫保鸡丁盖饭", "gong bao ji ding gai fan")]),
+        (212, "米粉面馆", [("牛肉面", "niu rou mian"), ("桂林米粉", "gui lin mi fen")]),
+        (213, "包子粥店", [("小笼包", "xiao long bao"), ("皮蛋瘦肉粥", "pi dan shou rou zhou")]),
+        (214, "麻辣烫", [("麻辣烫", "ma la tang"), ("冒菜", "mao cai")]),
+    ]),
+    (220, "特色菜系", [
+        (221, "川湘菜", [("水煮鱼", "shui zhu yu"), ("剁椒鱼头", "duo jiao yu tou")]),
+        (222, "粤菜", [("白切鸡", "bai qie ji"), ("烧鹅饭", "shao e fan")]),
+        (223, "东北菜", [("锅包肉", "guo bao rou"), ("地三鲜", "di san xian")]),
+    ]),
+    (230, "异国料理", [
+        (231, "日韩料理", [("寿司拼盘", "shou si pin pan"), ("石锅拌饭", "shi guo ban fan")]),
+        (232, "西餐", [("意大利面", "yi da li mian"), ("牛排", "niu pai")]),
+        (233, "披萨意面", [("培根披萨", "pei gen pi sa"), ("海鲜披萨", "hai xian pi sa")]),
+    ]),
+    (240, "小吃夜宵", [
+        (241, "烧烤", [("羊肉串", "yang rou chuan"), ("烤鸡翅", "kao ji chi")]),
+        (242, "炸鸡炸串", [("香酥炸鸡", "xiang su zha ji"), ("炸串", "zha chuan")]),
+        (243, "小龙虾", [("麻辣小龙虾", "ma la xiao long xia"), ("蒜蓉小龙虾", "suan rong xiao long xia")]),
+    ]),
+    (250, "甜品饮品", [
+        (251, "奶茶果汁", [("珍珠奶茶", "zhen zhu nai cha"), ("鲜榨橙汁", "xian zha cheng zhi")]),
+        (252, "甜品", [("芒果班戟", "mang guo ban ji"), ("双皮奶", "shuang pi nai")]),
+    ]),
+]
+
+# 通用配菜，丰富菜单
+SIDE_FOODS = [
+    ("米饭", "mi fan"), ("可乐", "ke le"), ("卤蛋", "lu dan"),
+    ("凉拌黄瓜", "liang ban huang gua"), ("酸梅汤", "suan mei tang"),
+]
+
+SHOP_PREFIXES = ["老", "小", "金", "福", "好", "大", "新", "正宗", "阿", "蜀"]
+SHOP_SUFFIXES = ["记", "家", "坊", "屋", "馆", "铺", "小厨", "食堂"]
+
+DELIVERIES = [{"color": "57A9FF", "id": 1, "is_solid": True, "text": "蜂鸟专送"}]
+
+ACTIVITIES = [
+    {"id": 1, "name": "新店", "description": "新开店铺", "icon_name": "新", "icon_color": "E8842D"},
+    {"id": 2, "name": "首单立减", "description": "新用户下单立减", "icon_name": "首", "icon_color": "70BC46"},
+    {"id": 3, "name": "满减优惠", "description": "满30减5", "icon_name": "减", "icon_color": "F07373"},
+]
+
+SUPPORTS = [
+    {"description": "已加入“外卖保”计划，食品安全有保障", "icon_color": "999999", "icon_name": "保", "id": 7, "name": "外卖保"},
+    {"description": "准时必达，超时秒赔", "icon_color": "57A9FF", "icon_name": "准", "id": 9, "name": "准时达"},
+    {"description": "该商家支持开发票，请在下单时填写好发票抬头", "icon_color": "999999", "icon_name": "票", "id": 4, "name": "开发票"},
+]
+
+RATING_TAGS = ["味道好", "送餐快", "分量足", "包装精美", "干净卫生", "食材新鲜", "服务不错", "味道一般"]
+
+CITIES = [
+    ("B", 1, "北京", "beijing"), ("S", 2, "上海", "shanghai"), ("G", 3, "广州", "guangzhou"),
+    ("S", 4, "深圳", "shenzhen"), ("H", 5, "杭州", "hangzhou"), ("C", 6, "成都", "chengdu"),
+    ("W", 7, "武汉", "wuhan"), ("N", 8, "南京", "nanjing"), ("X", 9, "西安", "xian"),
+]
+HOT_CITY_IDS = [1, 2, 3, 4, 5]
+
+SERVER_UTC = datetime(2020, 1, 1)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# documents
+# 每个餐馆使用独立的随机数生成器，同一 (seed, shop id) 总是生成同样的数据，
+# 分批或中断后续跑都不影响结果
+def shop_rng(seed: int, shop_id: int) -> random.Random:
+    return random.Random(f"{seed}:{shop_id}")
+
+
+def skewed(rng: random.Random, alpha: float, scale: float, cap: int) -> int:
+    # 长尾分布: 中位数约为 scale，少数很大
+    return min(int(scale * (rng.paretovariate(alpha) - 1)), cap)
+
+
+def pick_location(rng: random.Random) -> tuple:
+    weights = [district[4] for district in DISTRICTS]
+    name, latitude, longitude, sigma, _ = rng.choices(DISTRICTS, weights=weights)[0]
+    return name, rng.gauss(latitude, sigma), rng.gauss(longitude, sigma)
+
+
+def make_shop(rng: random.Random, shop_id: int) -> dict:
+    parent_id, parent_name, subs = rng.choice(CATEGORY_TREE)
+    sub_id, sub_name, dishes = rng.choice(subs)
+    district, latitude, longitude = pick_location(rng)
+    dish = rng.choice(dishes)[0]
+    name = f"{rng.choice(SHOP_PREFIXES)}{dish[:2]}{rng.choice(SHOP_SUFFIXES)}({district}{shop_id}店)"
+    rating_count = skewed(rng, 1.1, 20, 100000)
+    return {
+        "id": shop_id,
+        "name": name,
+        "address": f"北京市{district}{rng.randint(1, 300)}号",
+        "latitude": round(latitude, 6),
+        "longitude": round(longitude, 6),
+        "location": [round(longitude, 6), round(latitude, 6)],
+        "phone": f"010-{rng.randint(10000000, 99999999)}",
+        "category": f"{parent_name}/{sub_name}",
+        "supports": rng.sample(SUPPORTS, rng.randint(0, len(SUPPORTS))),
+        "status": 1,
+        "recent_order_num": skewed(rng, 1.2, 50, 50000),
+        "rating_count": rating_count,
+        "rating": round(min(5.0, max(3.0, rng.gauss(4.5, 0.3))), 1),
+        "promotion_info": "欢迎光临，用餐高峰请提前下单，谢谢",
+        "piecewise_agent_fee": {"tips": f"配送费约¥{rng.choice([0, 3, 5, 8])}"},
+        "opening_hours": [rng.choice(["8:30/20:30", "10:00/22:00", "17:00/02:00"])],
+        "license": {"business_license_image": "", "catering_service_license_image": ""},
+        "is_new": rng.random() < 0.1,
+        "is_premium": rng.random() < 0.2,
+        "image_path": "",
+        "delivery_mode": dict(rng.choice(DELIVERIES)),
+        "activities": rng.sample(ACTIVITIES, rng.randint(0, 2)),
+        "identification": {
+            "registered_address": f"北京市{district}",
+            "company_name": name,
+            "identificate_date": SERVER_UTC,
+        },
+        "float_delivery_fee": rng.choice([0, 3, 5, 8]),
+        "float_minimum_order_amount": rng.choice([0, 15, 20, 30]),
+        "description": "",
+    }
+
+
+def make_specfoods(rng: random.Random, shop_id: int, item_id: int, food: tuple) -> list:
+    # 一半菜品有多个规格（大份/小份）
+    name, pinyin = food
+    price = rng.randint(8, 60)
+    specs = [("", 0)]
+    if rng.random() < 0.5:
+        specs = [("小份", 0), ("大份", rng.randint(3, 10))]
+    return [{
+        "original_price": 0,
+        "sku_id": item_id * 10 + n,
+        "name": name,
+        "pinyin_name": pinyin,
+        "restaurant_id": shop_id,
+        "food_id": item_id * 10 + n,
+        "packing_fee": rng.choice([0, 1, 2]),
+        "recent_rating": round(rng.uniform(3.5, 5), 1),
+        "promotion_stock": -1,
+        "price": price + extra,
+        "sold_out": rng.random() < 0.05,
+        "recent_popularity": skewed(rng, 1.3, 5, 5000),
+        "is_essential": False,
+        "item_id": item_id,
+        "checkout_mode": 1,
+        "stock": rng.randint(0, 1000),
+        "specs_name": spec,
+        "specs": [{"name": "规格", "value": spec}] if spec else [],
+    } for n, (spec, extra) in enumerate(specs)]
+
+
+def make_menus(rng: random.Random, shop: dict) -> list:
+    shop_id = shop["id"]
+    parent_name, sub_name = shop["category"].split("/")
+    dishes = next(
+        dishes
+        for _, name, subs in CATEGORY_TREE if name == parent_name
+        for _, sub, dishes in subs if sub == sub_name
+    )
+    groups = [("热销榜", dishes + rng.sample(SIDE_FOODS, 2)), ("主食", dishes), ("小吃配菜", SIDE_FOODS)]
+    menus = []
+    for index, (group, foods) in enumerate(groups[:rng.randint(2, 3)]):
+        menu_id = shop_id * 10 + index
+        items = []
+        for n, food in enumerate(foods):
+            item_id = menu_id * 100 + n
+            month_sales = skewed(rng, 1.2, 10, 20000)
+            items.append({
+                "rating": round(rng.uniform(3.5, 5), 1),
+                "is_featured": int(rng.random() < 0.1),
+                "restaurant_id": shop_id,
+                "category_id": menu_id,
+                "pinyin_name": food[1],
+                "display_times": [],
+                "attrs": [],
+                "description": "",
+                "month_sales": month_sales,
+                "rating_count": month_sales // 5,
+                "tips": f"{month_sales // 5}评价 月售{month_sales}份",
+                "image_path": "",
+                "specifications": [],
+                "server_utc": SERVER_UTC,
+                "is_essential": False,
+                "attributes": [],
+                "item_id": item_id,
+                "limitation": "",
+                "name": food[0],
+                "satisfy_count": month_sales // 6,
+                "activity": "",
+                "satisfy_rate": rng.randint(80, 100),
+                "specfoods": make_specfoods(rng, shop_id, item_id, food),
+            })
+        menus.append({
+            "description": "大家喜欢吃，才叫真好吃。" if index == 0 else "",
+            "is_selected": index == 0,
+            "icon_url": "",
+            "name": group,
+            "id": menu_id,
+            "restaurant_id": shop_id,
+            "type": 1,
+            "foods": items,
+        })
+    return menus
+
+
+def make_ratings(rng: random.Random, shop: dict) -> dict:
+    # 保存的评价条数与 rating_count 同样长尾，最多 GEN_MAX_RATINGS 条
+    count = min(shop["rating_count"], GEN_MAX_RATINGS)
+    tag_counts = {tag: 0 for tag in RATING_TAGS}
+    ratings = []
+    for n in range(count):
+        star = rng.choices([1, 2, 3, 4, 5], weights=[2, 3, 10, 30, 55])[0]
+        tags = rng.sample(RATING_TAGS, rng.randint(0, 2))
+        for tag in tags:
+            tag_counts[tag] += 1
+        rated_at = SERVER_UTC - timedelta(days=rng.randint(0, 365))
+        ratings.append({
+            "avatar": "",
+            "item_ratings": [],
+            "rated_at": rated_at.strftime("%Y-%m-%d"),
+            "rating_star": star,
+            "rating_text": "" if rng.random() < 0.5 else "很好吃，还会再来",
+            "time_spent_desc": f"{rng.randint(20, 60)}分钟送达",
+            "username": f"1{rng.randint(30, 89)}******{rng.randint(10, 99)}",
+            "tags": tags,
+            "highlights": [],
+        })
+    score = shop["rating"]
+    return {
+        "restaurant_id": shop["id"],
+        "ratings": ratings,
+        "scores": {
+            "compare_rating": round(rng.uniform(0.5, 0.95), 2),
+            "deliver_time": rng.randint(25, 50),
+            "food_score": round(min(5.0, score + rng.uniform(-0.2, 0.2)), 1),
+            "order_rating_amount": shop["rating_count"],
+            "overall_score": score,
+            "service_score": round(min(5.0, score + rng.uniform(-0.2, 0.2)), 1),
+        },
+        "tags": [{"count": count, "name": "全部", "unsatisfied": False}] + [
+            {"count": n, "name": tag, "unsatisfied": tag == "味道一般"}
+            for tag, n in tag_counts.items() if n
+        ],
+    }
+
+
+def make_categories() -> list:
+    res = []
+    for parent_id, parent_name, subs in CATEGORY_TREE:
+        res.append({
+            "id": parent_id,
+            "name": parent_name,
+            "level": 1,
+            "image_url": "",
+            "ids": [sub_id for sub_id, _, _ in subs],
+            "sub_categories": [
+                {"id": parent_id, "name": f"全部{parent_name}", "level": 1, "image_url": ""}
+            ] + [
+                {"id": sub_id, "name": sub_name, "level": 2, "image_url": ""}
+                for sub_id, sub_name, _ in subs
+            ],
+        })
+    return res
+
+
+def make_entries() -> list:
+    return [{
+        "id": n,
+        "is_in_serving": True,
+        "description": f"{name}入口",
+        "title": name,
+        "link": "",
+        "image_url": "",
+        "icon_url": "",
+        "title_color": "",
+    } for n, (_, name, _) in enumerate(CATEGORY_TREE, 1)]
+
+
+def make_cities() -> dict:
+    data = {"hotCities": []}
+    for letter, city_id, name, pinyin in CITIES:
+        city = {"id": city_id, "name": name, "pinyin": pinyin}
+        data.setdefault(letter, []).append(city)
+        if city_id in HOT_CITY_IDS:
+            data["hotCities"].append(city)
+    return {"v": 1, "data": data}
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# writer
+async def generate_reference(database):
+    await database[categories_collection_name].insert_many(make_categories())
+    await database[deliveries_collection_name].insert_many([dict(d) for d in DELIVERIES])
+    await database[activities_collection_name].insert_many([dict(a) for a in ACTIVITIES])
+    await database[entries_collection_name].insert_many(make_entries())
+    await database[cities_collection_name].insert_one(make_cities())
+
+
+async def generate_shops(
+    database,
+    start: int,
+    stop: int,
+    seed: int = GEN_SEED,
+    batch_size: int = GEN_BATCH_SIZE,
+):
+    # 生成 id 为 [start, stop) 的餐馆及其菜单、评价，每批一次 insert_many
+    for batch_start in range(start, stop, batch_size):
+        shops, menus, ratings = [], [], []
+        for shop_id in range(batch_start, min(batch_start + batch_size, stop)):
+            rng = shop_rng(seed, shop_id)
+            shop = make_shop(rng, shop_id)
+            shops.append(shop)
+            menus.extend(make_menus(rng, shop))
+            ratings.append(make_ratings(rng, shop))
+
+        # 菜单带上 v（毫秒），运行中的服务轮询 v 时会清掉这些餐馆的缓存
+        version = int(time.time() * 1000)
+        for menu in menus:
+            menu["v"] = version
+
+        await database[restaurants_collection_name].insert_many(shops, ordered=False)
+        await database[menus_collection_name].insert_many(menus, ordered=False)
+        await database[ratings_collection_name].insert_many(ratings, ordered=False)
+        # 分类餐馆数按批累加，运行中的服务通过 fmsnapshot 读到
+        await database[category_counts_collection_name].bulk_write([
+            UpdateOne({"_id": name}, {"$inc": {"count": count}}, upsert=True)
+            for name, count in Counter(shop["category"] for shop in shops).items()
+        ], ordered=False)
+        logger.info("已生成餐馆 %s/%s", min(batch_start + batch_size, stop) - start, stop - start)
+
+
+async def generate(database, shops: int, seed: int = GEN_SEED, batch_size: int = GEN_BATCH_SIZE):
+    await generate_reference(database)
+    await generate_shops(database, 1, shops + 1, seed, batch_size)
+
+
+generated_collections = [
+    restaurants_collection_name,
+    category_counts_collection_name,
+    menus_collection_name,
+    ratings_collection_name,
+    categories_collection_name,
+    deliveries_collection_name,
+    activities_collection_name,
+    entries_collection_name,
+    cities_collection_name,
+]
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# cli
+# python fmgen.py --shops 100000             写入 MONGO_DB，建议使用单独的库
+# python fmgen.py --shops 10000000 --drop    先清空生成的集合
+# python fmgen.py --shops 1000 --start 5001  追加 id 从 5001 开始的餐馆
+async def main(args) -> int:
+    from fmdb import db, db_name, connect_to_mongo, close_mongo_connection, create_indexes
+
+    await connect_to_mongo()
+    try:
+        database = db.client[db_name]
+        if args.drop:
+            for name in generated_collections:
+                await database[name].drop()
+        if args.start == 1:
+            await generate_reference(database)
+        await generate_shops(
+            database, args.start, args.start + args.shops, args.seed, args.batch_size
+        )
+        await create_indexes()
+    finally:
+        await close_mongo_connection()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成餐馆、菜单、评价测试数据")
+    parser.add_argument("--shops", type=int, default=1000)
+    parser.add_argument("--start", type=int, default=1, help="起始餐馆 id")
+    parser.add_argument("--seed", type=int, default=GEN_SEED)
+    parser.add_argument("--batch-size", type=int, default=GEN_BATCH_SIZE)
+    parser.add_argument("--drop", action="store_true", help="先删除生成的集合")
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(parser.parse_args())))
+# =============================================================================
@@ -0,0 +1,112 @@
+import os
+import math
+
+# -----------------------------------------------------------------------------
+# geo config
+EARTH_RADIUS = 6378100                                  # 米, 与 mongodb 球面计算一致
+SHOP_SEARCH_RADIUS = int(os.getenv("SHOP_SEARCH_RADIUS", 20000))   # 米
+RIDER_SPEED = float(os.getenv("RIDER_SPEED", 250))      # 骑手速度, 米/分钟
+PREPARE_MINUTES = int(os.getenv("PREPARE_MINUTES", 20))  # 出餐时间, 分钟
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# distance
+def haversine(
+    latitude1: float,
+    longitude1: float,
+    latitude2: float,
+    longitude2: float,
+) -> float:
+    lat1 = math.radians(latitude1)
+    lat2 = math.radians(latitude2)
+    dlat = lat2 - lat1
+    dlng = math.radians(longitude2 - longitude1)
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(dlng / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def format_distance(meters: float) -> str:
+    if meters < 1000:
+        return f"{int(round(meters))}米"
+    return f"{meters / 1000:.2f}公里"
+
+
+def estimate_lead_time(meters: float) -> str:
+    minutes = PREPARE_MINUTES + math.ceil(meters / RIDER_SPEED)
+    return f"{minutes}分钟"
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# geohash
+geohash_base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash_encode(latitude: float, longitude: float, precision: int = 8) -> str:
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            rng, value = lng_range, longitude
+        else:
+            rng, value = lat_range, latitude
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            rng[0] = mid
+        else:
+            bits = bits * 2
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(geohash_base32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def geohash_cell_size(precision: int) -> tuple:
+    # (纬度跨度, 经度跨度)，单位度；经度分得的位数比纬度多一半
+    bits = precision * 5
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+
+def geohash_cover(latitude: float, longitude: float, radius: float) -> list:
+    # 覆盖以 (纬度, 经度) 为中心、半径 radius 米的圆的 geohash 前缀
+    # 选格子边长不小于半径的最高精度，圆一定落在中心格及其 8 个邻格内
+    meters_per_degree = 111320
+    cos_lat = max(math.cos(math.radians(latitude)), 0.01)
+    precision = 1
+    for p in range(12, 0, -1):
+        dlat, dlng = geohash_cell_size(p)
+        if dlat * meters_per_degree >= radius and dlng * meters_per_degree * cos_lat >= radius:
+            precision = p
+            break
+
+    dlat, dlng = geohash_cell_size(precision)
+    cells = set()
+    for i in (-1, 0, 1):
+        for j in (-1, 0, 1):
+            lat = min(max(latitude + i * dlat, -90.0), 90.0)
+            lng = (longitude + j * dlng + 180.0) % 360.0 - 180.0
+            cells.add(geohash_encode(lat, lng, precision))
+    return sorted(cells)
+
+
+def parse_latlng(location: str):
+    # "纬度,经度" -> (纬度, 经度)，格式不对时返回 None
+    try:
+        latitude, longitude = (float(v) for v in location.split(","))
+    except (AttributeError, ValueError):
+        return None
+    return latitude, longitude
+# =============================================================================
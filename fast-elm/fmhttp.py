@@ -0,0 +1,131 @@
+import os
+import asyncio
+import logging
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# http client config
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))      # 总连接数
+HTTP_HOST_LIMIT = int(os.getenv("HTTP_HOST_LIMIT", 20))     # 每个主机并发连接数
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 30))     # 空闲连接保持秒数
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 5))          # 单次请求总超时
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 2))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", 2))            # 单个请求最多重试次数
+HTTP_RETRY_RATIO = float(os.getenv("HTTP_RETRY_RATIO", 0.1))   # 重试占请求的比例上限
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", 0.1))
+
+# 地图接口地址，测试时可指向本地桩服务
+MAP_API_URL = os.getenv("MAP_API_URL", "http://apis.map.qq.com")
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# retry budget
+class RetryBudget:
+    # 每个请求存入 ratio 个令牌，每次重试消耗一个令牌
+    # 上游故障时重试总量被限制在请求量的 ratio 倍以内，避免重试风暴
+    def __init__(self, ratio: float, min_tokens: float = 10, max_tokens: float = 100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# client object
+class HttpClientError(Exception):
+    pass
+
+
+class HttpClient:
+    session: aiohttp.ClientSession = None
+    budget: RetryBudget = None
+
+
+http = HttpClient()
+
+
+async def open_http_client():
+    logger.info("创建 http 连接池...")
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_HOST_LIMIT,
+        keepalive_timeout=HTTP_KEEPALIVE,
+    )
+    http.session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=HTTP_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT
+        ),
+    )
+    http.budget = RetryBudget(HTTP_RETRY_RATIO)
+
+
+async def close_http_client():
+    logger.info("关闭 http 连接池...")
+    if http.session:
+        await http.session.close()
+        http.session = None
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# request
+def _retryable(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+async def fetch_json(
+    method: str,
+    url: str,
+    *,
+    params: dict = None,
+    json: dict = None,
+    data: str = None,
+    headers: dict = None,
+) -> dict:
+    http.budget.deposit()
+    attempt = 0
+    while True:
+        try:
+            async with http.session.request(
+                method, url,
+                params=params, json=json, data=data, headers=headers
+            ) as res:
+                if not _retryable(res.status):
+                    # 腾讯地图接口的 content-type 不一定是 application/json
+                    try:
+                        return await res.json(content_type=None)
+                    except ValueError:
+                        raise HttpClientError(f"{method} {url} 返回非 json 数据")
+                error = HttpClientError(f"{method} {url} 返回 {res.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = HttpClientError(f"{method} {url} 请求失败: {e!r}")
+
+        attempt += 1
+        if attempt > HTTP_RETRIES or not http.budget.withdraw():
+            raise error
+        logger.warning("%s, 第 %s 次重试", error, attempt)
+        await asyncio.sleep(HTTP_RETRY_BACKOFF * attempt)
+
+
+async def get_json(url: str, params: dict = None, **kwargs) -> dict:
+    return await fetch_json("GET", url, params=params, **kwargs)
+
+
+async def post_json(url: str, **kwargs) -> dict:
+    return await fetch_json("POST", url, **kwargs)
+# =============================================================================
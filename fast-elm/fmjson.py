@@ -0,0 +1,78 @@
+import os
+import json
+import random
+import logging
+
+from datetime import datetime, date
+
+from bson import ObjectId
+from pydantic import BaseModel, ValidationError
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:             # orjson 为可选依赖，没有时退回标准库 json
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# json config
+# 信任数据库中的数据：读接口直接返回投影后的 dict，不再逐条构造 pydantic 模型
+TRUSTED_READS = os.getenv("TRUSTED_READS", "0") == "1"
+# 信任模式下按比例抽样校验，0 为不校验
+VALIDATE_SAMPLE_RATE = float(os.getenv("VALIDATE_SAMPLE_RATE", 0))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# encoder
+def json_default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(data) -> bytes:
+    if orjson:
+        return orjson.dumps(data, default=json_default)
+    return json.dumps(
+        data, default=json_default, ensure_ascii=False, separators=(",", ":")
+    ).encode()
+
+
+class JSONBytesResponse(Response):
+    # 直接把数据编码成 bytes，跳过 jsonable_encoder
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# trusted reads
+def model_projection(model) -> dict:
+    # 只取模型中定义的字段，信任模式下返回的 dict 与模型字段一致
+    projection = {name: True for name in model.__fields__}
+    projection["_id"] = False
+    return projection
+
+
+def load_row(model, row: dict):
+    if not TRUSTED_READS:
+        return model(**row)
+
+    if VALIDATE_SAMPLE_RATE and random.random() < VALIDATE_SAMPLE_RATE:
+        try:
+            model(**row)
+        except ValidationError as e:
+            logger.warning("%s 数据校验失败: %s", model.__name__, e)
+    return row
+# =============================================================================
@@ -0,0 +1,132 @@
+import os
+import sys
+import uuid
+import queue
+import random
+import logging
+import contextvars
+
+from logging.handlers import QueueHandler, QueueListener
+
+# -----------------------------------------------------------------------------
+# log config
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")
+# 按模块设置级别, 例如 "fmcrud=DEBUG,fmhttp=INFO"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# DEBUG 级别日志的采样比例, 1 为全部输出
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1))
+# 为每个请求生成 request id 并写入响应头 X-Request-ID
+LOG_REQUEST_ID = os.getenv("LOG_REQUEST_ID", "0") == "1"
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# request id
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+def get_request_id() -> str:
+    return request_id_var.get()
+
+
+class RequestIdMiddleware:
+    # 纯 ASGI 中间件，只设置 contextvar，不包装请求和响应体
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for name, value in scope.get("headers") or []:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")
+                break
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers") or [])
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# filters
+class RequestIdFilter(logging.Filter):
+    # 在调用线程里取 request id，之后才进入队列
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# setup & shutdown
+class LogState:
+    listener: QueueListener = None
+
+
+log_state = LogState()
+
+
+def parse_levels(levels: str) -> dict:
+    res = {}
+    for item in levels.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            res[name.strip()] = level.strip().upper()
+    return res
+
+
+def setup_logging():
+    # 日志先进队列，由后台线程写 stderr，请求处理中不做同步 io
+    if log_state.listener:
+        return
+
+    log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(LOG_SAMPLE_RATE))
+    queue_handler.addFilter(RequestIdFilter())
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL.upper())
+    for name, level in parse_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    log_state.listener = QueueListener(
+        log_queue, stream_handler, respect_handler_level=True
+    )
+    log_state.listener.start()
+
+
+async def stop_logging():
+    if log_state.listener:
+        log_state.listener.stop()
+        log_state.listener = None
+# =============================================================================
@@ -0,0 +1,128 @@
+import os
+import time
+import asyncio
+import logging
+
+from pymongo.errors import PyMongoError
+
+from fmdb import db, db_name, menus_collection_name, query_shape
+from fmcrud import get_menus
+from fmjson import dumps
+from fmresponse import make_etag
+from fmcache import TieredCache
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# menu cache config
+MENU_CACHE_SIZE = int(os.getenv("MENU_CACHE_SIZE", 5000))       # 缓存的餐馆数
+# 兜底过期秒数，收不到变更通知时菜单最多旧这么久
+MENU_CACHE_TTL = float(os.getenv("MENU_CACHE_TTL", 600))
+# 不支持 change stream（单机 mongo）时，按 v 字段轮询的间隔秒数
+MENU_POLL_INTERVAL = float(os.getenv("MENU_POLL_INTERVAL", 10))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# menu cache
+# 每个餐馆的菜单序列化一次，缓存 bytes 和 ETag
+# 写菜单的程序（如 fmgen）必须同时把 v 字段设为当前毫秒时间，轮询只能按 v 发现修改
+# 删除没有 v 可查，轮询时比较文档数，变化时清空整个缓存
+class MenuEntry:
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = make_etag(body)
+
+
+class MenuWatcher:
+    task: asyncio.Task = None
+    version: int = 0            # 轮询时已处理的最大 v
+    count: int = None           # 上次轮询时的菜单文档数
+
+
+menu_cache = TieredCache("menus", MENU_CACHE_SIZE, MENU_CACHE_TTL)
+# 结算用的价格表 (fmcart.PriceBook) 也是菜单的视图，随菜单一起失效
+price_cache = TieredCache("prices", MENU_CACHE_SIZE, MENU_CACHE_TTL)
+menu_watcher = MenuWatcher()
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+async def get_menu_entry(conn, restaurant_id: int) -> MenuEntry:
+    async def load():
+        return MenuEntry(dumps(await get_menus(conn, restaurant_id)))
+
+    return await menu_cache.get_or_load(str(restaurant_id), load)
+
+
+def invalidate_menu(restaurant_id: int):
+    menu_cache.invalidate(str(restaurant_id))
+    price_cache.invalidate(str(restaurant_id))
+
+
+def clear_menus():
+    menu_cache.clear()
+    price_cache.clear()
+
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# invalidation
+async def watch_menus():
+    collection = db.client[db_name][menus_collection_name]
+    try:
+        async with collection.watch(full_document="updateLookup") as stream:
+            logger.info("菜单缓存: 使用 change stream 失效")
+            async for change in stream:
+                doc = change.get("fullDocument")
+                if doc and "restaurant_id" in doc:
+                    invalidate_menu(doc["restaurant_id"])
+                else:
+                    # 删除事件只带 _id，不知道属于哪个餐馆
+                    clear_menus()
+    except PyMongoError as e:
+        logger.info("菜单缓存: change stream 不可用 (%r)，改为轮询 v 字段", e)
+        await poll_menus()
+
+
+query_shape(menus_collection_name, "v")
+async def poll_menus():
+    collection = db.client[db_name][menus_collection_name]
+    menu_watcher.version = now_ms()
+    menu_watcher.count = None
+    try:
+        menu_watcher.count = await collection.estimated_document_count()
+    except PyMongoError as e:
+        logger.warning("菜单缓存轮询失败: %r", e)
+    while True:
+        await asyncio.sleep(MENU_POLL_INTERVAL)
+        try:
+            rows = collection.find(
+                {"v": {"$gt": menu_watcher.version}},
+                projection={"_id": False, "restaurant_id": True, "v": True}
+            )
+            async for row in rows:
+                invalidate_menu(row["restaurant_id"])
+                menu_watcher.version = max(menu_watcher.version, row["v"])
+            # 同一轮里既有删除又有新增时文档数可能不变，这种情况靠 MENU_CACHE_TTL 兜底
+            count = await collection.estimated_document_count()
+            if menu_watcher.count is not None and count != menu_watcher.count:
+                clear_menus()
+            menu_watcher.count = count
+        except Exception as e:
+            logger.warning("菜单缓存轮询失败: %r", e)
+
+
+async def start_menu_watcher():
+    menu_watcher.task = asyncio.ensure_future(watch_menus())
+
+
+async def stop_menu_watcher():
+    if menu_watcher.task:
+        menu_watcher.task.cancel()
+        menu_watcher.task = None
+    clear_menus()
+# =============================================================================
@@ -4,7 +4,12 @@ from datetime import datetime, timezone
 
 from pydantic import BaseModel, Schema, BaseConfig, EmailStr, HttpUrl
 
-from fmsecurity import generate_salt, verify_password, get_password_hash
+from fmsecurity import (
+    generate_salt,
+    verify_password,
+    get_password_hash,
+    get_password_hash_async,
+)
 
 
 # -----------------------------------------------------------------------------
@@ -55,6 +60,10 @@ class RWUserInDB(DBModelMixin, RWUserBase):
         self.salt = generate_salt()
         self.hashed_password = get_password_hash(self.salt + password)
 
+    async def change_password_async(self, password: str):
+        self.salt = generate_salt()
+        self.hashed_password = await get_password_hash_async(self.salt + password)
+
 
 class RWUser(RWUserBase):
     token: str
@@ -105,6 +114,7 @@ class ArticleFilterParams(RWModel):
     favorited: str = ""
     limit: int = 20
     offset: int = 0
+    cursor: str = ""
 
 
 class ArticleBase(RWModel):
@@ -417,12 +427,13 @@ class RateModel(BaseModel):
 
 
 class ScoresModel(BaseModel):
-    compare_rating: float
-    deliver_time: int
-    food_score: float
-    order_rating_amount: int
-    overall_score: float
-    service_score: float
+    # 没有评价的餐馆没有 scores，各项按 0 处理
+    compare_rating: float = 0
+    deliver_time: int = 0
+    food_score: float = 0
+    order_rating_amount: int = 0
+    overall_score: float = 0
+    service_score: float = 0
 
 
 class TagsModel(BaseModel):
@@ -436,4 +447,67 @@ class RatingsModel(BaseModel):
     ratings: List[RateModel]
     scores: ScoresModel
     tags: List[TagsModel]
-# =============================================================================
\ No newline at end of file
+# =============================================================================
+
+# -----------------------------------------------------------------------------
+# CartModel
+class CartEntityModel(BaseModel):
+    # 前端购物车中的一项，价格以服务端价格表为准，客户端传来的 price 不使用
+    id: int = None                  # food_id
+    sku_id: int
+    item_id: int = None
+    quantity: int
+    name: str = ""
+    attrs: List = []
+    specs: List = []
+    extra: Dict = {}
+    packing_fee: float = 0
+    price: float = 0
+    stock: int = None
+
+
+class CartInCheckout(BaseModel):
+    come_from: str = "web"
+    geohash: str = ""
+    restaurant_id: int
+    entities: List[List[CartEntityModel]]
+
+
+class OrderInCreate(BaseModel):
+    # 下单以结算时保存的购物车为准，entities 只是前端回传的副本
+    address_id: int = None
+    come_from: str = "mobile_web"
+    deliver_time: str = ""
+    description: str = ""
+    entities: List[List[CartEntityModel]] = []
+    geohash: str = ""
+    paymethod_id: int = 1
+    sig: str = ""
+# =============================================================================
+
+
+
+# -----------------------------------------------------------------------------
+# AddressModel
+class AddressInCreate(BaseModel):
+    address: str
+    address_detail: str = ""
+    geohash: str                    # "纬度,经度"
+    name: str
+    phone: str
+    phone_bk: str = ""
+    poi_type: int = 0
+    sex: int = 1
+    tag: str = ""
+    tag_type: int = 0
+
+
+class AddressModel(AddressInCreate):
+    id: int
+    user_id: int
+    st_geohash: str = ""
+    is_valid: int = 1
+    created_at: datetime = None
+    is_deliverable: bool = None     # 只在按餐馆查询时返回
+    distance: str = None
+# =============================================================================
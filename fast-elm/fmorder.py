@@ -0,0 +1,284 @@
+import os
+import sys
+import asyncio
+import logging
+import argparse
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND
+
+from fmdb import db_name, orders_collection_name, order_indexes, query_shape
+from fmcrud import encode_cursor, decode_cursor, epoch
+from fmmodel import OrderInCreate
+from fmstock import STOCK_HOLD_TTL
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# order config
+ORDER_ARCHIVE_DB = os.getenv("ORDER_ARCHIVE_DB", "") or db_name    # 冷数据所在的库
+ORDER_ARCHIVE_DAYS = int(os.getenv("ORDER_ARCHIVE_DAYS", 180))     # 超过天数的订单归档
+ORDER_ARCHIVE_BATCH = int(os.getenv("ORDER_ARCHIVE_BATCH", 1000))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# order documents
+# orders 集合每单一个文档，按 (user_id, created_at, _id) 倒序分页
+# 列表字段在顶层，详情页的 snapshot 在下单时一次生成，读历史时不再关联 shops / menus
+# 归档后的订单移到 ORDER_ARCHIVE_DB 库的同名集合，读取时在热数据之后继续读冷数据
+WAIT_PAY = 0
+PAID = 1
+CANCELLED = -1
+
+order_status = {
+    WAIT_PAY: ("等待支付", "f60"),
+    PAID: ("支付成功", "6ac20b"),
+    CANCELLED: ("已取消", "999"),
+}
+
+list_projection = {"snapshot": False}
+snapshot_projection = {"_id": False, "snapshot": True, "status_code": True, "pay_expire_at": True}
+snapshot_excluded = ("_id", "created_at", "status_code", "pay_expire_at")
+
+
+def build_order(
+    order_id: str,
+    user_id: int,
+    cart: dict,
+    order: OrderInCreate,
+) -> dict:
+    now = datetime.utcnow()
+    restaurant = cart.get("restaurant_info") or {}
+    packing_fee = cart["extra"][0]["price"] if cart.get("extra") else 0
+    basket = {
+        "group": [[{
+            "name": item["name"],
+            "price": item["price"],
+            "quantity": item["quantity"],
+            "specs": item["specs"],
+            "sku_id": item["sku_id"],
+        } for item in group] for group in cart["groups"]],
+        "packing_fee": {"name": "餐盒", "price": packing_fee, "quantity": 1},
+        "deliver_fee": {"name": "配送费", "price": cart["deliver_amount"], "quantity": 1},
+        "extra": [],
+        "abandoned_extra": [],
+        "pindan_map": [],
+    }
+    doc = {
+        "_id": ObjectId(order_id),
+        "id": order_id,
+        "unique_id": order_id,
+        "user_id": user_id,
+        "restaurant_id": cart["restaurant_id"],
+        "restaurant_name": restaurant.get("name", ""),
+        "restaurant_image_url": restaurant.get("image_path", ""),
+        "basket": basket,
+        "total_amount": cart["total"],
+        "total_quantity": sum(item["quantity"] for group in cart["groups"] for item in group),
+        "status_code": WAIT_PAY,
+        "formatted_created_at": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        "order_time": int((now - epoch).total_seconds()),
+        "created_at": now,
+        "pay_expire_at": now + timedelta(seconds=STOCK_HOLD_TTL),
+    }
+    # 详情页需要的全部字段，下单后不再变化；状态随支付、取消变化，读取时取顶层字段
+    doc["snapshot"] = dict(
+        {key: value for key, value in doc.items() if key not in snapshot_excluded},
+        restaurant_phone=restaurant.get("phone", ""),
+        restaurant_address=restaurant.get("address", ""),
+        groups=cart["groups"],
+        address_id=order.address_id,
+        description=order.description,
+        deliver_time=order.deliver_time or cart.get("promise_delivery_time", ""),
+        pay_method="在线支付",
+        geohash=order.geohash or cart.get("geohash", ""),
+        come_from=order.come_from,
+    )
+    return doc
+
+
+def render_order(row: dict, now: datetime = None) -> dict:
+    # 状态栏随时间变化（支付倒计时、超时），读取时计算
+    now = now or datetime.utcnow()
+    status_code = row.get("status_code", WAIT_PAY)
+    expire_at = row.get("pay_expire_at")
+    if status_code == WAIT_PAY and expire_at and expire_at < now:
+        title, color = "支付超时", "999"
+    else:
+        title, color = order_status.get(status_code, ("", "999"))
+    row["status_bar"] = {"color": color, "image_type": "", "sub_title": "", "title": title}
+    row["time_pass"] = int((now - epoch).total_seconds()) - row.get("order_time", 0)
+    return row
+
+
+async def create_order(conn, order_id: str, user_id: int, cart: dict, order: OrderInCreate) -> dict:
+    doc = build_order(order_id, user_id, cart, order)
+    await conn[db_name][orders_collection_name].insert_one(doc)
+    return doc
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# history
+def order_collections(conn) -> list:
+    # (热数据, 冷数据)
+    return [
+        conn[db_name][orders_collection_name],
+        conn[ORDER_ARCHIVE_DB][orders_collection_name],
+    ]
+
+
+query_shape(orders_collection_name, "user_id", "created_at", "_id")
+async def page_orders(
+    collection,
+    user_id: int,
+    after: tuple = None,
+    skip: int = 0,
+    limit: int = 10,
+) -> list:
+    filter = {"user_id": user_id}
+    if after:
+        created_at, last_id = after
+        filter["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}},
+        ]
+    rows = collection.find(filter, projection=list_projection) \
+        .sort([("created_at", -1), ("_id", -1)])
+    if skip:
+        rows = rows.skip(skip)
+    return [row async for row in rows.limit(limit)]
+
+
+async def get_orders(
+    conn,
+    user_id: int,
+    offset: int = 0,
+    limit: int = 10,
+    cursor: str = None,
+):
+    # 返回 (订单列表, 下一页游标)，不足一页时游标为 None
+    after = None
+    if cursor:
+        value, last_id = decode_cursor(cursor)
+        try:
+            after = (epoch + timedelta(milliseconds=value), ObjectId(last_id))
+        except (TypeError, OverflowError, InvalidId):
+            raise HTTPException(
+                status_code=HTTP_400_BAD_REQUEST,
+                detail="Invalid cursor"
+            )
+
+    hot, cold = order_collections(conn)
+    rows = await page_orders(hot, user_id, after, 0 if after else offset, limit)
+    if len(rows) < limit and ORDER_ARCHIVE_DB != db_name:
+        # 热数据读完，按同样的顺序接着读冷数据
+        skip = 0
+        if rows:
+            after = (rows[-1]["created_at"], rows[-1]["_id"])
+        elif not after and offset:
+            skip = max(0, offset - await hot.count_documents({"user_id": user_id}))
+        rows += await page_orders(cold, user_id, after, skip, limit - len(rows))
+
+    next_cursor = None
+    if rows and len(rows) == limit:
+        last = rows[-1]
+        milliseconds = (last["created_at"] - epoch) // timedelta(milliseconds=1)
+        next_cursor = encode_cursor(milliseconds, str(last["_id"]))
+
+    now = datetime.utcnow()
+    res = []
+    for row in rows:
+        row.pop("_id")
+        row.pop("created_at")
+        res.append(render_order(row, now))
+    return res, next_cursor
+
+
+query_shape(orders_collection_name, "_id")
+async def get_order_snapshot(conn, user_id: int, order_id: str) -> dict:
+    try:
+        filter = {"_id": ObjectId(order_id), "user_id": user_id}
+    except (TypeError, InvalidId):
+        filter = None
+
+    collections = order_collections(conn) if filter else []
+    if ORDER_ARCHIVE_DB == db_name:
+        collections = collections[:1]
+    for collection in collections:
+        row = await collection.find_one(filter, projection=snapshot_projection)
+        if row:
+            snapshot = row["snapshot"]
+            snapshot["status_code"] = row.get("status_code", WAIT_PAY)
+            snapshot["pay_expire_at"] = row.get("pay_expire_at")
+            return render_order(snapshot)
+
+    raise HTTPException(
+        status_code=HTTP_404_NOT_FOUND,
+        detail=f"订单 {order_id} 不存在",
+    )
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# archive
+query_shape(orders_collection_name, "created_at")
+async def archive_orders(conn, before: datetime, batch_size: int = ORDER_ARCHIVE_BATCH) -> int:
+    # 先写冷库再删热库，中途失败重跑时已写入的订单按 _id 冲突跳过
+    if ORDER_ARCHIVE_DB == db_name:
+        return 0
+    hot, cold = order_collections(conn)
+    await cold.create_indexes(order_indexes)
+
+    moved = 0
+    while True:
+        rows = hot.find({"created_at": {"$lt": before}}).limit(batch_size)
+        rows = [row async for row in rows]
+        if not rows:
+            break
+        try:
+            await cold.insert_many(rows, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        await hot.delete_many({"_id": {"$in": [row["_id"] for row in rows]}})
+        moved += len(rows)
+        logger.info("已归档订单 %s", moved)
+    return moved
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# cli
+# ORDER_ARCHIVE_DB=elm_archive python fmorder.py archive --days 180
+async def main(args) -> int:
+    from fmdb import db, connect_to_mongo, close_mongo_connection
+
+    if ORDER_ARCHIVE_DB == db_name:
+        print("ORDER_ARCHIVE_DB 与 MONGO_DB 相同，无需归档")
+        return 2
+
+    await connect_to_mongo()
+    try:
+        before = datetime.utcnow() - timedelta(days=args.days)
+        moved = await archive_orders(db.client, before, args.batch_size)
+        print("archived", moved)
+    finally:
+        await close_mongo_connection()
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="归档历史订单")
+    parser.add_argument("command", choices=["archive"])
+    parser.add_argument("--days", type=int, default=ORDER_ARCHIVE_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ORDER_ARCHIVE_BATCH)
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.get_event_loop().run_until_complete(main(parser.parse_args())))
+# =============================================================================
@@ -0,0 +1,73 @@
+import os
+import hashlib
+
+from starlette.responses import Response
+from starlette.status import HTTP_304_NOT_MODIFIED
+
+from fmjson import JSONBytesResponse
+
+# -----------------------------------------------------------------------------
+# http cache config
+# 城市、分类、配送方式等目录数据，浏览器/CDN 缓存秒数与过期后可先用旧数据的秒数
+CATALOG_MAX_AGE = int(os.getenv("CATALOG_MAX_AGE", 300))
+CATALOG_STALE = int(os.getenv("CATALOG_STALE", 3600))
+# 菜单一天改几次，缓存时间短一些，靠 ETag 重新验证
+MENU_MAX_AGE = int(os.getenv("MENU_MAX_AGE", 30))
+MENU_STALE = int(os.getenv("MENU_STALE", 300))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# cache policy
+class CachePolicy:
+    def __init__(
+        self,
+        max_age: int = 0,
+        stale_while_revalidate: int = 0,
+        private: bool = False,
+    ):
+        parts = ["private" if private else "public", f"max-age={max_age}"]
+        if stale_while_revalidate:
+            parts.append(f"stale-while-revalidate={stale_while_revalidate}")
+        self.cache_control = ", ".join(parts)
+
+
+# 各接口使用的策略
+catalog_policy = CachePolicy(CATALOG_MAX_AGE, CATALOG_STALE)
+menu_policy = CachePolicy(MENU_MAX_AGE, MENU_STALE)
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# conditional get
+def make_etag(body: bytes) -> str:
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match 可以是 * 或逗号分隔的多个 ETag，比较时忽略弱校验前缀 W/
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def conditional_response(
+    body: bytes,
+    if_none_match: str,
+    policy: CachePolicy,
+    etag: str = None,
+) -> Response:
+    etag = etag or make_etag(body)
+    headers = {"ETag": etag, "Cache-Control": policy.cache_control}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+    return JSONBytesResponse(body, headers=headers)
+# =============================================================================
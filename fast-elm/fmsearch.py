@@ -0,0 +1,249 @@
+import os
+import re
+import math
+import asyncio
+import logging
+
+from bisect import bisect_left
+
+from fmdb import db, db_name, restaurants_collection_name, menus_collection_name
+from fmgeo import haversine
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# search config
+SEARCH_REFRESH_INTERVAL = float(os.getenv("SEARCH_REFRESH_INTERVAL", 300))   # 秒
+SEARCH_GRID = float(os.getenv("SEARCH_GRID", 0.05))         # 地理网格边长, 度
+SEARCH_PREFIX_LIMIT = int(os.getenv("SEARCH_PREFIX_LIMIT", 200))   # 前缀最多展开的词数
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# tokenizer
+# 中文按单字和相邻双字建索引，查询时用双字，相当于子串匹配
+# 字母数字（英文、拼音）按整词建索引，查询时按前缀匹配
+TOKEN_RE = re.compile(r"[一-鿿]+|[a-z0-9]+")
+
+# 字段权重
+NAME_WEIGHT = 4.0
+CATEGORY_WEIGHT = 2.0
+FOOD_WEIGHT = 1.0
+PREFIX_FACTOR = 0.5             # 前缀命中的得分折扣
+
+
+def is_cjk(run: str) -> bool:
+    return "一" <= run[0] <= "鿿"
+
+
+def index_terms(text: str) -> set:
+    terms = set()
+    for run in TOKEN_RE.findall((text or "").lower()):
+        if is_cjk(run):
+            terms.update(run)
+            terms.update(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.add(run)
+    return terms
+
+
+def pinyin_terms(pinyin: str) -> set:
+    # "xiang guo" -> xiang, guo, xiangguo, xg
+    words = TOKEN_RE.findall((pinyin or "").lower())
+    terms = set(words)
+    if len(words) > 1:
+        terms.add("".join(words))
+        terms.add("".join(word[0] for word in words))
+    return terms
+
+
+def query_terms(keyword: str) -> list:
+    # 返回 [(词, 是否前缀匹配)]
+    terms = []
+    for run in TOKEN_RE.findall((keyword or "").lower()):
+        if not is_cjk(run):
+            terms.append((run, True))
+        elif len(run) == 1:
+            terms.append((run, False))
+        else:
+            terms.extend((run[i:i + 2], False) for i in range(len(run) - 1))
+    return terms
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# search index
+def grid_cell(latitude: float, longitude: float) -> tuple:
+    return (math.floor(latitude / SEARCH_GRID), math.floor(longitude / SEARCH_GRID))
+
+
+class SearchIndex:
+    # 构建后只读，刷新时整体替换
+    # 倒排表按网格分片: 词 -> {网格: {shop id: 权重}}，地理查询只读附近网格的分片
+    def __init__(self, shops: list = (), menus: list = ()):
+        self.locations = {}         # shop id -> (纬度, 经度)
+        self.postings = {}
+
+        cells = {}
+        for shop in shops:
+            shop_id = shop["id"]
+            self.locations[shop_id] = (shop["latitude"], shop["longitude"])
+            cells[shop_id] = grid_cell(shop["latitude"], shop["longitude"])
+            self.add(index_terms(shop.get("name")), cells[shop_id], shop_id, NAME_WEIGHT)
+            self.add(
+                index_terms(shop.get("category")), cells[shop_id], shop_id, CATEGORY_WEIGHT
+            )
+
+        for menu in menus:
+            shop_id = menu.get("restaurant_id")
+            if shop_id not in cells:
+                continue
+            for food in menu.get("foods") or []:
+                terms = index_terms(food.get("name"))
+                terms |= pinyin_terms(food.get("pinyin_name"))
+                self.add(terms, cells[shop_id], shop_id, FOOD_WEIGHT)
+
+        self.terms = sorted(self.postings)
+
+    def add(self, terms: set, cell: tuple, shop_id: int, weight: float):
+        for term in terms:
+            postings = self.postings.setdefault(term, {}).setdefault(cell, {})
+            if postings.get(shop_id, 0) < weight:
+                postings[shop_id] = weight
+
+    def expand(self, term: str, prefix: bool) -> list:
+        # [(词, 得分系数)]，前缀匹配时最多展开 SEARCH_PREFIX_LIMIT 个词
+        terms = [(term, 1.0)] if term in self.postings else []
+        if prefix:
+            start = bisect_left(self.terms, term)
+            for other in self.terms[start:start + SEARCH_PREFIX_LIMIT]:
+                if not other.startswith(term):
+                    break
+                if other != term:
+                    terms.append((other, PREFIX_FACTOR))
+        return terms
+
+    def match(self, term: str, prefix: bool, cells: set = None) -> dict:
+        # 返回 {shop id: 得分}，cells 不为空时只看这些网格
+        scores = {}
+        for other, factor in self.expand(term, prefix):
+            by_cell = self.postings[other]
+            if cells is None:
+                parts = by_cell.values()
+            elif len(cells) < len(by_cell):
+                parts = [by_cell[cell] for cell in cells if cell in by_cell]
+            else:
+                parts = [part for cell, part in by_cell.items() if cell in cells]
+            for part in parts:
+                for shop_id, weight in part.items():
+                    weight *= factor
+                    if scores.get(shop_id, 0) < weight:
+                        scores[shop_id] = weight
+        return scores
+
+    def nearby_cells(self, latitude: float, longitude: float, radius: float) -> set:
+        # 覆盖搜索半径的网格，精确距离之后再算
+        dlat = radius / 111320
+        dlng = dlat / max(math.cos(math.radians(latitude)), 0.01)
+        x0, y0 = grid_cell(latitude - dlat, longitude - dlng)
+        x1, y1 = grid_cell(latitude + dlat, longitude + dlng)
+        return {
+            (x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+        }
+
+    def search(
+        self,
+        keyword: str,
+        latitude: float = None,
+        longitude: float = None,
+        radius: float = None,
+    ) -> list:
+        # 返回按得分降序、距离升序排列的 [(shop id, 距离米)]，所有查询词都需命中
+        terms = query_terms(keyword)
+        if not terms:
+            return []
+
+        cells = None
+        if latitude is not None and radius:
+            cells = self.nearby_cells(latitude, longitude, radius)
+        matches = sorted(
+            (self.match(term, prefix, cells) for term, prefix in terms), key=len
+        )
+        candidates = set(matches[0])
+        for scores in matches[1:]:
+            candidates &= scores.keys()
+
+        hits = []
+        for shop_id in candidates:
+            meters = 0
+            if latitude is not None:
+                meters = haversine(latitude, longitude, *self.locations[shop_id])
+                if radius and meters > radius:
+                    continue
+            score = sum(scores[shop_id] for scores in matches)
+            hits.append((-score, meters, shop_id))
+        hits.sort()
+        return [(shop_id, meters) for _, meters, shop_id in hits]
+
+
+class SearchHolder:
+    index: SearchIndex = SearchIndex()
+    task: asyncio.Task = None
+
+
+searches = SearchHolder()
+
+
+def get_search_index() -> SearchIndex:
+    return searches.index
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# load & refresh
+async def load_search_index() -> SearchIndex:
+    database = db.client[db_name]
+    shops = await database[restaurants_collection_name].find(
+        {},
+        projection={
+            "_id": False, "id": True, "name": True, "category": True,
+            "latitude": True, "longitude": True,
+        },
+    ).to_list(None)
+    menus = await database[menus_collection_name].find(
+        {},
+        projection={
+            "_id": False, "restaurant_id": True,
+            "foods.name": True, "foods.pinyin_name": True,
+        },
+    ).to_list(None)
+
+    # 几十万条数据建索引要几秒，放到线程里，事件循环可以穿插处理请求
+    loop = asyncio.get_event_loop()
+    searches.index = await loop.run_in_executor(None, SearchIndex, shops, menus)
+    logger.info(
+        "搜索索引加载完成: %s 个餐馆, %s 个词",
+        len(searches.index.locations), len(searches.index.terms)
+    )
+    return searches.index
+
+
+async def refresh_search_index():
+    while True:
+        await asyncio.sleep(SEARCH_REFRESH_INTERVAL)
+        try:
+            await load_search_index()
+        except Exception as e:
+            logger.warning("搜索索引刷新失败: %r", e)
+
+
+async def start_search_index():
+    await load_search_index()
+    searches.task = asyncio.ensure_future(refresh_search_index())
+
+
+async def stop_search_index():
+    if searches.task:
+        searches.task.cancel()
+        searches.task = None
+# =============================================================================
@@ -1,8 +1,29 @@
+import os
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+
 import bcrypt
 from passlib.context import CryptContext
+from fastapi import HTTPException
+from starlette.status import HTTP_503_SERVICE_UNAVAILABLE
 
+# -----------------------------------------------------------------------------
+# password config
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))            # bcrypt cost
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 4))       # 哈希线程数
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", 64))   # 执行中+排队上限
+# =============================================================================
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# cost 不等于 BCRYPT_ROUNDS 的哈希在登录时会被重新计算
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
 
 
 def generate_salt():
@@ -14,4 +35,54 @@ def verify_password(plain_password, hashed_password):
 
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
\ No newline at end of file
+    return pwd_context.hash(password)
+
+
+# -----------------------------------------------------------------------------
+# password pool
+# bcrypt 每次要 100ms 以上的 cpu，放到独立线程池执行（bcrypt 计算时释放 GIL）
+# 排队数超过 PASSWORD_QUEUE_SIZE 时直接返回 503，不让登录风暴拖垮其他接口
+class PasswordPool:
+    executor: ThreadPoolExecutor = None
+    pending: int = 0
+
+
+password_pool = PasswordPool()
+
+
+async def run_in_password_pool(func, *args):
+    if password_pool.pending >= PASSWORD_QUEUE_SIZE:
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please retry later"
+        )
+    if not password_pool.executor:
+        password_pool.executor = ThreadPoolExecutor(
+            max_workers=PASSWORD_WORKERS,
+            thread_name_prefix="password"
+        )
+
+    password_pool.pending += 1
+    try:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(password_pool.executor, func, *args)
+    finally:
+        password_pool.pending -= 1
+
+
+async def verify_and_update_password(plain_password, hashed_password):
+    # 返回 (是否匹配, 新哈希)，cost 未变化时新哈希为 None
+    return await run_in_password_pool(
+        pwd_context.verify_and_update, plain_password, hashed_password
+    )
+
+
+async def get_password_hash_async(password):
+    return await run_in_password_pool(pwd_context.hash, password)
+
+
+async def close_password_pool():
+    if password_pool.executor:
+        password_pool.executor.shutdown(wait=False)
+        password_pool.executor = None
+# =============================================================================
@@ -0,0 +1,275 @@
+import os
+import copy
+import time
+import asyncio
+import logging
+
+from pydantic import BaseModel
+from pymongo import ReplaceOne
+from pymongo.errors import PyMongoError
+
+from fmdb import (
+    query_shape,
+    db,
+    db_name,
+    restaurants_collection_name,
+    category_counts_collection_name,
+    entries_collection_name,
+    categories_collection_name,
+    deliveries_collection_name,
+    activities_collection_name,
+)
+from fmjson import model_projection, load_row, dumps
+from fmresponse import make_etag
+from fmmodel import EntryModel, CategoryModel, DeliveriesModel, ActivitiesModel
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# snapshot config
+# 定时刷新间隔秒数；支持 change stream 时集合变化后会立即刷新
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SNAPSHOT_REFRESH_INTERVAL", 60))
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# reference snapshot
+# entries / categories / deliveries / activities 都是很小的参考数据表
+# 启动时整体加载到内存，刷新时构造新的 ReferenceSnapshot 整体替换
+class SnapshotTable:
+    def __init__(self, rows: list):
+        self.rows = tuple(rows)
+        self.body = dumps(rows)
+        self.etag = make_etag(self.body)
+
+
+class CategoryNode:
+    def __init__(self, id: int, parent_id: int, full_name: str, level: int):
+        self.id = id
+        self.parent_id = parent_id
+        self.full_name = full_name          # 与 shops.category 一致: "父/子"
+        self.level = level
+
+
+class CategoryTree:
+    # 分类 id -> 覆盖的 shops.category 取值；父分类覆盖全部子分类
+    # counts 为 shops.category -> 餐馆数，父分类的数量由子分类求和
+    # 餐馆数保存在 category_counts 集合，写 shops 的程序按分类 $inc
+    def __init__(self, categories: list = (), counts: dict = None):
+        self.categories = [as_dict(category) for category in categories]
+        self.counts = dict(counts or {})
+
+        nodes = {}
+        names = {}
+        for category in self.categories:
+            subs = []
+            for sub in category.get("sub_categories") or []:
+                # 与父分类同 id 的子分类是 "全部xx"，不对应具体的 shops.category
+                if sub.get("id") is None or sub["id"] == category.get("id"):
+                    continue
+                full_name = f"{category.get('name')}/{sub.get('name')}"
+                nodes[sub["id"]] = CategoryNode(
+                    sub["id"], category.get("id"), full_name, sub.get("level") or 2
+                )
+                names[sub["id"]] = (full_name,)
+                subs.append(full_name)
+            if category.get("id") is not None:
+                names[category["id"]] = tuple(subs)
+
+        self.nodes = nodes
+        self.names = names
+
+    def full_names(self, ids: list) -> list:
+        res = []
+        for id in ids or []:
+            for name in self.names.get(id, ()):
+                if name not in res:
+                    res.append(name)
+        return res
+
+    def count(self, id: int) -> int:
+        return sum(self.counts.get(name, 0) for name in self.names.get(id, ()))
+
+    def render(self) -> list:
+        # 带上当前餐馆数的分类列表
+        res = []
+        for category in self.categories:
+            category = dict(category)
+            if category.get("id") is not None:
+                category["count"] = self.count(category["id"])
+            category["sub_categories"] = [
+                dict(sub, count=self.count(sub["id"])) if sub.get("id") is not None else sub
+                for sub in category.get("sub_categories") or []
+            ]
+            res.append(category)
+        return res
+
+
+def as_dict(row) -> dict:
+    return row.dict() if isinstance(row, BaseModel) else dict(row)
+
+
+class ReferenceSnapshot:
+    def __init__(
+        self,
+        rows: dict = None,
+        category_tree: CategoryTree = None,
+        loaded_at: float = None,
+    ):
+        self.rows = rows or {}
+        self.category_tree = category_tree or CategoryTree()
+        self.loaded_at = loaded_at
+
+        def table(name):
+            return SnapshotTable(self.rows.get(name, []))
+
+        self.entries = table(entries_collection_name)
+        self.deliveries = table(deliveries_collection_name)
+        self.activities = table(activities_collection_name)
+        self.categories = self.render_categories()
+
+    def render_categories(self) -> SnapshotTable:
+        # 分类表使用带餐馆数的版本
+        return SnapshotTable([
+            load_row(CategoryModel, category)
+            for category in self.category_tree.render()
+        ])
+
+    def with_category_tree(self, category_tree: CategoryTree):
+        # 其他表原样复用，只重新序列化分类表
+        snapshot = copy.copy(self)
+        snapshot.category_tree = category_tree
+        snapshot.categories = snapshot.render_categories()
+        return snapshot
+
+
+reference_models = {
+    entries_collection_name: EntryModel,
+    categories_collection_name: CategoryModel,
+    deliveries_collection_name: DeliveriesModel,
+    activities_collection_name: ActivitiesModel,
+}
+
+
+class SnapshotHolder:
+    snapshot: ReferenceSnapshot = ReferenceSnapshot()
+    changed: asyncio.Event = None
+    tasks: list = []
+
+
+snapshots = SnapshotHolder()
+
+
+def get_snapshot() -> ReferenceSnapshot:
+    return snapshots.snapshot
+
+
+def snapshot_age() -> float:
+    # 距上次成功加载的秒数，未加载时为 None
+    loaded_at = snapshots.snapshot.loaded_at
+    return None if loaded_at is None else time.time() - loaded_at
+
+
+def get_category_tree() -> CategoryTree:
+    return snapshots.snapshot.category_tree
+
+
+async def adjust_category_count(conn, category: str, delta: int = 1):
+    # 餐馆新增 (+1)、删除 (-1) 后调用，修改分类时旧分类 -1、新分类 +1
+    # 本进程立即更新分类树，其他进程通过 change stream 或定时刷新读到新计数
+    await conn[db_name][category_counts_collection_name].update_one(
+        {"_id": category}, {"$inc": {"count": delta}}, upsert=True
+    )
+    old = snapshots.snapshot
+    counts = dict(old.category_tree.counts)
+    counts[category] = counts.get(category, 0) + delta
+    snapshots.snapshot = old.with_category_tree(
+        CategoryTree(old.category_tree.categories, counts)
+    )
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# load & refresh
+async def load_table(name: str, model) -> list:
+    rows = db.client[db_name][name].find({}, projection=model_projection(model))
+    return [load_row(model, row) async for row in rows]
+
+
+query_shape(restaurants_collection_name, "category")
+async def rebuild_category_counts() -> dict:
+    # 按 shops 重新统计并覆盖 category_counts；先按 category 排序，分组可以走 (category, id) 索引
+    rows = db.client[db_name][restaurants_collection_name].aggregate([
+        {"$sort": {"category": 1}},
+        {"$group": {"_id": "$category", "count": {"$sum": 1}}},
+    ])
+    counts = {row["_id"]: row["count"] async for row in rows}
+    if counts:
+        await db.client[db_name][category_counts_collection_name].bulk_write([
+            ReplaceOne({"_id": name}, {"count": count}, upsert=True)
+            for name, count in counts.items()
+        ], ordered=False)
+    return counts
+
+
+async def load_category_counts() -> dict:
+    # 计数集合为空（新部署或手工删除以纠正误差）时从 shops 重建一次
+    rows = db.client[db_name][category_counts_collection_name].find()
+    counts = {row["_id"]: row["count"] async for row in rows}
+    return counts or await rebuild_category_counts()
+
+
+async def load_snapshot() -> ReferenceSnapshot:
+    rows = {}
+    for name, model in reference_models.items():
+        rows[name] = await load_table(name, model)
+    tree = CategoryTree(rows[categories_collection_name], await load_category_counts())
+    snapshots.snapshot = ReferenceSnapshot(rows, tree, time.time())
+    logger.info(
+        "参考数据加载完成: %s",
+        ", ".join(f"{name}={len(items)}" for name, items in rows.items())
+    )
+    return snapshots.snapshot
+
+
+async def refresh_snapshot():
+    while True:
+        try:
+            await asyncio.wait_for(
+                snapshots.changed.wait(), SNAPSHOT_REFRESH_INTERVAL
+            )
+        except asyncio.TimeoutError:
+            pass
+        snapshots.changed.clear()
+        try:
+            await load_snapshot()
+        except Exception as e:
+            # 加载失败时继续使用旧快照，snapshot_age 会持续增长
+            logger.warning("参考数据刷新失败: %r", e)
+
+
+async def watch_snapshot():
+    collections = list(reference_models) + [category_counts_collection_name]
+    pipeline = [{"$match": {"ns.coll": {"$in": collections}}}]
+    try:
+        async with db.client[db_name].watch(pipeline) as stream:
+            async for change in stream:
+                snapshots.changed.set()
+    except PyMongoError as e:
+        logger.info("参考数据: change stream 不可用 (%r)，只做定时刷新", e)
+
+
+async def start_snapshot():
+    snapshots.changed = asyncio.Event()
+    await load_snapshot()
+    snapshots.tasks = [
+        asyncio.ensure_future(refresh_snapshot()),
+        asyncio.ensure_future(watch_snapshot()),
+    ]
+
+
+async def stop_snapshot():
+    for task in snapshots.tasks:
+        task.cancel()
+    snapshots.tasks = []
+# =============================================================================
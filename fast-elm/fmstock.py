@@ -0,0 +1,271 @@
+import os
+import asyncio
+import logging
+
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from fmdb import db, db_name, stocks_collection_name, reservations_collection_name, query_shape
+
+logger = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# stock config
+STOCK_HOLD_TTL = float(os.getenv("STOCK_HOLD_TTL", 900))           # 下单后未支付的保留秒数
+STOCK_SWEEP_INTERVAL = float(os.getenv("STOCK_SWEEP_INTERVAL", 30))  # 过期清理间隔秒数
+STOCK_SWEEP_BATCH = int(os.getenv("STOCK_SWEEP_BATCH", 500))       # 每轮最多释放的预留数
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# stock lines
+# 库存从 menus 文档中拆出，每个规格一个 stocks 文档:
+#   {_id: sku_id, restaurant_id, stock, promotion_stock, holds: {预留 id: 数量}}
+# 扣减只锁单个规格文档，热门商品的抢购不会串行化整个菜单
+# holds 中每个预留至少占一件库存，条目数不会超过库存数
+HELD = "held"
+CONFIRMED = "confirmed"
+RELEASED = "released"
+
+
+class StockLine:
+    # stock / promotion_stock 为菜单中的初始值，只在 stocks 文档不存在时使用
+    def __init__(
+        self,
+        sku_id: int,
+        quantity: int,
+        restaurant_id: int = None,
+        stock: int = 0,
+        promotion_stock: int = -1,
+    ):
+        self.sku_id = sku_id
+        self.quantity = quantity
+        self.restaurant_id = restaurant_id
+        self.stock = stock or 0
+        self.promotion_stock = -1 if promotion_stock is None else promotion_stock
+
+    @property
+    def limited(self) -> bool:
+        # promotion_stock 为 -1 表示不限量
+        return self.promotion_stock >= 0
+
+    def dict(self) -> dict:
+        return {
+            "sku_id": self.sku_id,
+            "quantity": self.quantity,
+            "restaurant_id": self.restaurant_id,
+            "stock": self.stock,
+            "promotion_stock": self.promotion_stock,
+        }
+
+
+def merge_lines(lines: list) -> list:
+    # 同一规格合并为一行，每个规格文档每单只更新一次
+    merged = {}
+    for line in lines:
+        if line.sku_id in merged:
+            merged[line.sku_id].quantity += line.quantity
+        else:
+            merged[line.sku_id] = StockLine(**line.dict())
+    return list(merged.values())
+
+
+def reserve_request(line: StockLine, reservation_id: str) -> UpdateOne:
+    # 库存足够时才扣减，同时记下预留，释放时按预留是否存在判断，保证只释放一次
+    filter = {"_id": line.sku_id, "stock": {"$gte": line.quantity}}
+    inc = {"stock": -line.quantity}
+    if line.limited:
+        filter["promotion_stock"] = {"$gte": line.quantity}
+        inc["promotion_stock"] = -line.quantity
+    return UpdateOne(
+        filter, {"$inc": inc, "$set": {f"holds.{reservation_id}": line.quantity}}
+    )
+
+
+def release_request(line: StockLine, reservation_id: str) -> UpdateOne:
+    inc = {"stock": line.quantity}
+    if line.limited:
+        inc["promotion_stock"] = line.quantity
+    return UpdateOne(
+        {"_id": line.sku_id, f"holds.{reservation_id}": {"$exists": True}},
+        {"$inc": inc, "$unset": {f"holds.{reservation_id}": ""}},
+    )
+
+
+def init_request(line: StockLine) -> UpdateOne:
+    return UpdateOne(
+        {"_id": line.sku_id},
+        {"$setOnInsert": {
+            "restaurant_id": line.restaurant_id,
+            "stock": line.stock,
+            "promotion_stock": line.promotion_stock,
+            "holds": {},
+        }},
+        upsert=True,
+    )
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# reserve & release
+query_shape(stocks_collection_name, "_id")
+async def release_lines(conn, reservation_id: str, lines: list):
+    await conn[db_name][stocks_collection_name].bulk_write(
+        [release_request(line, reservation_id) for line in lines], ordered=False
+    )
+
+
+async def init_stocks(conn, lines: list) -> bool:
+    # 规格第一次被购买时按菜单中的库存建立 stocks 文档，返回是否有新建
+    result = await conn[db_name][stocks_collection_name].bulk_write(
+        [init_request(line) for line in lines], ordered=False
+    )
+    return result.upserted_count > 0
+
+
+query_shape(reservations_collection_name, "_id")
+async def reserve_stock(
+    conn,
+    reservation_id: str,
+    lines: list,
+    user_id: int = None,
+) -> bool:
+    # 一单的所有规格在一次 bulk_write 中各做一次条件扣减
+    # 有任何一行库存不足时释放已扣减的行，返回 False
+    lines = merge_lines(lines)
+    now = datetime.utcnow()
+    # 先写预留记录，扣减后进程退出时由过期清理释放
+    await conn[db_name][reservations_collection_name].insert_one({
+        "_id": reservation_id,
+        "state": HELD,
+        "user_id": user_id,
+        "lines": [line.dict() for line in lines],
+        "created_at": now,
+        "expire_at": now + timedelta(seconds=STOCK_HOLD_TTL),
+    })
+
+    stocks = conn[db_name][stocks_collection_name]
+    for attempt in range(2):
+        result = await stocks.bulk_write(
+            [reserve_request(line, reservation_id) for line in lines], ordered=False
+        )
+        if result.matched_count == len(lines):
+            return True
+        await release_lines(conn, reservation_id, lines)
+        # 没有匹配可能是 stocks 文档还不存在，建立后重试一次
+        if attempt or not await init_stocks(conn, lines):
+            break
+
+    await conn[db_name][reservations_collection_name].update_one(
+        {"_id": reservation_id, "state": HELD}, {"$set": {"state": RELEASED}}
+    )
+    logger.debug("reservation %s 库存不足", reservation_id)
+    return False
+
+
+async def release_reservation(conn, reservation: dict):
+    # 先归还库存再改状态，中途失败时下一轮清理会再次释放，归还本身是幂等的
+    lines = [StockLine(**line) for line in reservation["lines"]]
+    await release_lines(conn, reservation["_id"], lines)
+    await conn[db_name][reservations_collection_name].update_one(
+        {"_id": reservation["_id"], "state": HELD}, {"$set": {"state": RELEASED}}
+    )
+
+
+async def release_stock(conn, reservation_id: str) -> bool:
+    # 取消订单时调用
+    reservation = await conn[db_name][reservations_collection_name].find_one(
+        {"_id": reservation_id, "state": HELD}
+    )
+    if not reservation:
+        return False
+    await release_reservation(conn, reservation)
+    return True
+
+
+async def confirm_stock(conn, reservation_id: str) -> bool:
+    # 订单写入后调用 (fmcart.place_order): 扣减生效，去掉预留标记
+    # 只确认未过期的预留，与过期清理互不重叠
+    reservation = await conn[db_name][reservations_collection_name].find_one_and_update(
+        {
+            "_id": reservation_id,
+            "state": HELD,
+            "expire_at": {"$gt": datetime.utcnow()},
+        },
+        {"$set": {"state": CONFIRMED}},
+    )
+    if not reservation:
+        return False
+    await conn[db_name][stocks_collection_name].bulk_write([
+        UpdateOne(
+            {"_id": line["sku_id"]},
+            {"$unset": {f"holds.{reservation_id}": ""}},
+        )
+        for line in reservation["lines"]
+    ], ordered=False)
+    return True
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# levels
+async def get_stock_levels(conn, sku_ids: list) -> dict:
+    # 结算时的库存预检: sku_id -> 可售数量，没有 stocks 文档的规格不在结果中
+    rows = conn[db_name][stocks_collection_name].find(
+        {"_id": {"$in": list(sku_ids)}},
+        projection={"stock": True, "promotion_stock": True},
+    )
+    levels = {}
+    async for row in rows:
+        stock = row.get("stock") or 0
+        promotion_stock = row.get("promotion_stock")
+        if promotion_stock is not None and promotion_stock >= 0:
+            stock = min(stock, promotion_stock)
+        levels[row["_id"]] = stock
+    return levels
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# expiry
+class StockSweeper:
+    task: asyncio.Task = None
+
+
+sweeper = StockSweeper()
+
+
+query_shape(reservations_collection_name, "state", "expire_at")
+async def sweep_expired(conn) -> int:
+    rows = conn[db_name][reservations_collection_name].find(
+        {"state": HELD, "expire_at": {"$lt": datetime.utcnow()}},
+        limit=STOCK_SWEEP_BATCH,
+    )
+    count = 0
+    async for reservation in rows:
+        await release_reservation(conn, reservation)
+        count += 1
+    if count:
+        logger.info("释放过期库存预留 %s 个", count)
+    return count
+
+
+async def sweep_reservations():
+    while True:
+        await asyncio.sleep(STOCK_SWEEP_INTERVAL)
+        try:
+            await sweep_expired(db.client)
+        except Exception as e:
+            logger.warning("库存预留清理失败: %r", e)
+
+
+async def start_stock_sweeper():
+    sweeper.task = asyncio.ensure_future(sweep_reservations())
+
+
+async def stop_stock_sweeper():
+    if sweeper.task:
+        sweeper.task.cancel()
+        sweeper.task = None
+# =============================================================================
@@ -1,4 +1,5 @@
 import os
+import time
 
 import jwt
 from jwt import PyJWTError
@@ -18,9 +19,11 @@ from starlette.status import (
 )
 
 from fmdb import (
+    query_shape,
     get_database, 
     db_name, 
-    users_collection_name
+    users_collection_name,
+    userinfos_collection_name,
 )
 
 from fmmodel import (
@@ -29,6 +32,8 @@ from fmmodel import (
     RWUserInDB
 )
 
+from fmcache import TTLCache, TieredCache
+
 ALGORITHM = "HS256"
 SECRET_KEY = Secret(os.getenv(
     "SECRET_KEY", 
@@ -40,6 +45,17 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7       # one week
 
 access_token_jwt_subject = "access"
 
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 30))
+
+# 已验证的 token -> TokenPayload，缓存到 token 过期为止
+token_cache = TTLCache(TOKEN_CACHE_SIZE)
+# username -> RWUserInDB，用户信息变更时调用 invalidate_user
+user_cache = TieredCache("user", maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# username -> userinfos.user_id，没有 userinfo 时为 None
+user_id_cache = TieredCache("user_id", maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
 
 class TokenPayload(RWModel):
     username: str = ""
@@ -87,16 +103,9 @@ async def _get_current_user(
     db: AsyncIOMotorClient = Depends(get_database),
     token: str = Depends(_get_authorization_token)
 ) -> RWUser:
-    try:
-        payload = jwt.decode(token, str(SECRET_KEY), algorithms=[ALGORITHM])
-        token_data = TokenPayload(**payload)
-    except PyJWTError:
-        raise HTTPException(
-            status_code=HTTP_403_FORBIDDEN,
-            detail="Could not validate credentials"
-        )
+    token_data = decode_access_token(token)
 
-    dbuser = await get_user(db, token_data.username)
+    dbuser = await get_user_cached(db, token_data.username)
     if not dbuser:
         raise HTTPException(
             status_code=HTTP_404_NOT_FOUND,
@@ -107,6 +116,35 @@ async def _get_current_user(
     return user
 
 
+async def get_current_user_id(
+    db: AsyncIOMotorClient = Depends(get_database),
+    user: RWUser = Depends(_get_current_user),
+) -> int:
+    # 当前登录用户在 userinfos 中的 user_id
+    user_id = await user_id_cache.get_or_load(
+        user.username, lambda: get_user_id(db, user.username)
+    )
+    if user_id is None:
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN,
+            detail="User info not found"
+        )
+    return user_id
+
+
+async def authorize_user_id(
+    user_id: int,
+    current_user_id: int = Depends(get_current_user_id),
+) -> int:
+    # 路径中的 user_id 必须是当前登录用户
+    if user_id != current_user_id:
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN,
+            detail="Not allowed to access other users"
+        )
+    return user_id
+
+
 async def _get_current_user_optional(
     db: AsyncIOMotorClient = Depends(get_database),
     token: str = Depends(_get_authorization_token_optional),
@@ -117,9 +155,51 @@ async def _get_current_user_optional(
     return None
 
 
+def decode_access_token(token: str) -> TokenPayload:
+    token_data = token_cache.get(token)
+    if token_data:
+        return token_data
+
+    try:
+        payload = jwt.decode(token, str(SECRET_KEY), algorithms=[ALGORITHM])
+        token_data = TokenPayload(**payload)
+    except PyJWTError:
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN,
+            detail="Could not validate credentials"
+        )
+
+    ttl = payload.get("exp", 0) - time.time()
+    if ttl > 0:
+        token_cache.set(token, token_data, ttl)
+    return token_data
+
+
+async def get_user_cached(conn: AsyncIOMotorClient, username: str) -> RWUserInDB:
+    return await user_cache.get_or_load(
+        username, lambda: get_user(conn, username)
+    )
+
+
+def invalidate_user(*usernames: str):
+    for username in usernames:
+        user_cache.invalidate(username)
+        user_id_cache.invalidate(username)
+
+
+query_shape(users_collection_name, "username")
 async def get_user(conn: AsyncIOMotorClient, username: str) -> RWUserInDB:
     row = await conn[db_name][users_collection_name].find_one(
         {"username": username}
     )
     if row:
-        return RWUserInDB(**row)
\ No newline at end of file
+        return RWUserInDB(**row)
+
+
+query_shape(userinfos_collection_name, "username")
+async def get_user_id(conn: AsyncIOMotorClient, username: str) -> int:
+    row = await conn[db_name][userinfos_collection_name].find_one(
+        {"username": username}, projection={"_id": False, "user_id": True}
+    )
+    if row:
+        return row["user_id"]
@@ -0,0 +1,86 @@
+import asyncio
+
+import httpx
+import pytest
+
+import fm
+import fmdb
+from fmbench import MockClient
+from fmtoken import get_user_id
+
+
+# -----------------------------------------------------------------------------
+# app client
+# 进程内 mongomock + httpx 直接调用 fm.app，不执行启动钩子
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def client(loop, monkeypatch):
+    monkeypatch.setattr(fmdb.db, "client", MockClient())
+    client = httpx.AsyncClient(app=fm.app, base_url="http://fm")
+    yield client
+    loop.run_until_complete(client.aclose())
+
+
+def register(loop, client, username: str) -> tuple:
+    # 返回 (user_id, Authorization 头)
+    res = loop.run_until_complete(client.post("/v1/users", json={"user": {
+        "username": username,
+        "email": f"{username}@example.com",
+        "password": "password",
+        "vcode": "",
+    }}))
+    assert res.status_code == 201
+    token = res.json()["user"]["token"]
+    user_id = loop.run_until_complete(get_user_id(fmdb.db.client, username))
+    assert user_id is not None
+    return user_id, {"Authorization": f"Token {token}"}
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# tests
+def test_register_then_list_orders(loop, client):
+    user_id, headers = register(loop, client, "alice")
+
+    res = loop.run_until_complete(
+        client.get(f"/bos/v2/users/{user_id}/orders", headers=headers)
+    )
+    assert res.status_code == 200
+    assert res.json() == []
+
+
+def test_register_then_add_and_list_addresses(loop, client):
+    user_id, headers = register(loop, client, "alice")
+
+    res = loop.run_until_complete(client.post(
+        f"/v1/users/{user_id}/addresses",
+        json={"address": "东城区", "geohash": "39.93,116.41", "name": "alice", "phone": "1"},
+        headers=headers,
+    ))
+    assert res.status_code == 200
+    address_id = res.json()["address"]["id"]
+
+    res = loop.run_until_complete(
+        client.get(f"/v1/users/{user_id}/addresses", headers=headers)
+    )
+    assert res.status_code == 200
+    assert [row["id"] for row in res.json()] == [address_id]
+
+
+def test_users_get_distinct_ids(loop, client):
+    alice_id, alice = register(loop, client, "alice")
+    bob_id, _ = register(loop, client, "bob")
+    assert alice_id != bob_id
+
+    res = loop.run_until_complete(
+        client.get(f"/v1/users/{bob_id}/addresses", headers=alice)
+    )
+    assert res.status_code == 403
+# =============================================================================
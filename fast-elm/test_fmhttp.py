@@ -0,0 +1,151 @@
+import asyncio
+
+import pytest
+from aiohttp import web, test_utils
+
+import fmhttp
+import fmcrud
+from fmhttp import HttpClientError, RetryBudget, get_json
+
+
+# -----------------------------------------------------------------------------
+# stub map server
+# 本地桩服务模拟腾讯地图接口，MAP_API_URL 指向它
+class StubMap:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0       # 前几次请求返回 503
+        self.delay = 0          # 每次请求的处理秒数
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, request):
+        self.calls += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            if self.calls <= self.failures:
+                return web.Response(status=503)
+            if request.path == "/ws/location/v1/ip":
+                return web.json_response({
+                    "status": 0,
+                    "result": {"ip": request.query["ip"], "ad_info": {"city": "北京市"}},
+                })
+            return web.json_response({
+                "status": 0,
+                "data": [{"title": request.query.get("keyword"), "boundary": request.query.get("boundary")}],
+            })
+        finally:
+            self.active -= 1
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def stub(loop, monkeypatch):
+    monkeypatch.setattr(fmhttp, "HTTP_RETRY_BACKOFF", 0)
+    stub = StubMap()
+    app = web.Application()
+    app.router.add_route("*", "/{path:.*}", stub.handle)
+    server = test_utils.TestServer(app, host="127.0.0.1")
+    loop.run_until_complete(server.start_server(loop=loop))
+    stub.url = str(server.make_url("")).rstrip("/")
+    monkeypatch.setattr(fmcrud, "MAP_API_URL", stub.url)
+
+    yield stub
+
+    loop.run_until_complete(fmhttp.close_http_client())
+    loop.run_until_complete(server.close())
+
+
+def open_client(loop, monkeypatch, **config):
+    # 连接池参数在创建 session 时读取
+    for name, value in config.items():
+        monkeypatch.setattr(fmhttp, name, value)
+    loop.run_until_complete(fmhttp.open_http_client())
+# =============================================================================
+
+
+# -----------------------------------------------------------------------------
+# tests
+def test_map_api_success(loop, stub, monkeypatch):
+    open_client(loop, monkeypatch)
+    posi = loop.run_until_complete(fmcrud.guess_position("1.2.3.4", "key"))
+    place = loop.run_until_complete(fmcrud.search_place("朝阳", "北京", "key"))
+
+    assert posi["result"]["ad_info"]["city"] == "北京市"
+    assert place["data"] == [{"title": "朝阳", "boundary": "region(北京,0)"}]
+    assert stub.calls == 2
+
+
+def test_retry_on_5xx(loop, stub, monkeypatch):
+    monkeypatch.setattr(fmhttp, "HTTP_RETRIES", 2)
+    open_client(loop, monkeypatch)
+    stub.failures = 2
+
+    place = loop.run_until_complete(fmcrud.search_place("朝阳", "北京", "key"))
+    assert place["data"][0]["title"] == "朝阳"
+    assert stub.calls == 3
+
+
+def test_5xx_gives_up_after_retries(loop, stub, monkeypatch):
+    monkeypatch.setattr(fmhttp, "HTTP_RETRIES", 2)
+    open_client(loop, monkeypatch)
+    stub.failures = 100
+
+    with pytest.raises(HttpClientError):
+        loop.run_until_complete(get_json(stub.url + "/ws/place/v1/search"))
+    assert stub.calls == 3
+
+
+def test_timeout_retries_then_fails(loop, stub, monkeypatch):
+    monkeypatch.setattr(fmhttp, "HTTP_RETRIES", 1)
+    open_client(loop, monkeypatch, HTTP_TIMEOUT=0.2)
+    # aiohttp 把超时时刻向上取整到秒，桩服务的延迟要超过 1 秒
+    stub.delay = 2
+
+    with pytest.raises(HttpClientError):
+        loop.run_until_complete(get_json(stub.url + "/ws/place/v1/search"))
+    assert stub.calls == 2
+
+
+def test_retry_budget_exhausted(loop, stub, monkeypatch):
+    # 只有一个令牌，每个请求存入 0.1 个：5 个失败请求总共只重试 1 次
+    monkeypatch.setattr(fmhttp, "HTTP_RETRIES", 2)
+    open_client(loop, monkeypatch)
+    fmhttp.http.budget = RetryBudget(0.1, min_tokens=1)
+    stub.failures = 100
+
+    for _ in range(5):
+        with pytest.raises(HttpClientError):
+            loop.run_until_complete(get_json(stub.url + "/ws/place/v1/search"))
+    assert stub.calls == 6
+
+
+def test_connector_limits(loop, stub, monkeypatch):
+    open_client(loop, monkeypatch, HTTP_POOL_SIZE=10, HTTP_HOST_LIMIT=2)
+    stub.delay = 0.05
+
+    connector = fmhttp.http.session.connector
+    assert connector.limit == 10
+    assert connector.limit_per_host == 2
+
+    async def burst():
+        return await asyncio.gather(*(
+            get_json(stub.url + "/ws/place/v1/search", {"keyword": str(n)})
+            for n in range(8)
+        ))
+
+    res = loop.run_until_complete(burst())
+    assert [row["data"][0]["title"] for row in res] == [str(n) for n in range(8)]
+    assert stub.calls == 8
+    assert stub.max_active == 2
+# =============================================================================